@@ -0,0 +1,392 @@
+"""
+In-process stand-in for S3, speaking the 2006-03-01 REST dialect the s3
+package uses: the bucket list, bucket create/delete, ListBucket with prefix,
+marker, delimiter and max-keys, and object GET/PUT/HEAD/DELETE with Range and
+the If-Match/If-None-Match/If-Modified-Since/If-Unmodified-Since conditions.
+Requests are not authenticated.
+
+Latency is added before every response and bandwidth limits how fast each
+connection reads request bodies and writes response bodies, so benchmarks
+can run against something closer to a remote server than loopback.
+
+    server = FakeS3Server(latency=0.02, bandwidth=10 * 1024 * 1024)
+    server.start()
+    service = S3Service('key', 'secret', secure=False, host='127.0.0.1',
+                        port=server.port)
+    ...
+    server.stop()
+"""
+import cgi
+import md5
+import time
+import bisect
+import socket
+import urllib
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
+from email.utils import formatdate, parsedate_tz, mktime_tz
+
+NS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+OWNER = '<Owner><ID>fakes3</ID><DisplayName>fakes3</DisplayName></Owner>'
+CHUNK_SIZE = 64 * 1024
+
+
+def _iso_date(t):
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(t))
+
+
+def _parse_http_date(value):
+    parsed = parsedate_tz(value or '')
+    if parsed is None:
+        return None
+    return mktime_tz(parsed)
+
+
+class _Object(object):
+    __slots__ = ('data', 'headers', 'mtime', 'etag')
+
+    def __init__(self, data, headers, mtime):
+        self.data = data
+        self.headers = headers
+        self.mtime = mtime
+        self.etag = '"%s"' % md5.new(data).hexdigest()
+
+
+class _Bucket(object):
+    def __init__(self, created):
+        self.created = created
+        self.objects = {}
+        self.keys = []
+        self.lock = threading.Lock()
+
+    def put(self, key, obj):
+        self.lock.acquire()
+        try:
+            if key not in self.objects:
+                bisect.insort(self.keys, key)
+            self.objects[key] = obj
+        finally:
+            self.lock.release()
+
+    def delete(self, key):
+        self.lock.acquire()
+        try:
+            if self.objects.pop(key, None) is not None:
+                del self.keys[bisect.bisect_left(self.keys, key)]
+        finally:
+            self.lock.release()
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.fake._count('connections')
+
+    def _throttled(self, size):
+        bandwidth = self.server.fake.bandwidth
+        if bandwidth:
+            time.sleep(float(size) / bandwidth)
+
+    def _split(self):
+        url = urlparse.urlparse(self.path)
+        parts = url.path.lstrip('/').split('/', 1)
+        bucket = urllib.unquote(parts[0]) or None
+        key = None
+        if len(parts) > 1 and parts[1]:
+            key = urllib.unquote(parts[1])
+        return bucket, key, dict(urlparse.parse_qsl(url.query))
+
+    def _read_body(self):
+        remaining = int(self.headers.get('Content-Length') or 0)
+        chunks = []
+        while remaining:
+            data = self.rfile.read(min(remaining, CHUNK_SIZE))
+            if not data:
+                break
+            self._throttled(len(data))
+            chunks.append(data)
+            remaining -= len(data)
+        return ''.join(chunks)
+
+    def _send(self, status, body='', headers=None, send_body=True):
+        fake = self.server.fake
+        if fake.latency:
+            time.sleep(fake.latency)
+        self.send_response(status)
+        headers = headers or {}
+        if 'Content-Length' not in headers:
+            headers['Content-Length'] = str(len(body))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if send_body and body:
+            if fake.bandwidth:
+                for pos in xrange(0, len(body), CHUNK_SIZE):
+                    chunk = body[pos:pos + CHUNK_SIZE]
+                    self._throttled(len(chunk))
+                    self.wfile.write(chunk)
+            else:
+                self.wfile.write(body)
+        fake._count('bytes_out', send_body and len(body) or 0)
+
+    def _error(self, status, code, resource='', send_body=True):
+        body = ('<?xml version="1.0" encoding="UTF-8"?><Error><Code>%s</Code>'
+                '<Message>%s</Message><Resource>%s</Resource></Error>' %
+                (code, code, cgi.escape(resource)))
+        self._send(status, body, {'Content-Type': 'application/xml'}, send_body)
+
+    def _start(self, method):
+        fake = self.server.fake
+        fake._count('requests')
+        fake._count(method)
+
+    def do_PUT(self):
+        self._start('PUT')
+        bucket, key, query = self._split()
+        data = self._read_body()
+        self.server.fake._count('bytes_in', len(data))
+        store = self.server.fake.buckets
+        if key is None:
+            if bucket not in store:
+                store[bucket] = _Bucket(time.time())
+            return self._send(200)
+        if bucket not in store:
+            return self._error(404, 'NoSuchBucket', bucket)
+        digest = self.headers.get('Content-MD5')
+        if digest and digest != md5.new(data).digest().encode('base64').strip():
+            return self._error(400, 'BadDigest', key)
+        headers = {}
+        for name, value in self.headers.items():
+            if name.startswith('x-amz-meta-') or name in ('content-type', 'content-encoding'):
+                headers[name] = value
+        obj = _Object(data, headers, time.time())
+        store[bucket].put(key, obj)
+        self._send(200, '', {'ETag': obj.etag})
+
+    def do_DELETE(self):
+        self._start('DELETE')
+        bucket, key, query = self._split()
+        store = self.server.fake.buckets
+        if bucket not in store:
+            return self._error(404, 'NoSuchBucket', bucket)
+        if key is None:
+            if store[bucket].keys:
+                return self._error(409, 'BucketNotEmpty', bucket)
+            del store[bucket]
+        else:
+            store[bucket].delete(key)
+        self._send(204)
+
+    def do_HEAD(self):
+        self.do_GET(send_body=False)
+
+    def do_GET(self, send_body=True):
+        self._start(send_body and 'GET' or 'HEAD')
+        bucket, key, query = self._split()
+        store = self.server.fake.buckets
+        if bucket is None:
+            return self._list_buckets()
+        if bucket not in store:
+            return self._error(404, 'NoSuchBucket', bucket, send_body)
+        if key is None:
+            return self._list_bucket(bucket, store[bucket], query)
+        obj = store[bucket].objects.get(key)
+        if obj is None:
+            return self._error(404, 'NoSuchKey', key, send_body)
+        headers = dict(obj.headers)
+        headers['ETag'] = obj.etag
+        headers['Last-Modified'] = formatdate(obj.mtime, usegmt=True)
+        status = self._check_conditions(obj)
+        if status is not None:
+            if status == 304:
+                return self._send(304, '', headers, False)
+            return self._error(status, 'PreconditionFailed', key, send_body)
+        data = obj.data
+        byte_range = self.headers.get('Range')
+        if byte_range and byte_range.startswith('bytes='):
+            first, last = byte_range[6:].split('-', 1)
+            if first:
+                first = int(first)
+                if last:
+                    last = min(int(last), len(data) - 1)
+                else:
+                    last = len(data) - 1
+            else:
+                first = max(0, len(data) - int(last))
+                last = len(data) - 1
+            if first >= len(data) or first > last:
+                return self._error(416, 'InvalidRange', key, send_body)
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (first, last, len(data))
+            return self._send(206, data[first:last + 1], headers, send_body)
+        headers['Content-Length'] = str(len(data))
+        self._send(200, data, headers, send_body)
+
+    def _check_conditions(self, obj):
+        get = self.headers.get
+        mtime = int(obj.mtime)
+        if get('If-Match') and get('If-Match') not in (obj.etag, '*'):
+            return 412
+        since = _parse_http_date(get('If-Unmodified-Since'))
+        if since is not None and mtime > since:
+            return 412
+        if get('If-None-Match'):
+            if get('If-None-Match') in (obj.etag, '*'):
+                return 304
+        else:
+            since = _parse_http_date(get('If-Modified-Since'))
+            if since is not None and mtime <= since:
+                return 304
+        return None
+
+    def _list_buckets(self):
+        buckets = self.server.fake.buckets
+        names = sorted(buckets)
+        body = ''.join(['<Bucket><Name>%s</Name><CreationDate>%s</CreationDate></Bucket>' %
+                        (cgi.escape(name), _iso_date(buckets[name].created)) for name in names])
+        self._send(200, '<?xml version="1.0" encoding="UTF-8"?><ListAllMyBucketsResult '
+                        'xmlns="%s">%s<Buckets>%s</Buckets></ListAllMyBucketsResult>' %
+                        (NS, OWNER, body), {'Content-Type': 'application/xml'})
+
+    def _list_bucket(self, name, bucket, query):
+        prefix = query.get('prefix', '')
+        marker = query.get('marker', '')
+        delimiter = query.get('delimiter')
+        max_keys = int(query.get('max-keys', 1000))
+        bucket.lock.acquire()
+        try:
+            keys = bucket.keys
+            i = bisect.bisect_right(keys, marker)
+            if prefix and prefix > marker:
+                i = bisect.bisect_left(keys, prefix)
+            contents = []
+            prefixes = []
+            truncated = False
+            last = None
+            while i < len(keys):
+                key = keys[i]
+                if not key.startswith(prefix):
+                    break
+                pos = -1
+                if delimiter:
+                    pos = key.find(delimiter, len(prefix))
+                if pos >= 0:
+                    common = key[:pos + len(delimiter)]
+                    if common <= marker or (prefixes and prefixes[-1] == common):
+                        i += 1
+                        continue
+                    if len(contents) + len(prefixes) >= max_keys:
+                        truncated = True
+                        break
+                    prefixes.append(common)
+                    last = common
+                else:
+                    if len(contents) + len(prefixes) >= max_keys:
+                        truncated = True
+                        break
+                    contents.append((key, bucket.objects[key]))
+                    last = key
+                i += 1
+        finally:
+            bucket.lock.release()
+        parts = ['<?xml version="1.0" encoding="UTF-8"?><ListBucketResult xmlns="%s">'
+                 '<Name>%s</Name><Prefix>%s</Prefix><Marker>%s</Marker><MaxKeys>%d</MaxKeys>' %
+                 (NS, cgi.escape(name), cgi.escape(prefix), cgi.escape(marker), max_keys)]
+        if delimiter:
+            parts.append('<Delimiter>%s</Delimiter>' % cgi.escape(delimiter))
+            if truncated and last:
+                parts.append('<NextMarker>%s</NextMarker>' % cgi.escape(last))
+        parts.append('<IsTruncated>%s</IsTruncated>' % (truncated and 'true' or 'false'))
+        for key, obj in contents:
+            parts.append('<Contents><Key>%s</Key><LastModified>%s</LastModified>'
+                         '<ETag>&quot;%s&quot;</ETag><Size>%d</Size>%s'
+                         '<StorageClass>STANDARD</StorageClass></Contents>' %
+                         (cgi.escape(key), _iso_date(obj.mtime), obj.etag.strip('"'),
+                          len(obj.data), OWNER))
+        for common in prefixes:
+            parts.append('<CommonPrefixes><Prefix>%s</Prefix></CommonPrefixes>' %
+                         cgi.escape(common))
+        parts.append('</ListBucketResult>')
+        self._send(200, ''.join(parts), {'Content-Type': 'application/xml'})
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 256
+
+
+class FakeS3Server(object):
+    """
+    Threaded in-memory S3 server.
+
+    buckets maps bucket names to their contents; stats counts connections,
+    requests (also per method) and body bytes in and out.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, bandwidth=None):
+        """
+        @param host:      Address to listen on
+        @type  host:      string
+        @param port:      Port to listen on, 0 for any free port
+        @type  port:      int
+        @param latency:   Seconds added before every response
+        @type  latency:   float
+        @param bandwidth: Bytes per second per connection, None for unlimited
+        @type  bandwidth: int
+        """
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.buckets = {}
+        self.stats = {}
+        self._stats_lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def _count(self, name, n=1):
+        self._stats_lock.acquire()
+        try:
+            self.stats[name] = self.stats.get(name, 0) + n
+        finally:
+            self._stats_lock.release()
+
+    def start(self):
+        """
+        Start serving on a background thread.
+
+        @return: The port the server listens on
+        @rtype:  int
+        """
+        self._server = _Server((self.host, self.port), _Handler)
+        self._server.fake = self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return self.port
+
+    def stop(self):
+        """
+        Stop serving and close the listening socket.
+        """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
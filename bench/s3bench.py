@@ -0,0 +1,292 @@
+"""
+End to end S3 benchmarks against the in-process fake server.
+
+Runs small-object, large-object, listing and delete workloads through
+S3Service/S3Bucket and reports, per operation, ops/s, p50/p99 latency and
+MB/s. The report is printed as a table and can be written as JSON to
+compare runs across commits.
+
+    python bench/s3bench.py [options]
+    python bench/s3bench.py --latency 0.02 --bandwidth 20000000 --json out.json
+"""
+import os
+import sys
+import time
+import json
+import random
+import tempfile
+import threading
+import subprocess
+from Queue import Queue
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fakes3 import FakeS3Server, _Object
+from s3 import S3Service, S3Object
+
+WORKLOADS = ('small', 'large', 'listing', 'delete')
+MB = 1024.0 * 1024.0
+
+
+def percentile(values, p):
+    """
+    p-th percentile (0 to 100) of a list of values, nearest rank.
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = int(round(p / 100.0 * (len(values) - 1)))
+    return values[rank]
+
+
+class Result(object):
+    """
+    Latencies and bytes of one benchmarked operation.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.bytes = 0
+        self.items = None
+        self.elapsed = 0.0
+
+    def summary(self):
+        n = len(self.latencies)
+        elapsed = self.elapsed or 1e-9
+        summary = {'ops': n,
+                   'seconds': round(self.elapsed, 4),
+                   'ops_per_sec': round(n / elapsed, 1),
+                   'p50_ms': None,
+                   'p99_ms': None,
+                   'mb_per_sec': round(self.bytes / MB / elapsed, 2)}
+        if self.latencies:
+            summary['p50_ms'] = round(percentile(self.latencies, 50) * 1000, 3)
+            summary['p99_ms'] = round(percentile(self.latencies, 99) * 1000, 3)
+        if self.items is not None:
+            summary['items_per_sec'] = round(self.items / elapsed, 1)
+        return summary
+
+
+def run_ops(name, func, items, workers):
+    """
+    Call func(item) for every item on workers threads, timing each call.
+    func returns the number of bytes it moved.
+    """
+    result = Result(name)
+    queue = Queue()
+    for item in items:
+        queue.put(item)
+    lock = threading.Lock()
+    errors = []
+
+    def work():
+        while True:
+            try:
+                item = queue.get_nowait()
+            except Exception:
+                return
+            started = time.time()
+            try:
+                size = func(item) or 0
+            except Exception, e:
+                errors.append(e)
+                return
+            latency = time.time() - started
+            lock.acquire()
+            try:
+                result.latencies.append(latency)
+                result.bytes += size
+            finally:
+                lock.release()
+
+    threads = [threading.Thread(target=work) for i in range(workers)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result.elapsed = time.time() - started
+    if errors:
+        raise errors[0]
+    return result
+
+
+def small_objects(bucket, options):
+    keys = ['small/%06d' % i for i in xrange(options.small_count)]
+    data = 'x' * options.small_size
+    def put(key):
+        bucket.save(S3Object(key, data, {'bench': 'small'}))
+        return len(data)
+    def get(key):
+        return len(bucket.get(key).data)
+    def head(key):
+        bucket.head(key)
+    results = [run_ops('small_put', put, keys, options.workers),
+               run_ops('small_get', get, keys, options.workers),
+               run_ops('small_head', head, keys, options.workers)]
+    # the same GETs pipelined, depth requests per round trip
+    pipelined = Result('small_get_pipelined')
+    started = time.time()
+    for i in xrange(0, len(keys), options.pipeline_depth):
+        batch_started = time.time()
+        with bucket.pipeline(depth=options.pipeline_depth) as p:
+            handles = [p.get(key) for key in keys[i:i + options.pipeline_depth]]
+        latency = (time.time() - batch_started) / len(handles)
+        for handle in handles:
+            pipelined.latencies.append(latency)
+            pipelined.bytes += len(handle.result().data)
+    pipelined.elapsed = time.time() - started
+    results.append(pipelined)
+    return results
+
+
+def large_objects(bucket, options):
+    keys = ['large/%03d' % i for i in xrange(options.large_count)]
+    data = os.urandom(options.large_size)
+    def put(key):
+        bucket.save(S3Object(key, data, {}))
+        return len(data)
+    def get(key):
+        obj = bucket.get(key, stream=True)
+        size = 0
+        for chunk in obj.data.iter_chunks():
+            size += len(chunk)
+        return size
+    results = [run_ops('large_put', put, keys, options.workers),
+               run_ops('large_get', get, keys, options.workers)]
+    fd, target = tempfile.mkstemp()
+    os.close(fd)
+    def download(key):
+        return bucket.download(key, target, part_size=max(1, options.large_size // 4),
+                               workers=4).transferred
+    try:
+        results.append(run_ops('large_download', download, keys, 1))
+    finally:
+        os.unlink(target)
+    return results
+
+
+def populate(server, bucket_name, prefix, count):
+    """
+    Put count empty objects straight into the fake server's store.
+    """
+    store = server.buckets[bucket_name]
+    now = time.time()
+    for i in xrange(count):
+        store.put('%s%07d' % (prefix, i), _Object('', {}, now))
+
+
+def listing(bucket, options, server):
+    populate(server, bucket.name, 'list/', options.list_count)
+    result = Result('list_page')
+    started = time.time()
+    pages = bucket._iterpages
+    page_started = [time.time()]
+    def list_page(prefix, marker, max_keys, delimiter):
+        page = bucket._list_entries_page(prefix, marker, max_keys, delimiter)
+        now = time.time()
+        result.latencies.append(now - page_started[0])
+        page_started[0] = now
+        return page
+    n = 0
+    for entry in pages(list_page, 'list/', None, options.page_size, None):
+        n += 1
+    result.elapsed = time.time() - started
+    result.items = n
+    return [result]
+
+
+def deletes(bucket, options, server):
+    populate(server, bucket.name, 'del/', options.delete_count)
+    keys = ['del/%07d' % i for i in xrange(0, options.delete_count, 2)]
+    single = run_ops('delete', bucket.delete, keys, options.workers)
+    # the rest as one bulk delete: throughput only, its calls overlap
+    bulk = Result('delete_prefix')
+    started = time.time()
+    n = 0
+    for key, error in bucket.delete_prefix('del/', page_size=options.page_size):
+        if error is not None:
+            raise error
+        n += 1
+    bulk.elapsed = time.time() - started
+    bulk.items = n
+    return [single, bulk]
+
+
+def git_revision():
+    try:
+        p = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return p.communicate()[0].strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--workloads', default=','.join(WORKLOADS),
+                      help='comma separated subset of %s' % ', '.join(WORKLOADS))
+    parser.add_option('--latency', type='float', default=0.0,
+                      help='seconds the server waits before each response; requests '
+                           'pipelined on one connection wait one after another')
+    parser.add_option('--bandwidth', type='int', default=0,
+                      help='bytes per second per connection, 0 for unlimited')
+    parser.add_option('--workers', type='int', default=8)
+    parser.add_option('--small-count', type='int', default=2000)
+    parser.add_option('--small-size', type='int', default=1024)
+    parser.add_option('--pipeline-depth', type='int', default=32)
+    parser.add_option('--large-count', type='int', default=8)
+    parser.add_option('--large-size', type='int', default=16 * 1024 * 1024)
+    parser.add_option('--list-count', type='int', default=20000)
+    parser.add_option('--delete-count', type='int', default=5000)
+    parser.add_option('--page-size', type='int', default=1000)
+    parser.add_option('--json', dest='json_path', help='write the report to this file')
+    options, args = parser.parse_args()
+
+    server = FakeS3Server(latency=options.latency, bandwidth=options.bandwidth or None)
+    server.start()
+    try:
+        service = S3Service('bench', 'bench', secure=False, host='127.0.0.1',
+                            port=server.port, pool_size=max(options.workers, 10))
+        bucket = service.create('bench-%d' % random.randint(0, 1 << 30))
+        results = []
+        for workload in options.workloads.split(','):
+            if workload == 'small':
+                results.extend(small_objects(bucket, options))
+            elif workload == 'large':
+                results.extend(large_objects(bucket, options))
+            elif workload == 'listing':
+                results.extend(listing(bucket, options, server))
+            elif workload == 'delete':
+                results.extend(deletes(bucket, options, server))
+            else:
+                parser.error('unknown workload %r' % workload)
+    finally:
+        server.stop()
+
+    report = {'revision': git_revision(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+              'python': sys.version.split()[0],
+              'options': dict((k, v) for k, v in vars(options).items() if k != 'json_path'),
+              'server': server.stats,
+              'results': dict((result.name, result.summary()) for result in results)}
+
+    print '%-22s %8s %10s %10s %10s %10s %10s' % ('operation', 'ops', 'ops/s', 'p50 ms',
+                                                  'p99 ms', 'MB/s', 'items/s')
+    for result in results:
+        s = result.summary()
+        print '%-22s %8d %10.1f %10s %10s %10.2f %10s' % (
+            result.name, s['ops'], s['ops_per_sec'], s['p50_ms'] or '-', s['p99_ms'] or '-',
+            s['mb_per_sec'], s.get('items_per_sec', '-'))
+    if options.json_path:
+        f = open(options.json_path, 'w')
+        try:
+            json.dump(report, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Request signing benchmark: the shared s3.signer.Signer against the
+per-request hmac.new/strftime/encodestring code it replaced.
+
+    python bench/signing.py [iterations]
+"""
+import os
+import sys
+import sha
+import hmac
+import time
+import base64
+import urllib
+from time import gmtime, strftime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from s3.connection import S3Connection
+from s3.generator import S3Generator
+from s3.signer import Signer, string_to_sign, http_date
+
+PUB_KEY = '0PN5J17HBGZHT7JJ3X82'
+PRIV_KEY = 'uV3F3YluFJax1cknvbcGwgjvx4QpvB+leU8dUj2o'
+
+
+def legacy_auth_header_value(method, path, headers):
+    xamzs = [k for k in headers.keys() if k.startswith("x-amz-")]
+    xamzs.sort()
+    auth_parts = [method,
+                  headers.get("Content-MD5", ""),
+                  headers.get("Content-Type", ""),
+                  headers.get("Date", ""),]
+    auth_parts.extend([k + ":" + headers[k].strip() for k in xamzs])
+    auth_parts.append(path)
+    auth_str = "\n".join(auth_parts)
+    auth_str = base64.encodestring(
+        hmac.new(PRIV_KEY, auth_str, sha).digest()).strip()
+    return "AWS %s:%s" % (PUB_KEY, auth_str)
+
+
+def legacy_headers(method, path):
+    headers = {'x-amz-meta-owner': 'bench'}
+    headers["Date"] = strftime("%a, %d %b %Y %H:%M:%S GMT", gmtime())
+    headers["Authorization"] = legacy_auth_header_value(method, path, headers)
+    return headers
+
+
+def timed(name, func, iterations):
+    started = time.time()
+    func(iterations)
+    elapsed = time.time() - started
+    print '%-32s %9.0f ops/s' % (name, iterations / elapsed)
+    return elapsed
+
+
+def main():
+    iterations = 100000
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+    path = '/bench-bucket/some/object/key.txt'
+    headers = {'Date': http_date(), 'x-amz-meta-owner': 'bench'}
+    assert legacy_auth_header_value('GET', path, headers) == \
+           Signer(PUB_KEY, PRIV_KEY).authorization('GET', path, headers)
+
+    conn = S3Connection(PUB_KEY, PRIV_KEY)
+    signer = Signer(PUB_KEY, PRIV_KEY)
+
+    def legacy_request(n):
+        for i in xrange(n):
+            legacy_headers('GET', path)
+
+    def request(n):
+        for i in xrange(n):
+            conn._headers('GET', path, headers={'x-amz-meta-owner': 'bench'})
+
+    def legacy_presign(n):
+        for i in xrange(n):
+            h = {'Date': str(1200000000 + i)}
+            urllib.quote_plus(legacy_auth_header_value('GET', path, h).split(':', 1)[1])
+
+    generator = S3Generator(PUB_KEY, PRIV_KEY)
+    def presign(n):
+        for i in xrange(n):
+            generator._auth_header_value('GET', path, {'Date': str(1200000000 + i)})
+
+    def presign_batch(n):
+        signer.sign_many([string_to_sign('GET', path, {'Date': str(1200000000 + i)})
+                          for i in xrange(n)])
+
+    keys = ['some/object/key%d.txt' % i for i in xrange(iterations)]
+    def presign_get(n):
+        for key in keys[:n]:
+            generator.get('bench-bucket', key)
+
+    many = S3Generator(PUB_KEY, PRIV_KEY)
+    def presign_many(n):
+        many.get_many('bench-bucket', keys[:n])
+
+    print 'iterations: %d' % iterations
+    base = timed('legacy request headers', legacy_request, iterations)
+    new = timed('S3Connection._headers', request, iterations)
+    print '%-32s %9.2fx' % ('speedup', base / new)
+    base = timed('legacy presign', legacy_presign, iterations)
+    new = timed('S3Generator signature', presign, iterations)
+    print '%-32s %9.2fx' % ('speedup', base / new)
+    new = timed('Signer.sign_many', presign_batch, iterations)
+    print '%-32s %9.2fx' % ('speedup', base / new)
+    base = timed('S3Generator.get', presign_get, iterations)
+    new = timed('S3Generator.get_many', presign_many, iterations)
+    print '%-32s %9.2fx' % ('speedup', base / new)
+
+
+if __name__ == '__main__':
+    main()
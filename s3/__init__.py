@@ -12,13 +12,19 @@ DEFAULT_HOST = "s3.amazonaws.com"
 #   + handle s3 object metadata
 #   + acl's
 #   + accept date types as input for "If-*-Since" headers
-#   + make some (tuple?) interface for "Range" headers
-#   + pipelining
 
 from connection import S3Connection
 from service import S3Service
 from objects import S3Bucket, S3Object
+from listing import S3ListEntry, S3Listing
+from index import S3BucketIndex
+from cache import S3BucketCache
+from pipeline import S3Pipeline
 from generator import S3Generator
+from aio import AsyncS3Service, AsyncS3Bucket
+from metrics import RequestMetrics, InMemoryMetrics
+from hedge import HedgePolicy
+from codec import CompressionPolicy, ZlibCodec, GzipCodec
 from errors import S3Error
 
 Service = S3Service
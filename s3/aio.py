@@ -0,0 +1,970 @@
+"""
+Non-blocking S3 client.
+
+Everything runs on a single EventLoop built on asyncore: requests go out
+over a pool of non-blocking HTTP/1.1 keep-alive connections and every
+operation returns a Future. Coroutines are generators that yield futures
+and are resumed with their results::
+
+    loop = EventLoop()
+    service = AsyncS3Service(pub_key, priv_key, loop=loop)
+
+    def copy(bucket, src, dst):
+        obj = yield bucket.get(src)
+        obj.key = dst
+        yield bucket.save(obj)
+
+    bucket = service.bucket('name')
+    loop.run_until_complete(gather(loop, [loop.spawn(copy(bucket, k, k + '.bak'))
+                                          for k in keys]))
+"""
+import sys
+import ssl
+import time
+import heapq
+import socket
+import asyncore
+import asynchat
+from collections import deque
+
+import s3
+from s3.connection import S3Connection, PORTS_BY_SECURITY
+from s3.objects import S3Object
+from s3.codec import CODECS, CODEC_META, SIZE_META, decode
+from s3.parsers import parseErrorResponse, parseListKeysPage, parseGetBucketNames
+from s3.pool import DEFAULT_IDLE_TIMEOUT
+
+DEFAULT_ASYNC_POOL_SIZE = 64
+BODY_BUFFER_LIMIT = 1024 * 1024
+SEND_CHUNK_SIZE = 64 * 1024
+
+
+class Return(Exception):
+    """
+    Raise Return(value) in a coroutine to make value its result.
+    """
+    def __init__(self, value=None):
+        Exception.__init__(self)
+        self.value = value
+
+
+class Future(object):
+    """
+    Result of an operation that has not necessarily finished yet.
+    """
+    def __init__(self, loop):
+        self._loop = loop
+        self._done = False
+        self._result = None
+        self._error = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        """
+        The result, or the exception the operation failed with re-raised.
+        """
+        if not self._done:
+            raise RuntimeError('Future is not done yet')
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
+    def exc_info(self):
+        return self._error
+
+    def add_done_callback(self, callback):
+        """
+        Call callback(future) on the loop once the future is done.
+        """
+        if self._done:
+            self._loop.call_soon(callback, self)
+        else:
+            self._callbacks.append(callback)
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exc_info):
+        """
+        @param exc_info: sys.exc_info() tuple, or an exception instance
+        """
+        if not isinstance(exc_info, tuple):
+            exc_info = (exc_info.__class__, exc_info, None)
+        self._finish(None, exc_info)
+
+    def _finish(self, result, error):
+        if self._done:
+            return
+        self._done = True
+        self._result = result
+        self._error = error
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._loop.call_soon(callback, self)
+
+
+class Task(Future):
+    """
+    Drives a generator coroutine: every future it yields is waited for and
+    its result (or exception) sent back into the generator.
+    """
+    def __init__(self, loop, coroutine):
+        Future.__init__(self, loop)
+        self._coroutine = coroutine
+        loop.call_soon(self._step, None, None)
+
+    def _step(self, value, error):
+        try:
+            if error is not None:
+                future = self._coroutine.throw(*error)
+            else:
+                future = self._coroutine.send(value)
+        except StopIteration:
+            self.set_result(None)
+        except Return, e:
+            self.set_result(e.value)
+        except:
+            self.set_exception(sys.exc_info())
+        else:
+            future.add_done_callback(self._wakeup)
+
+    def _wakeup(self, future):
+        self._step(future._result, future._error)
+
+
+def gather(loop, futures):
+    """
+    Future of the list of results of futures, failing with the first error.
+    """
+    futures = list(futures)
+    result = Future(loop)
+    results = [None] * len(futures)
+    remaining = [len(futures)]
+    if not futures:
+        result.set_result(results)
+    def done(i, future):
+        if future._error is not None:
+            result.set_exception(future._error)
+            return
+        results[i] = future._result
+        remaining[0] -= 1
+        if not remaining[0]:
+            result.set_result(results)
+    for i, future in enumerate(futures):
+        future.add_done_callback(lambda future, i=i: done(i, future))
+    return result
+
+
+class EventLoop(object):
+    """
+    asyncore based event loop with call_soon/call_later scheduling. Uses
+    poll() so it is not limited to FD_SETSIZE sockets.
+    """
+    def __init__(self):
+        self.map = {}
+        self._ready = deque()
+        self._timers = []
+        self._stopped = False
+
+    def call_soon(self, callback, *args):
+        self._ready.append((callback, args))
+
+    def call_later(self, delay, callback, *args):
+        heapq.heappush(self._timers, (self.time() + delay, callback, args))
+
+    def time(self):
+        return time.time()
+
+    def spawn(self, coroutine):
+        """
+        Start running a generator coroutine.
+
+        @return: Task, a Future of the coroutine's result
+        @rtype:  Task
+        """
+        return Task(self, coroutine)
+
+    def _run_once(self):
+        timeout = 1.0
+        if self._ready:
+            timeout = 0
+        elif self._timers:
+            timeout = max(0, min(timeout, self._timers[0][0] - self.time()))
+        if self.map:
+            asyncore.poll2(timeout, self.map)
+        elif timeout:
+            time.sleep(timeout)
+        now = self.time()
+        while self._timers and self._timers[0][0] <= now:
+            when, callback, args = heapq.heappop(self._timers)
+            self._ready.append((callback, args))
+        for i in xrange(len(self._ready)):
+            callback, args = self._ready.popleft()
+            callback(*args)
+
+    def run_until_complete(self, future):
+        """
+        Run the loop until future is done and return its result.
+        """
+        if not isinstance(future, Future):
+            future = self.spawn(future)
+        while not future.done():
+            self._run_once()
+        return future.result()
+
+    def run_forever(self):
+        self._stopped = False
+        while not self._stopped:
+            self._run_once()
+
+    def stop(self):
+        self._stopped = True
+
+
+class AsyncBody(object):
+    """
+    Streamed response body. read() returns a Future of the next chunk of
+    data, an empty string at the end of the body. At most BODY_BUFFER_LIMIT
+    bytes are buffered; the connection stops reading until they are consumed.
+    """
+    def __init__(self, loop, channel, length):
+        self._loop = loop
+        self._channel = channel
+        self.len = length
+        self._chunks = deque()
+        self._buffered = 0
+        self._finished = False
+        self._error = None
+        self._waiter = None
+
+    def read(self):
+        future = Future(self._loop)
+        if self._chunks:
+            data = self._chunks.popleft()
+            self._buffered -= len(data)
+            future.set_result(data)
+        elif self._error is not None:
+            future.set_exception(self._error)
+        elif self._finished:
+            future.set_result('')
+        else:
+            self._waiter = future
+        return future
+
+    def close(self):
+        """
+        Stop reading; an unfinished response's connection is not reused.
+        """
+        if not self._finished and self._channel is not None:
+            self._channel.abort()
+        self._finished = True
+        self._chunks.clear()
+
+    def _full(self):
+        return self._buffered >= BODY_BUFFER_LIMIT
+
+    def _feed(self, data):
+        waiter, self._waiter = self._waiter, None
+        if waiter is not None:
+            waiter.set_result(data)
+        else:
+            self._chunks.append(data)
+            self._buffered += len(data)
+
+    def _finish(self):
+        self._finished = True
+        self._channel = None
+        waiter, self._waiter = self._waiter, None
+        if waiter is not None:
+            waiter.set_result('')
+
+    def _fail(self, error):
+        self._error = error
+        self._channel = None
+        waiter, self._waiter = self._waiter, None
+        if waiter is not None:
+            waiter.set_exception(error)
+
+
+class AsyncDecodingBody(object):
+    """
+    Decompressing wrapper around an AsyncBody; read() returns a Future of
+    the next chunk of decompressed data, an empty string at the end.
+    """
+    def __init__(self, body, codec, length=None):
+        self._body = body
+        self._decompressor = codec.decompressor()
+        self.len = length
+        self._finished = False
+
+    def read(self):
+        future = Future(self._body._loop)
+        if self._finished:
+            future.set_result('')
+        else:
+            self._body.read().add_done_callback(lambda chunk: self._decompress(chunk, future))
+        return future
+
+    def _decompress(self, chunk, future):
+        if chunk._error is not None:
+            future.set_exception(chunk._error)
+            return
+        try:
+            if not chunk._result:
+                self._finished = True
+                future.set_result(self._decompressor.flush())
+                return
+            data = self._decompressor.decompress(chunk._result)
+        except:
+            future.set_exception(sys.exc_info())
+            return
+        if data:
+            future.set_result(data)
+        else:
+            # not a whole block yet
+            self._body.read().add_done_callback(lambda chunk: self._decompress(chunk, future))
+
+    def close(self):
+        self._finished = True
+        self._body.close()
+
+
+class AsyncResponse(object):
+    def __init__(self, status, reason, headers):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = None
+
+    def getheader(self, name, default=None):
+        name = name.lower()
+        for header, value in self.headers:
+            if header == name:
+                return value
+        return default
+
+    def getheaders(self):
+        return self.headers
+
+
+class _FileProducer(object):
+    def __init__(self, f):
+        self._f = f
+
+    def more(self):
+        return self._f.read(SEND_CHUNK_SIZE)
+
+
+class _HTTPChannel(asynchat.async_chat):
+    """
+    One non-blocking keep-alive connection, running one request at a time.
+    """
+    def __init__(self, pool, ready):
+        asynchat.async_chat.__init__(self, map=pool.loop.map)
+        self._pool = pool
+        self._ready = ready
+        self._handshaking = False
+        self._want_write = False
+        self._future = None
+        self.reused = False
+        self.idle_since = None
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connect((pool.host, pool.port))
+
+    def handle_connect(self):
+        if not self._pool.secure:
+            self._connected()
+            return
+        self.del_channel()
+        context = self._pool.ssl_context or ssl.create_default_context()
+        self.set_socket(context.wrap_socket(self.socket, server_hostname=self._pool.host,
+                                            do_handshake_on_connect=False))
+        self._handshaking = True
+        self._handshake()
+
+    def _handshake(self):
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLWantReadError:
+            self._want_write = False
+        except ssl.SSLWantWriteError:
+            self._want_write = True
+        else:
+            self._handshaking = False
+            self._connected()
+
+    def _connected(self):
+        ready, self._ready = self._ready, None
+        if ready is not None:
+            ready.set_result(self)
+
+    def readable(self):
+        if self._handshaking:
+            return True
+        body = self._response_body()
+        return body is None or not body._full()
+
+    def writable(self):
+        if self._handshaking:
+            return self._want_write
+        return asynchat.async_chat.writable(self)
+
+    def handle_read(self):
+        if self._handshaking:
+            self._handshake()
+        else:
+            asynchat.async_chat.handle_read(self)
+
+    def handle_write(self):
+        if self._handshaking:
+            self._handshake()
+        else:
+            asynchat.async_chat.handle_write(self)
+
+    def recv(self, buffer_size):
+        try:
+            data = self.socket.recv(buffer_size)
+            pending = getattr(self.socket, 'pending', None)
+            while pending is not None and pending():
+                data += self.socket.recv(buffer_size)
+        except ssl.SSLWantReadError:
+            return ''
+        except socket.error, e:
+            if e.args[0] in asyncore._DISCONNECTED:
+                self.handle_close()
+                return ''
+            raise
+        if not data:
+            self.handle_close()
+        return data
+
+    def send(self, data):
+        try:
+            return asynchat.async_chat.send(self, data)
+        except ssl.SSLWantWriteError:
+            return 0
+
+    def _response_body(self):
+        if self._future is None or self._response is None:
+            return None
+        return self._response.body if isinstance(self._response.body, AsyncBody) else None
+
+    def start(self, method, request, body, future, stream):
+        self._future = future
+        self._method = method
+        self._stream = stream
+        self._response = None
+        self._chunks = []
+        self._will_close = False
+        self._state = 'head'
+        self.set_terminator('\r\n\r\n')
+        self.push(request)
+        if body is not None:
+            if isinstance(body, str):
+                self.push(body)
+            else:
+                self.push_with_producer(_FileProducer(body))
+
+    def collect_incoming_data(self, data):
+        if self._state in ('body', 'chunk', 'close'):
+            body = self._response.body
+            if isinstance(body, AsyncBody):
+                body._feed(data)
+            else:
+                body.append(data)
+        else:
+            self._chunks.append(data)
+
+    def found_terminator(self):
+        line = ''.join(self._chunks)
+        self._chunks = []
+        state = self._state
+        if state == 'head':
+            self._parse_head(line)
+        elif state == 'chunk-size':
+            size = int(line.split(';', 1)[0].strip() or '0', 16)
+            if size:
+                self._state = 'chunk'
+                self.set_terminator(size)
+            else:
+                self._state = 'trailer'
+                self.set_terminator('\r\n')
+        elif state == 'chunk':
+            self._state = 'chunk-end'
+            self.set_terminator('\r\n')
+        elif state == 'chunk-end':
+            self._state = 'chunk-size'
+        elif state == 'trailer':
+            if not line:
+                self._complete()
+        elif state == 'body':
+            self._complete()
+
+    def _parse_head(self, head):
+        lines = head.split('\r\n')
+        version, status, reason = (lines[0].split(None, 2) + [''])[:3]
+        status = int(status)
+        if 100 <= status < 200:
+            return
+        headers = []
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers.append((name.strip().lower(), value.strip()))
+        response = self._response = AsyncResponse(status, reason, headers)
+        connection = (response.getheader('connection') or '').lower()
+        self._will_close = connection == 'close' or \
+                           (version == 'HTTP/1.0' and connection != 'keep-alive')
+        length = response.getheader('content-length')
+        if length is not None:
+            length = int(length)
+        ok = 200 <= status < 300
+        if self._stream and ok:
+            response.body = AsyncBody(self._pool.loop, self, length)
+            self._future.set_result(response)
+        else:
+            response.body = []
+        if self._method == 'HEAD' or status in (204, 304):
+            self._complete()
+        elif (response.getheader('transfer-encoding') or '').lower() == 'chunked':
+            self._state = 'chunk-size'
+            self.set_terminator('\r\n')
+        elif length is not None:
+            if length:
+                self._state = 'body'
+                self.set_terminator(length)
+            else:
+                self._complete()
+        else:
+            self._state = 'close'
+            self._will_close = True
+            self.set_terminator(None)
+
+    def _complete(self):
+        response, future = self._response, self._future
+        self._future = None
+        self._state = 'idle'
+        if self._will_close:
+            self._pool.discard(self)
+        else:
+            self._pool.release(self)
+        if isinstance(response.body, AsyncBody):
+            response.body._finish()
+        else:
+            response.body = ''.join(response.body)
+            future.set_result(response)
+
+    def abort(self):
+        self._future = None
+        self._pool.discard(self)
+
+    def handle_close(self):
+        future, self._future = self._future, None
+        if self._state == 'close' and future is not None:
+            self._future = future
+            self._will_close = True
+            self._complete()
+            return
+        self._pool.discard(self)
+        error = socket.error(32, 'Connection closed by server')
+        self._fail(future, error)
+
+    def handle_error(self):
+        future, self._future = self._future, None
+        error = sys.exc_info()
+        self._pool.discard(self)
+        self._fail(future, error)
+
+    def _fail(self, future, error):
+        ready, self._ready = self._ready, None
+        if ready is not None:
+            ready.set_exception(error)
+        if future is None:
+            return
+        body = self._response is not None and self._response.body
+        if isinstance(body, AsyncBody):
+            body._fail(error)
+        else:
+            future.set_exception(error)
+
+
+class AsyncConnectionPool(object):
+    """
+    Bounded pool of non-blocking keep-alive connections to one endpoint.
+    Requests beyond size wait for a connection to be released.
+    """
+    def __init__(self, loop, host, port, secure=True, size=DEFAULT_ASYNC_POOL_SIZE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, ssl_context=None):
+        self.loop = loop
+        self.host = host
+        self.port = port
+        self.secure = secure
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.ssl_context = ssl_context
+        self.created = 0
+        self.reused = 0
+        self._count = 0
+        self._idle = []
+        self._waiters = deque()
+
+    def acquire(self):
+        """
+        @return: Future of a connected channel
+        @rtype:  Future
+        """
+        now = self.loop.time()
+        while self._idle:
+            channel = self._idle.pop()
+            if self.idle_timeout is not None and now - channel.idle_since > self.idle_timeout:
+                self.discard(channel)
+                continue
+            future = Future(self.loop)
+            channel.reused = True
+            self.reused += 1
+            future.set_result(channel)
+            return future
+        future = Future(self.loop)
+        if self._count < self.size:
+            self._open(future)
+        else:
+            self._waiters.append(future)
+        return future
+
+    def _open(self, future):
+        self._count += 1
+        self.created += 1
+        _HTTPChannel(self, future)
+
+    def release(self, channel):
+        if self._waiters:
+            channel.reused = True
+            self.reused += 1
+            self._waiters.popleft().set_result(channel)
+        else:
+            channel.idle_since = self.loop.time()
+            self._idle.append(channel)
+
+    def discard(self, channel):
+        if channel in self._idle:
+            self._idle.remove(channel)
+        if channel.socket is not None:
+            self._count -= 1
+            channel.close()
+            channel.socket = None
+        if self._waiters and self._count < self.size:
+            self._open(self._waiters.popleft())
+
+    def close(self):
+        for channel in list(self._idle):
+            self.discard(channel)
+
+
+class AsyncS3Connection(object):
+    """
+    Signs requests with S3Connection's code and sends them through an
+    AsyncConnectionPool.
+    """
+    def __init__(self, pub_key, priv_key, loop, secure=True, host=s3.DEFAULT_HOST, port=None,
+                 pool_size=DEFAULT_ASYNC_POOL_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 ssl_context=None):
+        if not port:
+            port = PORTS_BY_SECURITY[secure]
+        self.loop = loop
+        self._signing = S3Connection(pub_key, priv_key, secure=secure, host=host, port=port)
+        self._pool = AsyncConnectionPool(loop, host, port, secure, size=pool_size,
+                                         idle_timeout=idle_timeout, ssl_context=ssl_context)
+        self._host_header = host
+        if port != PORTS_BY_SECURITY[secure]:
+            self._host_header = '%s:%d' % (host, port)
+
+    def request(self, method, bucket=None, obj=None, body=None, params=None, headers=None,
+                stream=False):
+        """
+        Send a signed request.
+
+        @return: Future of an AsyncResponse; with stream set its body is an
+                 AsyncBody, otherwise a string. Error statuses fail the
+                 future with an S3Error.
+        @rtype:  Future
+        """
+        signing = self._signing
+        path = signing._path(bucket, obj)
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        length = None
+        if isinstance(headers, dict) and headers.has_key("Content-Length"):
+            length = headers["Content-Length"]
+        elif isinstance(body, str):
+            length = len(body)
+        elif body is not None:
+            length = signing._io_len(body)
+        headers = signing._headers(method, path, length=length, headers=headers)
+        lines = ['%s %s HTTP/1.1' % (method, path + signing._params(params)),
+                 'Host: %s' % self._host_header]
+        for k, v in headers.items():
+            lines.append('%s: %s' % (k, v))
+        request = '\r\n'.join(lines) + '\r\n\r\n'
+        result = Future(self.loop)
+        self._send(result, method, request, body, stream, True)
+        return result
+
+    def _send(self, result, method, request, body, stream, may_retry):
+        def connected(acquired):
+            if acquired._error is not None:
+                result.set_exception(acquired._error)
+                return
+            channel = acquired._result
+            reused = channel.reused
+            response = Future(self.loop)
+            response.add_done_callback(lambda f: done(f, reused))
+            channel.start(method, request, body, response, stream)
+        def done(response, reused):
+            error = response._error
+            if error is not None:
+                # the server may close a kept-alive connection just as we
+                # reuse it; try once more on a new one if we can replay
+                if may_retry and reused and isinstance(error[1], socket.error) and \
+                   (body is None or isinstance(body, str)):
+                    self._send(result, method, request, body, stream, False)
+                else:
+                    result.set_exception(error)
+                return
+            response = response._result
+            if response.status < 200 or response.status > 299:
+                try:
+                    result.set_exception(parseErrorResponse(response.status, response.reason,
+                                                                response.body))
+                except:
+                    result.set_exception(sys.exc_info())
+            else:
+                result.set_result(response)
+        self._pool.acquire().add_done_callback(connected)
+
+
+def _then(loop, future, func):
+    result = Future(loop)
+    def done(future):
+        if future._error is not None:
+            result.set_exception(future._error)
+            return
+        try:
+            result.set_result(func(future._result))
+        except:
+            result.set_exception(sys.exc_info())
+    future.add_done_callback(done)
+    return result
+
+
+class AsyncKeyIterator(object):
+    """
+    Asynchronous paginated key iterator. next() returns a Future of the next
+    key, or of None once the listing is exhausted. The following page is
+    requested as soon as a page arrives.
+    """
+    def __init__(self, bucket, prefix=None, delimiter=None, page_size=None, marker=None):
+        self._bucket = bucket
+        self._args = (prefix, delimiter, page_size)
+        self._keys = deque()
+        self._page = bucket._list_page(prefix, marker, page_size, delimiter)
+
+    def next(self):
+        loop = self._bucket.loop
+        if self._keys:
+            future = Future(loop)
+            future.set_result(self._keys.popleft())
+            return future
+        if self._page is None:
+            future = Future(loop)
+            future.set_result(None)
+            return future
+        page, self._page = self._page, None
+        result = Future(loop)
+        def fetched(future):
+            if future._error is not None:
+                result.set_exception(future._error)
+                return
+            keys, truncated, marker = future._result
+            prefix, delimiter, page_size = self._args
+            if truncated and marker:
+                self._page = self._bucket._list_page(prefix, marker, page_size, delimiter)
+            self._keys.extend(keys)
+            self.next().add_done_callback(lambda f: result._finish(f._result, f._error))
+        page.add_done_callback(fetched)
+        return result
+
+
+class AsyncS3Bucket(object):
+    """
+    Non-blocking counterpart of S3Bucket. Every method returns a Future.
+    """
+    def __init__(self, name, connection):
+        self.name = name
+        self._conn = connection
+        self.loop = connection.loop
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return self.name
+
+    def _request(self, method, obj=None, body=None, params=None, headers=None, stream=False):
+        return self._conn.request(method, self.name, obj, body=body, params=params,
+                                  headers=headers, stream=stream)
+
+    def get(self, key, headers=None, stream=False, byte_range=None):
+        """
+        Get an S3Object. With stream set its data is an AsyncBody.
+        Compressed objects are decompressed, except for ranged gets.
+
+        @return: Future of the S3Object
+        @rtype:  Future
+        """
+        if headers is None:
+            headers = {}
+        if byte_range is not None:
+            first, last = byte_range
+            if last is None:
+                headers['Range'] = 'bytes=%d-' % first
+            else:
+                headers['Range'] = 'bytes=%d-%d' % (first, last)
+        def made(response):
+            metadata = {}
+            for name, value in response.headers:
+                if name.startswith('x-amz-meta-'):
+                    metadata[name[11:]] = value
+            data = response.body
+            codec = CODECS.get(metadata.get(CODEC_META))
+            if codec is not None and byte_range is None:
+                size = metadata.pop(SIZE_META, None)
+                del metadata[CODEC_META]
+                if stream:
+                    data = AsyncDecodingBody(data, codec, size and int(size))
+                else:
+                    data = decode(codec, data)
+            return S3Object(key, data, metadata,
+                            response.getheader('last-modified', ''), None)
+        return _then(self.loop, self._request('GET', key, headers=headers, stream=stream), made)
+
+    def head(self, key, headers=None):
+        """
+        @return: Future of the dictionary of the object's headers
+        @rtype:  Future
+        """
+        return _then(self.loop, self._request('HEAD', key, headers=headers),
+                     lambda response: dict(response.headers))
+
+    def save(self, s3object, headers=None):
+        """
+        Save an S3Object; its data may be a string or a file-like object.
+
+        @return: Future of the object's ETag
+        @rtype:  Future
+        """
+        if headers is None:
+            headers = {}
+        for key in s3object.metadata:
+            headers['x-amz-meta-' + key] = s3object.metadata[key]
+        return _then(self.loop, self._request('PUT', s3object.key, body=s3object.data,
+                                              headers=headers),
+                     lambda response: response.getheader('etag'))
+
+    def delete(self, key):
+        """
+        Delete an object by key (or S3Object).
+
+        @return: Future of None
+        @rtype:  Future
+        """
+        key = getattr(key, 'key', key)
+        return _then(self.loop, self._request('DELETE', key), lambda response: None)
+
+    def _list_page(self, prefix=None, marker=None, max_keys=None, delimiter=None):
+        params = {}
+        if prefix: params['prefix'] = prefix
+        if marker: params['marker'] = marker
+        if max_keys: params['max-keys'] = max_keys
+        if delimiter: params['delimiter'] = delimiter
+        return _then(self.loop, self._request('GET', params=params),
+                     lambda response: parseListKeysPage(response.body))
+
+    def keys(self, prefix=None, marker=None, max_keys=None, delimiter=None):
+        """
+        One page of keys, as S3Bucket.keys.
+
+        @return: Future of the list of keys
+        @rtype:  Future
+        """
+        return _then(self.loop, self._list_page(prefix, marker, max_keys, delimiter),
+                     lambda page: page[0])
+
+    def iterkeys(self, prefix=None, delimiter=None, page_size=None, marker=None):
+        """
+        All keys, following the listing across pages.
+
+        @rtype: AsyncKeyIterator
+        """
+        return AsyncKeyIterator(self, prefix, delimiter, page_size, marker)
+
+
+class AsyncS3Service(object):
+    """
+    Non-blocking counterpart of S3Service.
+    """
+    def __init__(self, pub_key, priv_key, loop=None, secure=True, host=s3.DEFAULT_HOST,
+                 port=None, pool_size=DEFAULT_ASYNC_POOL_SIZE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, ssl_context=None):
+        if loop is None:
+            loop = EventLoop()
+        self.loop = loop
+        self._conn = AsyncS3Connection(pub_key, priv_key, loop, secure=secure, host=host,
+                                       port=port, pool_size=pool_size,
+                                       idle_timeout=idle_timeout, ssl_context=ssl_context)
+
+    def bucket(self, name):
+        """
+        Bucket handle, without checking that the bucket exists.
+        """
+        return AsyncS3Bucket(name, self._conn)
+
+    def keys(self):
+        """
+        @return: Future of the list of bucket names
+        @rtype:  Future
+        """
+        return _then(self.loop, self._conn.request('GET'),
+                     lambda response: parseGetBucketNames(response.body))
+
+    def list(self):
+        """
+        @return: Future of the list of AsyncS3Buckets
+        @rtype:  Future
+        """
+        return _then(self.loop, self.keys(), lambda names: [self.bucket(n) for n in names])
+
+    def get(self, name, default=None):
+        """
+        @return: Future of the bucket, or default if it does not exist
+        @rtype:  Future
+        """
+        return _then(self.loop, self.keys(),
+                     lambda names: name in names and self.bucket(name) or default)
+
+    def create(self, name):
+        """
+        @return: Future of the new AsyncS3Bucket
+        @rtype:  Future
+        """
+        return _then(self.loop, self._conn.request('PUT', name), lambda r: self.bucket(name))
+
+    def delete(self, name):
+        """
+        @return: Future of None
+        @rtype:  Future
+        """
+        return _then(self.loop, self._conn.request('DELETE', name), lambda r: None)
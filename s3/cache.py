@@ -0,0 +1,333 @@
+import os
+import time
+import hashlib
+import cPickle
+import threading
+from collections import OrderedDict
+
+from s3.errors import S3Error
+from s3.objects import S3Object
+
+DEFAULT_MEMORY_BYTES = 64 * 1024 * 1024
+DEFAULT_DISK_BYTES = 1024 * 1024 * 1024
+
+
+class _Entry(object):
+    __slots__ = ('key', 'etag', 'last_modified', 'metadata', 'data', 'validated')
+
+    def __init__(self, key, etag, last_modified, metadata, data, validated):
+        self.key = key
+        self.etag = etag
+        self.last_modified = last_modified
+        self.metadata = metadata
+        self.data = data
+        self.validated = validated
+
+
+class S3BucketCache(object):
+    """
+    Read-through cache of the objects of a bucket, in memory and optionally
+    on disk.
+
+    Attaching a cache makes the bucket's plain get(key) calls (no extra
+    headers, no range, not streamed) go through it. Objects are kept in a
+    memory tier of memory_bytes and, if a directory is given, a disk tier of
+    disk_bytes; both evict the least recently used objects first, and objects
+    evicted from memory move to disk. A cached object is revalidated with
+    If-None-Match/If-Modified-Since, so an unchanged object costs a 304
+    without a body. With max_staleness set, objects validated less than that
+    many seconds ago are returned without asking S3 at all.
+
+    Saves and deletes made through the bucket invalidate the cached copy.
+    """
+
+    def __init__(self, bucket, memory_bytes=DEFAULT_MEMORY_BYTES, directory=None,
+                 disk_bytes=DEFAULT_DISK_BYTES, max_staleness=None):
+        """
+        @param bucket:        Bucket to cache
+        @type  bucket:        S3Bucket
+        @param memory_bytes:  Byte budget of the memory tier
+        @type  memory_bytes:  int
+        @param directory:     Directory of the disk tier, None for memory only
+        @type  directory:     string
+        @param disk_bytes:    Byte budget of the disk tier
+        @type  disk_bytes:    int
+        @param max_staleness: Seconds a validated object is served without
+                              revalidation, None to always revalidate
+        @type  max_staleness: float
+        """
+        self._bucket = bucket
+        self.memory_bytes = memory_bytes
+        self.directory = directory
+        self.disk_bytes = disk_bytes
+        self.max_staleness = max_staleness
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.refreshed = 0
+        self.evictions = 0
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._disk = OrderedDict()
+        self._disk_used = 0
+        self._lock = threading.RLock()
+        if directory is not None:
+            self._scan()
+        bucket.cache = self
+
+    def __len__(self):
+        return len(self._memory) + len(self._disk)
+
+    def detach(self):
+        """
+        Stop caching the bucket's objects.
+        """
+        if self._bucket.cache is self:
+            self._bucket.cache = None
+
+    def stats(self):
+        """
+        Cache counters: hits (memory and disk), disk_hits, misses, revalidated
+        (answered with a 304), refreshed (changed since cached) and evictions,
+        plus the bytes used by each tier.
+
+        @rtype: dict
+        """
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'revalidated': self.revalidated, 'refreshed': self.refreshed,
+                'evictions': self.evictions, 'memory_bytes': self._memory_used,
+                'disk_bytes': self._disk_used}
+
+    def get(self, key):
+        """
+        Get an object, from the cache if the cached copy is current.
+
+        @param key: Key of the object
+        @type  key: string
+        @return:    The object
+        @rtype:     S3Object
+        """
+        entry = self._lookup(key)
+        now = time.time()
+        if entry is not None and self.max_staleness is not None and \
+           now - entry.validated <= self.max_staleness:
+            self._count('hits')
+            return self._object(entry)
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        try:
+            response = self._bucket._request('GET', key, headers=headers)
+        except S3Error, e:
+            if entry is None or e.code != 'NotModified':
+                raise
+            entry.validated = now
+            self._touch(entry)
+            self._count('hits')
+            self._count('revalidated')
+            return self._object(entry)
+        obj = self._bucket._object(key, response, response.read())
+        if entry is None:
+            self._count('misses')
+        else:
+            self._count('refreshed')
+        self.put(obj, response.getheader('etag'), now)
+        return obj
+
+    def put(self, obj, etag, validated=None):
+        """
+        Cache an object as read from S3.
+
+        @param obj:       Object, with string data
+        @type  obj:       S3Object
+        @param etag:      Its ETag header, quotes included
+        @type  etag:      string
+        @param validated: When it was read, defaults to now
+        @type  validated: float
+        """
+        if validated is None:
+            validated = time.time()
+        entry = _Entry(obj.key, etag, obj.last_modified, dict(obj.metadata), obj.data, validated)
+        self.invalidate(obj.key)
+        if len(entry.data) <= self.memory_bytes:
+            self._lock.acquire()
+            try:
+                self._memory[entry.key] = entry
+                self._memory_used += len(entry.data)
+                self._shrink_memory()
+            finally:
+                self._lock.release()
+        else:
+            self._write(entry)
+
+    def invalidate(self, key):
+        """
+        Drop the cached copy of an object.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._memory.pop(key, None)
+            if entry is not None:
+                self._memory_used -= len(entry.data)
+            if self.directory is not None:
+                name = self._name(key)
+                size = self._disk.pop(name, None)
+                if size is not None:
+                    self._disk_used -= size
+                    self._unlink(name)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """
+        Drop every cached object, from memory and disk.
+        """
+        self._lock.acquire()
+        try:
+            self._memory.clear()
+            self._memory_used = 0
+            for name in self._disk:
+                self._unlink(name)
+            self._disk.clear()
+            self._disk_used = 0
+        finally:
+            self._lock.release()
+
+    def _count(self, counter):
+        self._lock.acquire()
+        try:
+            setattr(self, counter, getattr(self, counter) + 1)
+        finally:
+            self._lock.release()
+
+    def _object(self, entry):
+        return S3Object(entry.key, entry.data, dict(entry.metadata), entry.last_modified,
+                        self._bucket)
+
+    def _lookup(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._memory.pop(key, None)
+            if entry is not None:
+                self._memory[key] = entry
+                return entry
+            if self.directory is None:
+                return None
+            name = self._name(key)
+            if name not in self._disk:
+                return None
+            entry = self._read(name)
+            if entry is None or entry.key != key:
+                return None
+            self.disk_hits += 1
+            if len(entry.data) <= self.memory_bytes:
+                # promote to memory; the disk copy goes
+                self._disk_used -= self._disk.pop(name)
+                self._unlink(name)
+                self._memory[key] = entry
+                self._memory_used += len(entry.data)
+                self._shrink_memory()
+            else:
+                self._disk[name] = self._disk.pop(name)
+            return entry
+        finally:
+            self._lock.release()
+
+    def _touch(self, entry):
+        # a revalidated disk entry is rewritten for its new validation time
+        self._lock.acquire()
+        try:
+            in_memory = entry.key in self._memory
+        finally:
+            self._lock.release()
+        if not in_memory and self.directory is not None:
+            self._write(entry)
+
+    def _shrink_memory(self):
+        while self._memory_used > self.memory_bytes:
+            key, entry = self._memory.popitem(last=False)
+            self._memory_used -= len(entry.data)
+            self.evictions += 1
+            if self.directory is not None:
+                self._write(entry)
+
+    def _name(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return hashlib.sha1(key).hexdigest()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _unlink(self, name):
+        try:
+            os.unlink(self._path(name))
+        except OSError:
+            pass
+
+    def _scan(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        files = []
+        for name in os.listdir(self.directory):
+            if len(name) != 40:
+                continue
+            st = os.stat(self._path(name))
+            files.append((st.st_mtime, name, st.st_size))
+        files.sort()
+        for mtime, name, size in files:
+            self._disk[name] = size
+            self._disk_used += size
+        self._shrink_disk()
+
+    def _shrink_disk(self):
+        while self._disk_used > self.disk_bytes:
+            name, size = self._disk.popitem(last=False)
+            self._disk_used -= size
+            self.evictions += 1
+            self._unlink(name)
+
+    def _write(self, entry):
+        if self.directory is None or len(entry.data) > self.disk_bytes:
+            return
+        name = self._name(entry.key)
+        path = self._path(name)
+        tmp = '%s.%d.%d' % (path, os.getpid(), threading.currentThread().ident or 0)
+        f = open(tmp, 'wb')
+        try:
+            cPickle.dump((entry.key, entry.etag, entry.last_modified, entry.metadata,
+                          entry.validated), f, 2)
+            f.write(entry.data)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+        size = os.path.getsize(path)
+        self._lock.acquire()
+        try:
+            old = self._disk.pop(name, None)
+            if old is not None:
+                self._disk_used -= old
+            self._disk[name] = size
+            self._disk_used += size
+            self._shrink_disk()
+        finally:
+            self._lock.release()
+
+    def _read(self, name):
+        try:
+            f = open(self._path(name), 'rb')
+        except IOError:
+            size = self._disk.pop(name, None)
+            if size is not None:
+                self._disk_used -= size
+            return None
+        try:
+            key, etag, last_modified, metadata, validated = cPickle.load(f)
+            data = f.read()
+        finally:
+            f.close()
+        return _Entry(key, etag, last_modified, metadata, data, validated)
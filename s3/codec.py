@@ -0,0 +1,388 @@
+import sys
+import zlib
+import base64
+import fnmatch
+import hashlib
+import tempfile
+import threading
+from Queue import Queue
+from collections import deque
+
+# object metadata marking an object stored compressed, and its original size
+CODEC_META = 'content-codec'
+SIZE_META = 'uncompressed-size'
+
+DEFAULT_MIN_SIZE = 1024
+DEFAULT_SPOOL_SIZE = 8 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+QUEUE_DEPTH = 8
+
+
+class Codec(object):
+    """
+    Interface of a content codec, only described here: any object with
+    these attributes can be registered. ZlibCodec is the one to subclass
+    for other zlib based formats.
+
+    name is used as the Content-Encoding of stored objects. compressor()
+    and decompressor() return new objects with the interface of zlib's
+    compression and decompression objects: compress(data) or
+    decompress(data), and flush().
+    """
+
+
+class ZlibCodec(object):
+    """
+    zlib format, HTTP's 'deflate' content encoding.
+    """
+    name = 'deflate'
+    wbits = zlib.MAX_WBITS
+
+    def __init__(self, level=6):
+        """
+        @param level: Compression level, 1 (fastest) to 9 (smallest)
+        @type  level: int
+        """
+        self.level = level
+
+    def compressor(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, self.wbits)
+
+    def decompressor(self):
+        return zlib.decompressobj(self.wbits)
+
+
+class GzipCodec(ZlibCodec):
+    """
+    gzip format.
+    """
+    name = 'gzip'
+    wbits = zlib.MAX_WBITS | 16
+
+
+CODECS = {}
+
+
+def register(codec):
+    """
+    Make objects stored with codec readable; zlib and gzip are registered.
+
+    @param codec: Codec to register under its name
+    @type  codec: Codec
+    """
+    CODECS[codec.name] = codec
+
+
+register(ZlibCodec())
+register(GzipCodec())
+
+GZIP = CODECS['gzip']
+
+DEFAULT_CONTENT_TYPES = {'text/*': GZIP,
+                         'application/json': GZIP,
+                         'application/x-ndjson': GZIP,
+                         'application/xml': GZIP,
+                         'application/javascript': GZIP}
+
+
+class CompressionPolicy(object):
+    """
+    Which objects S3Bucket.save compresses, and how.
+
+    Attach it as C{bucket.compression}. An object is compressed with the
+    codec its Content-Type maps to (an exact type before the longest
+    matching wildcard pattern, parameters such as charset ignored), or the
+    default codec for unmatched types, if it is at least min_size bytes.
+    The compressed body is spooled in memory up to spool_size bytes, then
+    in a temporary file.
+    """
+
+    def __init__(self, content_types=None, default=None, min_size=DEFAULT_MIN_SIZE,
+                 spool_size=DEFAULT_SPOOL_SIZE):
+        """
+        @param content_types: Content type or fnmatch pattern to Codec, or to
+                              None to never compress; DEFAULT_CONTENT_TYPES
+                              if not given
+        @type  content_types: dict
+        @param default:       Codec for other content types, None for none
+        @type  default:       Codec
+        @param min_size:      Smaller objects are stored as they are
+        @type  min_size:      int
+        @param spool_size:    Bytes of compressed data kept in memory
+        @type  spool_size:    int
+        """
+        if content_types is None:
+            content_types = DEFAULT_CONTENT_TYPES
+        self.content_types = dict(content_types)
+        self.default = default
+        self.min_size = min_size
+        self.spool_size = spool_size
+
+    def codec_for(self, content_type, size):
+        """
+        @param content_type: Content-Type of the object, None if not set
+        @type  content_type: string
+        @param size:         Size of the object, None if unknown
+        @type  size:         int
+        @return:             Codec to store the object with, or None
+        @rtype:              Codec
+        """
+        if size is not None and size < self.min_size:
+            return None
+        content_type = (content_type or 'binary/octet-stream').split(';')[0].strip().lower()
+        if content_type in self.content_types:
+            return self.content_types[content_type]
+        patterns = sorted(self.content_types, key=len, reverse=True)
+        for pattern in patterns:
+            if fnmatch.fnmatchcase(content_type, pattern):
+                return self.content_types[pattern]
+        return self.default
+
+
+class CompressedBody(object):
+    """
+    Compressed request body, spooled so its length and MD5 are known
+    before it is sent.
+    """
+    def __init__(self, spool, length, md5):
+        self._spool = spool
+        self.len = length
+        self.md5 = md5
+
+    def read(self, n=-1):
+        return self._spool.read(n)
+
+    def tell(self):
+        return self._spool.tell()
+
+    def seek(self, pos, whence=0):
+        self._spool.seek(pos, whence)
+
+    def close(self):
+        self._spool.close()
+
+
+def encode(codec, source, spool_size=DEFAULT_SPOOL_SIZE):
+    """
+    Compress a file-like object.
+
+    The source is read in this thread and compressed in a worker thread;
+    zlib releases the GIL, so reading (from a socket or disk) and
+    compressing overlap. S3 needs the length of the body up front, so the
+    output is spooled rather than sent as it is produced.
+
+    @param codec:      Codec to compress with
+    @type  codec:      Codec
+    @param source:     Data to compress, read to the end
+    @type  source:     file
+    @param spool_size: Bytes of output kept in memory before spilling to disk
+    @type  spool_size: int
+    @return:           Compressed body; close it when done
+    @rtype:            CompressedBody
+    """
+    spool = tempfile.SpooledTemporaryFile(spool_size)
+    digest = hashlib.md5()
+    queue = Queue(QUEUE_DEPTH)
+    error = []
+
+    def write(data):
+        if data:
+            spool.write(data)
+            digest.update(data)
+
+    def compress():
+        compressor = codec.compressor()
+        while True:
+            chunk = queue.get()
+            if chunk is None:
+                break
+            if error:
+                continue
+            try:
+                write(compressor.compress(chunk))
+            except:
+                error.append(sys.exc_info())
+        if not error:
+            try:
+                write(compressor.flush())
+            except:
+                error.append(sys.exc_info())
+
+    worker = threading.Thread(target=compress)
+    worker.setDaemon(True)
+    worker.start()
+    try:
+        try:
+            chunk = source.read(CHUNK_SIZE)
+            while chunk:
+                queue.put(chunk)
+                chunk = source.read(CHUNK_SIZE)
+        finally:
+            queue.put(None)
+            worker.join()
+    except:
+        spool.close()
+        raise
+    if error:
+        spool.close()
+        raise error[0][0], error[0][1], error[0][2]
+    length = spool.tell()
+    spool.seek(0)
+    return CompressedBody(spool, length, base64.b64encode(digest.digest()))
+
+
+def decode(codec, data):
+    """
+    Decompress a string.
+    """
+    decompressor = codec.decompressor()
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+class DecodingBody(object):
+    """
+    Decompressing wrapper around a streamed body.
+
+    A worker thread reads the compressed body and decompresses it up to
+    QUEUE_DEPTH chunks ahead of the reader, so socket reads and
+    decompression overlap with whatever the reader does with the data.
+    """
+    def __init__(self, body, codec, length=None):
+        """
+        @param body:   Compressed body, closed when this one is
+        @type  body:   S3StreamingBody
+        @param codec:  Codec the body was compressed with
+        @type  codec:  Codec
+        @param length: Decompressed size, if known
+        @type  length: int
+        """
+        self._body = body
+        self._codec = codec
+        self.len = length
+        self.chunk_size = body.chunk_size
+        # decompressed chunks not read yet; _offset bytes of the first one are
+        self._chunks = deque()
+        self._offset = 0
+        self._buffered = 0
+        self._pos = 0
+        self._done = False
+        self._closed = False
+        self._queue = Queue(QUEUE_DEPTH)
+        self._worker = threading.Thread(target=self._decompress)
+        self._worker.setDaemon(True)
+        self._worker.start()
+
+    def __iter__(self):
+        return self.iter_chunks()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _getClosed(self):
+        return self._closed
+
+    closed = property(_getClosed)
+
+    def _decompress(self):
+        try:
+            decompressor = self._codec.decompressor()
+            chunk = self._body.read(CHUNK_SIZE)
+            while chunk and not self._closed:
+                data = decompressor.decompress(chunk)
+                if data:
+                    self._queue.put((data, None))
+                chunk = self._body.read(CHUNK_SIZE)
+            if not self._closed:
+                self._queue.put((decompressor.flush(), None))
+            self._queue.put((None, None))
+        except:
+            self._queue.put((None, sys.exc_info()))
+
+    def _fill(self, n):
+        while not self._done and (n is None or self._buffered < n):
+            data, error = self._queue.get()
+            if error is not None:
+                self._done = True
+                self.close()
+                raise error[0], error[1], error[2]
+            if data is None:
+                self._done = True
+            else:
+                self._chunks.append(data)
+                self._buffered += len(data)
+
+    def read(self, n=None):
+        """
+        Read at most n decompressed bytes, or everything left if n is omitted.
+
+        @param n: Number of bytes to read
+        @type  n: int
+        @return:  Data read, empty string at the end of the body
+        @rtype:   string
+        """
+        if self._closed:
+            return ''
+        if n is not None and n < 0:
+            n = None
+        self._fill(n)
+        if n is None:
+            n = self._buffered
+        parts = []
+        while n and self._chunks:
+            chunk = self._chunks[0]
+            if self._offset == 0 and len(chunk) <= n:
+                part = chunk
+            else:
+                part = chunk[self._offset:self._offset + n]
+            parts.append(part)
+            n -= len(part)
+            self._offset += len(part)
+            if self._offset == len(chunk):
+                self._chunks.popleft()
+                self._offset = 0
+        data = ''.join(parts)
+        self._buffered -= len(data)
+        self._pos += len(data)
+        if self._done and not self._buffered:
+            self._closed = True
+        return data
+
+    def readinto(self, buf):
+        view = memoryview(buf)
+        data = self.read(len(view))
+        n = len(data)
+        view[:n] = data
+        return n
+
+    def iter_chunks(self, chunk_size=None):
+        """
+        Iterate over the decompressed body in chunks of at most chunk_size bytes.
+        """
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        data = self.read(chunk_size)
+        while data:
+            yield data
+            data = self.read(chunk_size)
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        """
+        Stop reading; an unfinished response's connection is not reused.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        # unblock the worker if it is waiting on a full queue
+        while self._worker.isAlive():
+            while not self._queue.empty():
+                self._queue.get()
+            self._worker.join(0.01)
+        self._chunks.clear()
+        self._buffered = 0
+        self._body.close()
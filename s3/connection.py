@@ -1,20 +1,35 @@
-import base64
-import hmac
+import sys
+import time
+import select
 import httplib
-import sha
 import socket
 import urllib
-from time import gmtime, strftime
 
 import s3
-from s3.parsers import parseError
+from s3.parsers import parseErrorResponse
+from s3.signer import Signer, http_date
+from s3.pool import ConnectionPool, PooledResponse, DEFAULT_POOL_SIZE, DEFAULT_IDLE_TIMEOUT, \
+     unanswered
 
 PORTS_BY_SECURITY = { True: 443, False: 80 }
 
 class S3Connection(object):
-    def __init__(self, pub_key, priv_key, secure=True, host=s3.DEFAULT_HOST, port=None, debug=0):
+    """
+    S3 Connection class.
+
+    Requests are sent over keep-alive connections borrowed from a
+    ConnectionPool, so a single S3Connection (and its clones, which share
+    the pool) can be used from many threads at once.
+
+    Given a RequestMetrics object, every request is reported to it. Given a
+    HedgePolicy, slow read requests are hedged as it describes.
+    """
+    def __init__(self, pub_key, priv_key, secure=True, host=s3.DEFAULT_HOST, port=None, debug=0,
+                 pool=None, pool_size=DEFAULT_POOL_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 metrics=None, hedge=None):
         self._pub_key = pub_key
         self._priv_key = priv_key
+        self._signer = Signer(pub_key, priv_key)
         self._host = host
         if not port:
             self._port = PORTS_BY_SECURITY[secure]
@@ -22,41 +37,33 @@ class S3Connection(object):
             self._port = port
         self._secure = secure
 
-        if (secure):
-            self._conn = httplib.HTTPSConnection("%s:%d" % (self._host, self._port))
-        else:
-            self._conn = httplib.HTTPConnection("%s:%d" % (self._host, self._port))
+        if pool is None:
+            pool = ConnectionPool(self._host, self._port, secure,
+                                  size=pool_size, idle_timeout=idle_timeout)
+        self._pool = pool
+        self._metrics = metrics
+        self._hedge = hedge
         self._set_debug(debug)
 
     def _set_debug(self, debug):
         self._debug = debug
-        self._conn.set_debuglevel(debug)
+        self._pool.set_debuglevel(debug)
 
 
     def clone(self):
-        """C.clone() -> new connection to s3"""
-        return S3Connection(self._pub_key, self._priv_key, secure=self._secure, host=self._host, port=self._port, debug=self._debug)
+        """C.clone() -> new connection to s3 sharing this connection's pool"""
+        return S3Connection(self._pub_key, self._priv_key, secure=self._secure, host=self._host,
+                            port=self._port, debug=self._debug, pool=self._pool,
+                            metrics=self._metrics, hedge=self._hedge)
 
 
     def _auth_header_value(self, method, path, headers):
-        xamzs = [k for k in headers.keys() if k.startswith("x-amz-")]
-        xamzs.sort()
-        auth_parts = [method,
-                      headers.get("Content-MD5", ""),
-                      headers.get("Content-Type", ""),
-                      headers.get("Date", ""),]
-        auth_parts.extend([k + ":" + headers[k].strip() for k in xamzs])
-        # hmmm fali mi ona perverzija za ?acl i ?torrent
-        auth_parts.append(path)
-        auth_str = "\n".join(auth_parts)
-        auth_str = base64.encodestring(
-            hmac.new(self._priv_key, auth_str, sha).digest()).strip()
-        return "AWS %s:%s" % (self._pub_key, auth_str)
+        return self._signer.authorization(method, path, headers)
 
     def _headers(self, method, path, length=None, headers=None):
         if not headers:
             headers = {}
-        headers["Date"] = strftime("%a, %d %b %Y %H:%M:%S GMT", gmtime())
+        headers["Date"] = http_date()
         if length is not None:
             headers["Content-Length"] = length
         headers["Authorization"] = self._auth_header_value(method, path, headers)
@@ -95,38 +102,176 @@ class S3Connection(object):
             elif send_io is not None:
                 length = self._io_len(send_io)
             headers = self._headers(method, path, length=length, headers=headers)
-            
-            def do_c():
-                self._conn.putrequest(method, path + self._params(params))
-                for k,v in headers.items():
-                    self._conn.putheader(k, v)
-                self._conn.endheaders()
-
-            retry = False
-            try:
-                do_c()
-            except socket.error, e:
-                 # if broken pipe (timed out/server closed connection)
-                 # open new connection and try again
-                if e[0] == 32:
-                    retry = True
-            if retry:
-                do_c()
-                
-            if send_io is not None:
-                data = send_io.read(httplib.MAXAMOUNT)
-                while len(data) > 0:
-                    self._conn.send(data)
-                    data = send_io.read(httplib.MAXAMOUNT)
-                send_io.read() # seems to be needed to finish the response
+            url = path + self._params(params)
+            start = None
+            if send_io is not None and hasattr(send_io, "seek"):
+                start = send_io.tell()
+
+            hedge = self._hedge
+            if hedge is not None and send_io is None:
+                operation = method
+                if obj is None and method == 'GET':
+                    operation = 'LIST'
+                if operation in hedge.operations:
+                    r, conn = self._hedged(hedge, operation, method, url, headers)
+                    return self._response(r, conn, method, path)
+
+            metrics = self._metrics
+            if metrics is not None:
+                started = time.time()
+            conn = self._pool.acquire()
+            reused = conn.sock is not None
+            if metrics is not None:
+                metrics.connection('s3', reused)
             try:
-                r = self._conn.getresponse()
-            except httplib.ResponseNotReady, e:
-                e.args += ('You are probably overlapping S3 ops, like doing f = bucket.get(k); bucket.keys(); f.read(). Try using bucket.clone() such as f = bucket.clone().get(k)',)
-                raise e
-            if r.status < 200 or r.status > 299:
-                raise parseError(r.read())
-            if not method == "GET":
-                r.read()
-            return r
+                # a kept-alive socket can be closed by the server between the
+                # staleness check and our request; retry once on a fresh
+                # socket if writing failed, or if the server hung up without
+                # answering a request that is safe to repeat
+                replayable = send_io is None or start is not None
+                try:
+                    self._request(conn, method, url, headers, send_io)
+                except (socket.error, httplib.HTTPException):
+                    if not reused or not replayable:
+                        raise
+                    self._retry(conn, method, url, headers, send_io, start)
+                    reused = False
+                try:
+                    r = conn.getresponse()
+                except httplib.HTTPException, e:
+                    if not reused or not replayable or not unanswered(method, e):
+                        raise
+                    self._retry(conn, method, url, headers, send_io, start)
+                    r = conn.getresponse()
+            except:
+                self._pool.discard(conn)
+                if metrics is not None:
+                    metrics.request('s3', method, None, time.time() - started,
+                                    int(length or 0), 0)
+                raise
+            if metrics is not None:
+                metrics.request('s3', method, r.status, time.time() - started, int(length or 0),
+                                int(r.getheader('content-length') or 0))
+            return self._response(r, conn, method, path)
         return f
+
+    def _response(self, r, conn, method, path):
+        r = PooledResponse(r, conn, self._pool)
+        if r.status < 200 or r.status > 299:
+            raise parseErrorResponse(r.status, r.reason, r.read(), path)
+        if not method == "GET":
+            r.read()
+        return r
+
+    def _retry(self, conn, method, url, headers, send_io, start):
+        # send the request again on a fresh socket
+        conn.close()
+        if send_io is not None:
+            send_io.seek(start)
+        if self._metrics is not None:
+            self._metrics.retry('s3', method)
+            self._metrics.connection('s3', False)
+        self._request(conn, method, url, headers, send_io)
+
+    def _put(self, conn, method, url, headers):
+        # send a bodiless request, retrying once on a fresh socket if a
+        # kept-alive one turns out to be closed
+        reused = conn.sock is not None
+        if self._metrics is not None:
+            self._metrics.connection('s3', reused)
+        try:
+            self._request(conn, method, url, headers, None)
+        except (socket.error, httplib.HTTPException):
+            if not reused:
+                raise
+            self._retry(conn, method, url, headers, None, None)
+            reused = False
+        return reused
+
+    def _hedged(self, hedge, operation, method, url, headers):
+        """
+        Send a read request, and a duplicate on another connection if no
+        response has arrived after the policy's delay. Returns the first
+        response and its connection; the other connection is closed.
+        """
+        metrics = self._metrics
+        started = time.time()
+        deadline = started + hedge._begin(operation)
+        primary = self._pool.acquire()
+        try:
+            reused = {primary: self._put(primary, method, url, headers)}
+        except:
+            self._pool.discard(primary)
+            if metrics is not None:
+                metrics.request('s3', method, None, time.time() - started, 0, 0)
+            raise
+        pending = [primary]
+        waiting = True
+        error = None
+        try:
+            while pending:
+                timeout = None
+                if waiting:
+                    timeout = max(0, deadline - time.time())
+                readable = select.select([conn.sock for conn in pending], [], [], timeout)[0]
+                if not readable:
+                    waiting = False
+                    if hedge._fire():
+                        conn = self._pool.acquire()
+                        try:
+                            reused[conn] = self._put(conn, method, url, headers)
+                        except (socket.error, httplib.HTTPException):
+                            self._pool.discard(conn)
+                        else:
+                            pending.append(conn)
+                    continue
+                conn = [conn for conn in pending if conn.sock in readable][0]
+                pending.remove(conn)
+                try:
+                    r = conn.getresponse()
+                except (socket.error, httplib.HTTPException), e:
+                    if error is None:
+                        error = sys.exc_info()
+                    if reused[conn] and not pending and unanswered(method, e):
+                        # the server closed a kept-alive socket
+                        conn.close()
+                        reused[conn] = False
+                        if metrics is not None:
+                            metrics.retry('s3', method)
+                        try:
+                            self._put(conn, method, url, headers)
+                        except (socket.error, httplib.HTTPException):
+                            self._pool.discard(conn)
+                            raise
+                        pending.append(conn)
+                    else:
+                        self._pool.discard(conn)
+                    continue
+                seconds = time.time() - started
+                hedge._done(operation, seconds, conn is not primary)
+                if metrics is not None:
+                    metrics.request('s3', method, r.status, seconds, 0,
+                                    int(r.getheader('content-length') or 0))
+                return r, conn
+        finally:
+            # cancel the slower request by closing its connection
+            for conn in pending:
+                self._pool.discard(conn)
+        if metrics is not None:
+            metrics.request('s3', method, None, time.time() - started, 0, 0)
+        raise error[0], error[1], error[2]
+
+    def _request(self, conn, method, url, headers, send_io):
+        conn.putrequest(method, url)
+        for k,v in headers.items():
+            conn.putheader(k, v)
+        conn.endheaders()
+        if hasattr(send_io, "iter_buffers"):
+            for data in send_io.iter_buffers():
+                conn.send(data)
+        elif send_io is not None:
+            data = send_io.read(httplib.MAXAMOUNT)
+            while len(data) > 0:
+                conn.send(data)
+                data = send_io.read(httplib.MAXAMOUNT)
+            send_io.read() # seems to be needed to finish the response
@@ -1,14 +1,13 @@
 import s3
-import re
-import sha
-import hmac
 import time
-import base64
 import urllib
 
+from s3.signer import Signer, string_to_sign
+
 PORTS_BY_SECURITY = { True: 443, False: 80 }
 
 DEFAULT_EXPIRES_IN = 60
+MEMO_SIZE = 100000
 
 class S3Generator(object):
     """
@@ -21,6 +20,7 @@ class S3Generator(object):
     def __init__(self, pub_key, priv_key, secure=True, host=s3.DEFAULT_HOST, port=None):
         self._pub_key = pub_key
         self._priv_key = priv_key
+        self._signer = Signer(pub_key, priv_key)
         self._host = host
         if not port:
             self._port = PORTS_BY_SECURITY[secure]
@@ -34,6 +34,9 @@ class S3Generator(object):
         self.server_name = "%s:%d" % (self._host, self._port)
         self._expires_in = DEFAULT_EXPIRES_IN
         self._expires = None
+        self._expiry_window = None
+        self._memo = {}
+        self._memo_expires = None
 
     def set_expires_in(self, expires_in):
         """
@@ -55,6 +58,43 @@ class S3Generator(object):
         self._expires = expires
         self._expires_in = None
 
+    def set_expiry_window(self, window):
+        """
+        Round relative expiration times up to a multiple of window seconds.
+        
+        All URLs generated within the same window then share their Expires
+        time, so the same request always gets the same URL and can be
+        cached by browsers and CDNs. URLs stay valid for at least the
+        expires_in time and at most window seconds longer. Signed URLs are
+        memoized for the current window.
+        
+        @param window: Window length in seconds, None to disable
+        @type  window: int
+        """
+        self._expiry_window = window
+        self._memo = {}
+        self._memo_expires = None
+
+    def _expires_at(self):
+        if self._expires_in != None:
+            expires = int(time.time() + self._expires_in)
+            window = self._expiry_window
+            if window:
+                expires = -(-expires // window) * window
+            return expires
+        elif self._expires != None:
+            return int(self._expires)
+        return 0
+
+    def _memoized(self, expires):
+        # URLs are only reproducible with a fixed or windowed expiry
+        if self._expires_in != None and not self._expiry_window:
+            return None
+        if self._memo_expires != expires or len(self._memo) >= MEMO_SIZE:
+            self._memo = {}
+            self._memo_expires = expires
+        return self._memo
+
 
     def make_bare_url(self, bucket, key=''):
         """
@@ -64,26 +104,7 @@ class S3Generator(object):
 
 
     def _auth_header_value(self, method, path, headers):
-        xamzs = [k for k in headers.keys() if k.startswith("x-amz-")]
-        xamzs.sort()
-        auth_parts = [method,
-                      headers.get("Content-MD5", ""),
-                      headers.get("Content-Type", ""),
-                      headers.get("Date", ""),]
-        auth_parts.extend([k + ":" + headers[k].strip() for k in xamzs])
-        
-        # Don't include anything after the first ?, unless there is an acl or torrent parameter
-        stripped_path = path.split('?')[0]
-        if re.search("[&?]acl($|=|&)", path):
-            stripped_path += "?acl"
-        elif re.search("[&?]torrent($|=|&)", path):
-            stripped_path += "?torrent"
-
-        auth_parts.append(stripped_path)
-        auth_str = "\n".join(auth_parts)
-        auth_str = base64.encodestring(
-            hmac.new(self._priv_key, auth_str, sha).digest()).strip()
-        return urllib.quote_plus(auth_str)
+        return urllib.quote_plus(self._signer.sign(string_to_sign(method, path, headers)))
 
 
     def _headers(self, headers=None, length=None, expires=None):
@@ -130,11 +151,14 @@ class S3Generator(object):
 
     def _generate(self, method, bucket=None, key=None,
                   send_io=None, params=None, headers=None, acl=False):
-        expires = 0
-        if self._expires_in != None:
-            expires = int(time.time() + self._expires_in)
-        elif self._expires != None:
-            expires = int(self._expires)
+        expires = self._expires_at()
+        memo = None
+        if not headers and not params and send_io is None:
+            memo = self._memoized(expires)
+            if memo is not None:
+                url = memo.get((method, bucket, key, acl))
+                if url is not None:
+                    return url
 
         path = self._path(bucket, key, acl)
         length = None
@@ -151,7 +175,60 @@ class S3Generator(object):
             arg_div = '?'
         query_part = "Signature=%s&Expires=%d&AWSAccessKeyId=%s" % (signature, expires, self._pub_key)
 
-        return self.protocol + '://' + self.server_name + path + arg_div + query_part
+        url = self.protocol + '://' + self.server_name + path + arg_div + query_part
+        if memo is not None:
+            memo[(method, bucket, key, acl)] = url
+        return url
+
+
+    def get_many(self, bucket, keys, method='GET', headers=None):
+        """
+        Authenticated URLs for many objects of a bucket at once.
+        
+        The expiration time, the canonical string up to the path and the URL
+        prefix are computed once for the whole batch, and the signatures
+        with Signer.sign_many. With an expiry window set, URLs already
+        generated in the current window are reused.
+        
+        @param bucket:  Bucket's name
+        @type  bucket:  string
+        @param keys:    Object keys
+        @type  keys:    iterable
+        @param method:  HTTP method the URLs are for
+        @type  method:  string
+        @param headers: Additional headers, the same for every URL
+        @type  headers: dict
+        @return:        Authenticated URLs, in the order of keys
+        @rtype:         list
+        """
+        expires = self._expires_at()
+        memo = None
+        if not headers:
+            memo = self._memoized(expires)
+        headers = self._headers(headers=dict(headers or {}), expires=expires)
+        head = string_to_sign(method, '', headers)
+        base = self.protocol + '://' + self.server_name
+        tail = "&Expires=%d&AWSAccessKeyId=%s" % (expires, self._pub_key)
+        urls = []
+        paths = []
+        missing = []
+        for key in keys:
+            url = None
+            if memo is not None:
+                url = memo.get((method, bucket, key, False))
+            if url is None:
+                path = self._path(bucket, key)
+                paths.append(path)
+                missing.append((len(urls), key))
+            urls.append(url)
+        signatures = self._signer.sign_many([head + path for path in paths])
+        quote_plus = urllib.quote_plus
+        for (i, key), path, signature in zip(missing, paths, signatures):
+            url = base + path + '?Signature=' + quote_plus(signature) + tail
+            urls[i] = url
+            if memo is not None:
+                memo[(method, bucket, key, False)] = url
+        return urls
 
 
     def create_bucket(self, name, headers=None):
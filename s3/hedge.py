@@ -0,0 +1,137 @@
+import threading
+from collections import deque
+
+DEFAULT_OPERATIONS = ('GET', 'HEAD')
+MIN_SAMPLES = 20
+RECOMPUTE_EVERY = 32
+
+
+class _Latencies(object):
+    def __init__(self, window):
+        self.samples = deque(maxlen=window)
+        self.delay = None
+        self.pending = 0
+
+
+class HedgePolicy(object):
+    """
+    Hedging of idempotent read requests.
+
+    An S3Connection given a policy sends a duplicate of a GET or HEAD
+    request on a second pooled connection when the first has not received
+    the response headers within a delay, uses whichever response comes
+    first and closes the other connection.
+
+    The delay is the given percentile of the recent latencies of the
+    operation ('GET', 'HEAD', or 'LIST' for bucket listings), kept between
+    min_delay and max_delay; until MIN_SAMPLES latencies are known it is
+    max_delay. At most max_ratio of the requests are hedged, with bursts of
+    up to burst hedges.
+
+    The counters requests, hedged, won (the hedge answered first) and
+    suppressed (a hedge was due but the rate cap refused it) are public
+    attributes.
+    """
+
+    def __init__(self, percentile=95, min_delay=0.01, max_delay=1.0, max_ratio=0.05,
+                 burst=10, window=1000, operations=DEFAULT_OPERATIONS):
+        """
+        @param percentile: Latency percentile after which a hedge is sent
+        @type  percentile: float
+        @param min_delay:  Lower bound of the delay in seconds
+        @type  min_delay:  float
+        @param max_delay:  Upper bound of the delay in seconds
+        @type  max_delay:  float
+        @param max_ratio:  Largest fraction of requests that is hedged
+        @type  max_ratio:  float
+        @param burst:      Number of hedges that can be sent in a row
+        @type  burst:      int
+        @param window:     Number of recent latencies kept per operation
+        @type  window:     int
+        @param operations: Operations that are hedged, of 'GET', 'HEAD' and
+                           'LIST'
+        @type  operations: tuple
+        """
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_ratio = max_ratio
+        self.burst = burst
+        self.window = window
+        self.operations = frozenset(operations)
+        self.requests = 0
+        self.hedged = 0
+        self.won = 0
+        self.suppressed = 0
+        self._latencies = {}
+        self._budget = float(burst)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<HedgePolicy requests=%d hedged=%d won=%d suppressed=%d>' % (
+            self.requests, self.hedged, self.won, self.suppressed)
+
+    def stats(self):
+        """
+        @return: Counters and the current delay of each operation
+        @rtype:  dict
+        """
+        self._lock.acquire()
+        try:
+            return {'requests': self.requests,
+                    'hedged': self.hedged,
+                    'won': self.won,
+                    'suppressed': self.suppressed,
+                    'delays': dict((operation, self._delay(latencies))
+                                   for operation, latencies in self._latencies.items())}
+        finally:
+            self._lock.release()
+
+    def _delay(self, latencies):
+        if latencies.delay is None:
+            return self.max_delay
+        return min(self.max_delay, max(self.min_delay, latencies.delay))
+
+    def _begin(self, operation):
+        # a new request: earn some hedge budget and return the delay
+        self._lock.acquire()
+        try:
+            self.requests += 1
+            self._budget = min(self.burst, self._budget + self.max_ratio)
+            latencies = self._latencies.get(operation)
+            if latencies is None:
+                return self.max_delay
+            return self._delay(latencies)
+        finally:
+            self._lock.release()
+
+    def _fire(self):
+        self._lock.acquire()
+        try:
+            if self._budget < 1:
+                self.suppressed += 1
+                return False
+            self._budget -= 1
+            self.hedged += 1
+            return True
+        finally:
+            self._lock.release()
+
+    def _done(self, operation, seconds, won):
+        self._lock.acquire()
+        try:
+            if won:
+                self.won += 1
+            latencies = self._latencies.get(operation)
+            if latencies is None:
+                latencies = self._latencies[operation] = _Latencies(self.window)
+            latencies.samples.append(seconds)
+            latencies.pending += 1
+            if len(latencies.samples) >= MIN_SAMPLES and (latencies.delay is None or
+                                                          latencies.pending >= RECOMPUTE_EVERY):
+                samples = sorted(latencies.samples)
+                rank = int(round(self.percentile / 100.0 * (len(samples) - 1)))
+                latencies.delay = samples[rank]
+                latencies.pending = 0
+        finally:
+            self._lock.release()
@@ -0,0 +1,406 @@
+import os
+import mmap
+import time
+import bisect
+import struct
+import threading
+
+from s3.listing import S3ListEntry, S3Listing
+
+INDEX_MAGIC = 'S3IX'
+INDEX_VERSION = 1
+_HEADER = struct.Struct('<4sHdI')
+# overlay size, at least, at which it is merged back into the base listing
+COMPACT_MIN = 4096
+
+
+def _prefix_end(prefix):
+    """
+    Smallest string that sorts after every string starting with prefix.
+    """
+    while prefix:
+        last = ord(prefix[-1])
+        if isinstance(prefix, unicode):
+            if last < 0xffff:
+                return prefix[:-1] + unichr(last + 1)
+        elif last < 0xff:
+            return prefix[:-1] + chr(last + 1)
+        prefix = prefix[:-1]
+    return None
+
+
+class S3BucketIndex(object):
+    """
+    Sorted index of the objects in a bucket.
+
+    The index is built from a full listing (or loaded from a snapshot) and
+    kept current from the saves and deletes made through the bucket it is
+    attached to. has_key, prefix scans and delimiter rollups are answered
+    locally with binary searches. resync_step() relists one page at a time
+    from a moving marker, so changes made by other clients are picked up
+    incrementally; start() does that periodically on a background thread.
+
+    The objects are kept in a read-only S3Listing, memory mapped when the
+    index was loaded from a snapshot, and changes in a small overlay of
+    added or replaced entries and removed keys. The overlay is merged into
+    a new listing once it grows past an eighth of the listing (and at least
+    COMPACT_MIN entries).
+
+    Attaching an index makes the bucket's has_key() use it.
+    """
+
+    def __init__(self, bucket, page_size=None, build=True):
+        """
+        @param bucket:    Bucket to index
+        @type  bucket:    S3Bucket
+        @param page_size: Number of keys per listing request
+        @type  page_size: int
+        @param build:     List the bucket right away
+        @type  build:     bool
+        """
+        self._bucket = bucket
+        self.page_size = page_size
+        self.resync_marker = None
+        self.synced = None
+        self._lock = threading.RLock()
+        self._map = None
+        self._set_base(S3Listing())
+        self._stop = None
+        bucket.index = self
+        if build:
+            self.build()
+
+    def __len__(self):
+        return len(self._base) - len(self._removed) - len(self._replaced) + len(self._added)
+
+    def __contains__(self, key):
+        return self.has_key(key)
+
+    def _set_base(self, listing, map=None):
+        # called with the lock held (or before the index is shared)
+        if self._map is not None:
+            self._map.close()
+        self._base = listing
+        self._map = map
+        self._added = {}        # key -> entry added, or replacing one in the base
+        self._added_keys = []   # sorted keys of _added
+        self._replaced = set()  # keys of _added that are in the base too
+        self._removed = set()   # keys of the base that were removed
+
+    def _in_base(self, key):
+        keys = self._base.keys
+        i = bisect.bisect_left(keys, key)
+        return i < len(keys) and keys[i] == key
+
+    def _compact(self):
+        # called with the lock held
+        changes = len(self._added) + len(self._removed)
+        if changes >= max(COMPACT_MIN, len(self._base) // 8):
+            self._set_base(S3Listing([entry for key, entry in self._scan('', None)]))
+
+    def detach(self):
+        """
+        Stop updating the index from the bucket.
+        """
+        self.stop()
+        if self._bucket.index is self:
+            self._bucket.index = None
+
+    def build(self):
+        """
+        Rebuild the index from a full listing of the bucket.
+        """
+        listing = S3Listing(self._bucket.iterentries(page_size=self.page_size))
+        self._lock.acquire()
+        try:
+            self._set_base(listing)
+            self.resync_marker = None
+            self.synced = time.time()
+        finally:
+            self._lock.release()
+
+    def resync_step(self):
+        """
+        Relist one page after resync_marker and reconcile that key range.
+
+        @return: True once the end of the bucket was reached and the marker
+                 wrapped back to the beginning
+        @rtype:  bool
+        """
+        start = self.resync_marker
+        entries, truncated, marker = self._bucket._list_entries_page(None, start, self.page_size)
+        self._lock.acquire()
+        try:
+            if truncated and marker:
+                end = marker
+                self.resync_marker = marker
+            else:
+                end = None
+                self.resync_marker = None
+                self.synced = time.time()
+            listed = dict([(entry.key, entry) for entry in entries])
+            indexed = []
+            for key, entry in self._scan('', None, start):
+                if end is not None and key > end:
+                    break
+                indexed.append((key, entry))
+            for key, entry in indexed:
+                if key not in listed:
+                    self._remove(key)
+            indexed = dict(indexed)
+            for entry in entries:
+                old = indexed.get(entry.key)
+                if old is None or (old.size, old.etag, old.last_modified) != \
+                        (entry.size, entry.etag, entry.last_modified):
+                    self._add(entry)
+            self._compact()
+        finally:
+            self._lock.release()
+        return self.resync_marker is None
+
+    def start(self, interval):
+        """
+        Run resync_step() every interval seconds on a daemon thread.
+
+        @param interval: Seconds between two listing requests
+        @type  interval: float
+        """
+        self.stop()
+        stop = self._stop = threading.Event()
+        def run():
+            while not stop.isSet():
+                stop.wait(interval)
+                if not stop.isSet():
+                    try:
+                        self.resync_step()
+                    except Exception:
+                        pass
+        thread = threading.Thread(target=run)
+        thread.setDaemon(True)
+        thread.start()
+
+    def stop(self):
+        """
+        Stop the periodic resync.
+        """
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+
+    def add(self, entry):
+        """
+        Insert or replace an entry.
+
+        @param entry: Listing record for the object
+        @type  entry: S3ListEntry
+        """
+        self._lock.acquire()
+        try:
+            self._add(entry)
+            self._compact()
+        finally:
+            self._lock.release()
+
+    def _add(self, entry):
+        key = entry.key
+        if key not in self._added:
+            bisect.insort(self._added_keys, key)
+            if key in self._removed:
+                self._removed.discard(key)
+                self._replaced.add(key)
+            elif self._in_base(key):
+                self._replaced.add(key)
+        self._added[key] = entry
+
+    def remove(self, key):
+        """
+        Remove a key, if it is in the index.
+
+        @param key: Object key
+        @type  key: string
+        """
+        self._lock.acquire()
+        try:
+            self._remove(key)
+            self._compact()
+        finally:
+            self._lock.release()
+
+    def _remove(self, key):
+        if key in self._added:
+            del self._added[key]
+            del self._added_keys[bisect.bisect_left(self._added_keys, key)]
+            if key in self._replaced:
+                self._replaced.discard(key)
+                self._removed.add(key)
+        elif key not in self._removed and self._in_base(key):
+            self._removed.add(key)
+
+    def has_key(self, key):
+        """
+        Is the key in the index.
+        """
+        return self.get(key) is not None
+
+    def get(self, key):
+        """
+        Listing record of an object.
+
+        @param key: Object key
+        @type  key: string
+        @return:    The entry, or None if the key is not indexed
+        @rtype:     S3ListEntry
+        """
+        self._lock.acquire()
+        try:
+            entry = self._added.get(key)
+            if entry is not None or key in self._removed:
+                return entry
+            return self._base.find(key)
+        finally:
+            self._lock.release()
+
+    def _scan(self, prefix, delimiter, after=None):
+        # merge the base listing, less removed and replaced keys, with the
+        # added keys; with after, start past that key
+        base = self._base
+        keys = base.keys
+        added = self._added_keys
+        if after is not None and after >= prefix:
+            i = bisect.bisect_right(keys, after)
+            j = bisect.bisect_right(added, after)
+        else:
+            i = bisect.bisect_left(keys, prefix)
+            j = bisect.bisect_left(added, prefix)
+        n = len(keys)
+        m = len(added)
+        while True:
+            base_key = None
+            while i < n:
+                base_key = keys[i]
+                if base_key not in self._removed and base_key not in self._added:
+                    break
+                base_key = None
+                i += 1
+            added_key = None
+            if j < m:
+                added_key = added[j]
+            if base_key is None and added_key is None:
+                return
+            if added_key is None or (base_key is not None and base_key < added_key):
+                key = base_key
+            else:
+                key = added_key
+            if not key.startswith(prefix):
+                return
+            if delimiter:
+                pos = key.find(delimiter, len(prefix))
+                if pos >= 0:
+                    common = key[:pos + len(delimiter)]
+                    yield common, None
+                    end = _prefix_end(common)
+                    if end is None:
+                        return
+                    i = bisect.bisect_left(keys, end, i)
+                    j = bisect.bisect_left(added, end, j)
+                    continue
+            if key is base_key:
+                yield key, base[i]
+                i += 1
+            else:
+                yield key, self._added[key]
+                j += 1
+
+    def keys(self, prefix='', delimiter=None):
+        """
+        Keys under prefix, in order, with the same delimiter rollup as a
+        bucket listing.
+
+        @param prefix:    Only keys which begin with prefix
+        @type  prefix:    string
+        @param delimiter: Roll up keys into common prefixes
+        @type  delimiter: string
+        @return:          Keys and common prefixes
+        @rtype:           list
+        """
+        self._lock.acquire()
+        try:
+            return [key for key, entry in self._scan(prefix, delimiter)]
+        finally:
+            self._lock.release()
+
+    def entries(self, prefix='', delimiter=None):
+        """
+        Like keys, but returns S3ListEntry records.
+        """
+        self._lock.acquire()
+        try:
+            return [entry or S3ListEntry(key) for key, entry in self._scan(prefix, delimiter)]
+        finally:
+            self._lock.release()
+
+    def save(self, path):
+        """
+        Write a compact snapshot of the index to a file. It is written to a
+        temporary file that then replaces path, so an index mapping path
+        keeps reading the old one.
+
+        @param path: File name
+        @type  path: string
+        """
+        self._lock.acquire()
+        try:
+            if self._added or self._removed:
+                self._set_base(S3Listing([entry for key, entry in self._scan('', None)]))
+            listing = self._base
+            marker = (self.resync_marker or '').encode('utf-8')
+            synced = self.synced or 0
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            f = open(tmp, 'wb')
+            try:
+                f.write(_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, synced, len(marker)))
+                f.write(marker)
+                listing.dump(f)
+            finally:
+                f.close()
+            os.rename(tmp, path)
+        finally:
+            self._lock.release()
+
+    def load(cls, path, bucket, page_size=None):
+        """
+        Create an index for bucket from a snapshot written by save(), without
+        listing the bucket. The file is memory mapped and read in place;
+        entries are only built when asked for.
+
+        @param path:      File name
+        @type  path:      string
+        @param bucket:    Bucket the snapshot was taken of
+        @type  bucket:    S3Bucket
+        @param page_size: Number of keys per listing request
+        @type  page_size: int
+        @return:          The index, attached to bucket
+        @rtype:           S3BucketIndex
+        """
+        f = open(path, 'rb')
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        try:
+            magic, version, synced, marker_len = _HEADER.unpack_from(buf, 0)
+            if magic != INDEX_MAGIC or version != INDEX_VERSION:
+                raise ValueError('Not a bucket index snapshot: %s' % path)
+            pos = _HEADER.size
+            marker = buf[pos:pos + marker_len].decode('utf-8') or None
+            listing = S3Listing.load(buf, pos + marker_len)[0]
+        except:
+            buf.close()
+            raise
+        index = cls(bucket, page_size=page_size, build=False)
+        index._set_base(listing, buf)
+        index.resync_marker = marker
+        index.synced = synced or None
+        return index
+
+    load = classmethod(load)
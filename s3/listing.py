@@ -0,0 +1,361 @@
+import sys
+import bisect
+import struct
+import binascii
+import calendar
+from array import array
+
+SNAPSHOT_MAGIC = 'S3LS'
+SNAPSHOT_VERSION = 3
+_HEADER = struct.Struct('<4sHBBQ')
+_SECTION = struct.Struct('<Q')
+
+
+def parse_timestamp(value):
+    """
+    Convert an ISO 8601 timestamp as found in listings
+    ('2006-02-03T16:45:09.000Z') to seconds since the epoch.
+    """
+    return calendar.timegm((int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                            int(value[11:13]), int(value[14:16]), int(value[17:19]), 0, 0, 0))
+
+
+class S3ListEntry(object):
+    """
+    One object (or common prefix) of a bucket listing.
+
+    Common prefixes, returned when listing with a delimiter, have only a key;
+    their size, etag, last_modified and owner are None.
+    """
+    __slots__ = ('key', 'size', 'etag', 'last_modified', 'owner')
+
+    def __init__(self, key, size=None, etag=None, last_modified=None, owner=None):
+        self.key = key
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.owner = owner
+
+    def __repr__(self):
+        return self.key
+
+    def __str__(self):
+        return self.key
+
+    def is_prefix(self):
+        """
+        Is this a rolled up common prefix rather than an object.
+        """
+        return self.size is None
+
+
+class _MappedBytes(object):
+    """
+    Read-only window onto part of a buffer; slicing it reads the buffer.
+    """
+    def __init__(self, buf, offset, length):
+        self._buf = buf
+        self._offset = offset
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, s):
+        start, stop, step = s.indices(self._length)
+        return self._buf[self._offset + start:self._offset + stop]
+
+    def __str__(self):
+        return self._buf[self._offset:self._offset + self._length]
+
+
+class _MappedArray(object):
+    """
+    Read-only array of numbers stored in a buffer, as array.tostring()
+    wrote them; items are unpacked from the buffer as they are accessed.
+    """
+    def __init__(self, typecode, buf, offset, length, swap):
+        self.typecode = typecode
+        self.itemsize = array(typecode).itemsize
+        if typecode == 'd':
+            fmt = 'd'
+        else:
+            fmt = {4: 'i', 8: 'q'}[self.itemsize]
+        if swap == (sys.byteorder == 'little'):
+            fmt = '>' + fmt
+        else:
+            fmt = '<' + fmt
+        self._struct = struct.Struct(fmt)
+        self._buf = buf
+        self._offset = offset
+        self._length = length // self.itemsize
+        self._swap = swap
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._length
+        if not 0 <= i < self._length:
+            raise IndexError(i)
+        return self._struct.unpack_from(self._buf, self._offset + i * self.itemsize)[0]
+
+    def __iter__(self):
+        unpack_from = self._struct.unpack_from
+        for pos in xrange(self._offset, self._offset + self._length * self.itemsize,
+                          self.itemsize):
+            yield unpack_from(self._buf, pos)[0]
+
+    def tostring(self):
+        data = self._buf[self._offset:self._offset + self._length * self.itemsize]
+        if self._swap:
+            a = array(self.typecode)
+            a.fromstring(data)
+            a.byteswap()
+            data = a.tostring()
+        return data
+
+
+class _KeyList(object):
+    """
+    Read-only sequence of keys packed back to back into a single buffer.
+    Offsets are doubles: exact far beyond 2 GiB, where array('l') is only
+    32 bits wide on some platforms.
+    """
+    def __init__(self):
+        self._data = bytearray()
+        self._offsets = array('d', [0])
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        key = str(self._data[int(self._offsets[i]):int(self._offsets[i + 1])])
+        try:
+            key.decode('ascii')
+        except UnicodeDecodeError:
+            return key.decode('utf-8')
+        return key
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def append(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        self._data.extend(key)
+        self._offsets.append(len(self._data))
+
+
+def _write_section(f, data):
+    f.write(_SECTION.pack(len(data)))
+    f.write(data)
+
+def _read_section(buf, pos):
+    length = _SECTION.unpack_from(buf, pos)[0]
+    pos += _SECTION.size
+    return buf[pos:pos + length], pos + length
+
+def _read_array(typecode, buf, pos, swap):
+    data, pos = _read_section(buf, pos)
+    a = array(typecode)
+    a.fromstring(data)
+    if swap:
+        a.byteswap()
+    return a, pos
+
+def _map_array(typecode, buf, pos, swap):
+    length = _SECTION.unpack_from(buf, pos)[0]
+    pos += _SECTION.size
+    return _MappedArray(typecode, buf, pos, length, swap), pos + length
+
+def _map_bytes(buf, pos):
+    length = _SECTION.unpack_from(buf, pos)[0]
+    pos += _SECTION.size
+    return _MappedBytes(buf, pos, length), pos + length
+
+def _write_strings(f, strings):
+    packed = _KeyList()
+    for s in strings:
+        packed.append(s)
+    _write_section(f, packed._offsets.tostring())
+    _write_section(f, str(packed._data))
+
+def _read_strings(buf, pos, swap):
+    packed = _KeyList()
+    packed._offsets, pos = _read_array('d', buf, pos, swap)
+    data, pos = _read_section(buf, pos)
+    packed._data = bytearray(data)
+    return packed, pos
+
+def _map_strings(buf, pos, swap):
+    packed = _KeyList()
+    packed._offsets, pos = _map_array('d', buf, pos, swap)
+    packed._data, pos = _map_bytes(buf, pos)
+    return packed, pos
+
+
+class S3Listing(object):
+    """
+    Compact, array backed collection of S3ListEntry records.
+
+    Keys are packed into one buffer, sizes and modification times are kept
+    in arrays of doubles (exact up to 2**53, where array('l') and
+    array('i') overflow at 2 GiB and in 2038 on some platforms), MD5 ETags
+    as 16 raw bytes each and owners as indexes into a table of distinct
+    owner ids: about 44 bytes per object on top of the key itself. Entries
+    are built on access. Common prefixes are kept apart, in the prefixes
+    list.
+    """
+    def __init__(self, entries=()):
+        self.keys = _KeyList()
+        self.prefixes = []
+        self._sizes = array('d')
+        self._mtimes = array('d')
+        self._etags = bytearray()
+        self._odd_etags = {}
+        self._owners = []
+        self._owner_ids = {}
+        self._owner_idx = array('i')
+        for entry in entries:
+            self.append(entry)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        for i in xrange(len(self.keys)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.keys)
+        etag = self._odd_etags.get(i)
+        if etag is None:
+            etag = binascii.hexlify(self._etags[i * 16:i * 16 + 16])
+        owner = self._owners[self._owner_idx[i]]
+        return S3ListEntry(self.keys[i], int(self._sizes[i]), etag, int(self._mtimes[i]),
+                           owner)
+
+    def __contains__(self, key):
+        return self.find(key) is not None
+
+    def append(self, entry):
+        """
+        Add an entry; common prefixes go to the prefixes list.
+
+        @param entry: Listing record
+        @type  entry: S3ListEntry
+        """
+        if entry.is_prefix():
+            self.prefixes.append(entry.key)
+            return
+        i = len(self.keys)
+        self.keys.append(entry.key)
+        self._sizes.append(entry.size)
+        self._mtimes.append(entry.last_modified or 0)
+        etag = entry.etag or ''
+        if len(etag) == 32:
+            try:
+                self._etags.extend(binascii.unhexlify(etag))
+                etag = None
+            except TypeError:
+                pass
+        if etag is not None:
+            self._etags.extend('\0' * 16)
+            self._odd_etags[i] = etag
+        owner = self._owner_ids.get(entry.owner)
+        if owner is None:
+            owner = self._owner_ids[entry.owner] = len(self._owners)
+            self._owners.append(entry.owner)
+        self._owner_idx.append(owner)
+
+    def find(self, key):
+        """
+        Look up an object by key. Listings arrive in key order, so this is a
+        binary search.
+
+        @param key: Object key
+        @type  key: string
+        @return:    The entry, or None if the key is not in the listing
+        @rtype:     S3ListEntry
+        """
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return self[i]
+        return None
+
+    def total_size(self):
+        """
+        Sum of the sizes of all objects in the listing.
+        """
+        return int(sum(self._sizes))
+
+    def dump(self, f):
+        """
+        Write the listing to an open binary file in its packed form.
+
+        @param f: File opened for writing
+        @type  f: file
+        """
+        f.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, sys.byteorder == 'little',
+                             array('i').itemsize, len(self)))
+        _write_section(f, self.keys._offsets.tostring())
+        _write_section(f, str(self.keys._data))
+        _write_section(f, self._sizes.tostring())
+        _write_section(f, self._mtimes.tostring())
+        _write_section(f, str(self._etags))
+        _write_section(f, self._owner_idx.tostring())
+        _write_strings(f, [owner or '' for owner in self._owners])
+        odd = sorted(self._odd_etags)
+        _write_section(f, array('d', odd).tostring())
+        _write_strings(f, [self._odd_etags[i] for i in odd])
+        _write_strings(f, self.prefixes)
+
+    def load(cls, buf, pos=0):
+        """
+        Read a listing written by dump() from a buffer, typically a read-only
+        mmap of the file. Keys, sizes, modification times, ETags and owner
+        indexes are read from the buffer as they are accessed rather than
+        copied, so it must stay open while the listing is used; the
+        listing is read-only.
+
+        @param buf: Buffer holding the dump
+        @type  buf: mmap or string
+        @param pos: Offset of the dump in buf
+        @type  pos: int
+        @return:    (listing, offset just past the dump)
+        @rtype:     tuple
+        """
+        magic, version, little, int_size, count = _HEADER.unpack_from(buf, pos)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError('Not a listing snapshot')
+        if int_size != array('i').itemsize:
+            raise ValueError('Listing snapshot was written on an incompatible platform')
+        swap = bool(little) != (sys.byteorder == 'little')
+        pos += _HEADER.size
+        listing = cls()
+        listing.keys, pos = _map_strings(buf, pos, swap)
+        listing._sizes, pos = _map_array('d', buf, pos, swap)
+        listing._mtimes, pos = _map_array('d', buf, pos, swap)
+        listing._etags, pos = _map_bytes(buf, pos)
+        listing._owner_idx, pos = _map_array('i', buf, pos, swap)
+        owners, pos = _read_strings(buf, pos, swap)
+        listing._owners = [owner or None for owner in owners]
+        listing._owner_ids = dict((owner, i) for i, owner in enumerate(listing._owners))
+        odd, pos = _read_array('d', buf, pos, swap)
+        odd_etags, pos = _read_strings(buf, pos, swap)
+        listing._odd_etags = dict(zip([int(i) for i in odd], odd_etags))
+        prefixes, pos = _read_strings(buf, pos, swap)
+        listing.prefixes = list(prefixes)
+        if len(listing.keys) != count:
+            raise ValueError('Truncated listing snapshot')
+        return listing, pos
+
+    load = classmethod(load)
@@ -0,0 +1,212 @@
+"""
+Request metrics for the S3 and SQS connections.
+
+A connection created with a metrics object reports every request to it;
+without one (the default) the request path does no metrics work at all.
+"""
+import bisect
+import threading
+
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RequestMetrics(object):
+    """
+    Interface the connections report to. Every method does nothing; subclass
+    and override what you need, e.g. to forward to statsd.
+
+    service is 's3' or 'sqs', method the HTTP method.
+    """
+
+    def request(self, service, method, status, seconds, sent, received):
+        """
+        A request completed.
+
+        @param status:   HTTP status, or None if no response was received
+        @type  status:   int
+        @param seconds:  Time until the response headers arrived
+        @type  seconds:  float
+        @param sent:     Request body bytes
+        @type  sent:     int
+        @param received: Response body bytes, as given by Content-Length
+        @type  received: int
+        """
+
+    def retry(self, service, method):
+        """
+        A request was sent again after its kept-alive connection failed.
+        """
+
+    def connection(self, service, reused):
+        """
+        A request got a connection; reused is False for a newly opened one.
+        """
+
+
+class _Histogram(object):
+    def __init__(self, buckets):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class InMemoryMetrics(RequestMetrics):
+    """
+    Thread-safe aggregator keeping counters and latency histograms in
+    memory. snapshot() returns them as plain data; prometheus_text() formats
+    them for a Prometheus scrape.
+    """
+
+    def __init__(self, latency_buckets=DEFAULT_LATENCY_BUCKETS):
+        """
+        @param latency_buckets: Upper bounds of the latency histogram buckets
+                                in seconds, ascending
+        @type  latency_buckets: tuple
+        """
+        self.latency_buckets = tuple(latency_buckets)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Set everything back to zero.
+        """
+        self._lock.acquire()
+        try:
+            self.requests = {}
+            self.bytes_sent = {}
+            self.bytes_received = {}
+            self.retries = {}
+            self.connections = {}
+            self.latency = {}
+        finally:
+            self._lock.release()
+
+    def request(self, service, method, status, seconds, sent, received):
+        key = (service, method)
+        self._lock.acquire()
+        try:
+            counter = (service, method, status)
+            self.requests[counter] = self.requests.get(counter, 0) + 1
+            self.bytes_sent[key] = self.bytes_sent.get(key, 0) + sent
+            self.bytes_received[key] = self.bytes_received.get(key, 0) + received
+            histogram = self.latency.get(key)
+            if histogram is None:
+                histogram = self.latency[key] = _Histogram(self.latency_buckets)
+            histogram.counts[bisect.bisect_left(self.latency_buckets, seconds)] += 1
+            histogram.sum += seconds
+            histogram.count += 1
+        finally:
+            self._lock.release()
+
+    def retry(self, service, method):
+        key = (service, method)
+        self._lock.acquire()
+        try:
+            self.retries[key] = self.retries.get(key, 0) + 1
+        finally:
+            self._lock.release()
+
+    def connection(self, service, reused):
+        key = (service, reused and 'reused' or 'created')
+        self._lock.acquire()
+        try:
+            self.connections[key] = self.connections.get(key, 0) + 1
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """
+        Copy of the current values.
+
+        @return: Dictionary with requests {(service, method, status): count},
+                 bytes_sent, bytes_received and retries {(service, method):
+                 n}, connections {(service, 'created' or 'reused'): count}
+                 and latency {(service, method): (bucket counts, sum,
+                 count)}, the bucket counts not cumulative and the last one
+                 for latencies above every bound
+        @rtype:  dict
+        """
+        self._lock.acquire()
+        try:
+            return {'requests': dict(self.requests),
+                    'bytes_sent': dict(self.bytes_sent),
+                    'bytes_received': dict(self.bytes_received),
+                    'retries': dict(self.retries),
+                    'connections': dict(self.connections),
+                    'latency': dict((key, (list(h.counts), h.sum, h.count))
+                                    for key, h in self.latency.items())}
+        finally:
+            self._lock.release()
+
+    def prometheus_text(self, prefix='amazon'):
+        """
+        The metrics in the Prometheus text exposition format.
+
+        @param prefix: Prefix of the metric names
+        @type  prefix: string
+        @rtype:        string
+        """
+        return prometheus_text(self, prefix)
+
+
+def _labels(**labels):
+    items = sorted(labels.items())
+    return '{%s}' % ','.join(['%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                                             .replace('"', '\\"'))
+                              for name, value in items])
+
+
+def _float(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def prometheus_text(metrics, prefix='amazon'):
+    """
+    Format an InMemoryMetrics in the Prometheus text exposition format.
+
+    @param metrics: Aggregated metrics
+    @type  metrics: InMemoryMetrics
+    @param prefix:  Prefix of the metric names
+    @type  prefix:  string
+    @rtype:         string
+    """
+    snapshot = metrics.snapshot()
+    lines = []
+    def counter(name, help, values, label_names):
+        lines.append('# HELP %s_%s %s' % (prefix, name, help))
+        lines.append('# TYPE %s_%s counter' % (prefix, name))
+        for key in sorted(values):
+            labels = dict(zip(label_names, key))
+            lines.append('%s_%s%s %d' % (prefix, name, _labels(**labels), values[key]))
+
+    requests = dict(((service, method, status is None and 'error' or status), n)
+                    for (service, method, status), n in snapshot['requests'].items())
+    counter('requests_total', 'Requests by service, method and HTTP status.',
+            requests, ('service', 'method', 'status'))
+    counter('bytes_sent_total', 'Request body bytes sent.',
+            snapshot['bytes_sent'], ('service', 'method'))
+    counter('bytes_received_total', 'Response body bytes received.',
+            snapshot['bytes_received'], ('service', 'method'))
+    counter('retries_total', 'Requests resent on a new connection.',
+            snapshot['retries'], ('service', 'method'))
+    counter('connections_total', 'Connections used, newly created or reused.',
+            snapshot['connections'], ('service', 'state'))
+
+    name = '%s_request_duration_seconds' % prefix
+    lines.append('# HELP %s Time until the response headers arrived.' % name)
+    lines.append('# TYPE %s histogram' % name)
+    bounds = list(metrics.latency_buckets) + [float('inf')]
+    for (service, method) in sorted(snapshot['latency']):
+        counts, total, count = snapshot['latency'][(service, method)]
+        cumulative = 0
+        for bound, n in zip(bounds, counts):
+            cumulative += n
+            lines.append('%s_bucket%s %d' % (name, _labels(service=service, method=method,
+                                                           le=_float(bound)), cumulative))
+        lines.append('%s_sum%s %s' % (name, _labels(service=service, method=method),
+                                      _float(total)))
+        lines.append('%s_count%s %d' % (name, _labels(service=service, method=method), count))
+    return '\n'.join(lines) + '\n'
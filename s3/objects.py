@@ -1,6 +1,108 @@
+import time
 from StringIO import StringIO
 from s3.errors import S3Error
-from s3.parsers import parseListKeys
+from s3.parsers import parseListKeysPage, parseListEntries
+from s3.listing import S3Listing, S3ListEntry
+from s3.transfer import download, get_many, delete_many, BackgroundCall, MappedFile
+from s3.transfer import DEFAULT_PART_SIZE, DEFAULT_WORKERS, DEFAULT_RETRIES, DEFAULT_MAX_IN_FLIGHT_BYTES
+from s3.transfer import DEFAULT_DELETE_WORKERS
+from s3.pipeline import S3Pipeline, DEFAULT_PIPELINE_DEPTH
+from s3.codec import CODECS, CODEC_META, SIZE_META, encode, decode, DecodingBody
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+class S3StreamingBody(object):
+    """
+    Lazy, file-like body of an S3Object fetched with C{bucket.get(key, stream=True)}.
+
+    Data is pulled from the socket only as it is read, so memory use is
+    bounded by the read size. The underlying connection goes back to the
+    pool once the body is exhausted, or is dropped if the body is closed
+    early.
+    """
+    def __init__(self, response, chunk_size=DEFAULT_CHUNK_SIZE):
+        self._response = response
+        self.chunk_size = chunk_size
+        length = response.getheader('Content-Length')
+        if length is not None:
+            length = int(length)
+        self.len = length
+        self._pos = 0
+
+    def __iter__(self):
+        return self.iter_chunks()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _getClosed(self):
+        return self._response is None
+
+    closed = property(_getClosed)
+
+    def read(self, n=None):
+        """
+        Read at most n bytes, or everything that is left if n is omitted.
+
+        @param n: Number of bytes to read
+        @type  n: int
+        @return:  Data read, empty string at the end of the body
+        @rtype:   string
+        """
+        if self._response is None:
+            return ''
+        if n is None or n < 0:
+            data = self._response.read()
+        else:
+            data = self._response.read(n)
+        self._pos += len(data)
+        if not data or self._response.isclosed():
+            self.close()
+        return data
+
+    def readinto(self, buf):
+        """
+        Read up to len(buf) bytes into a caller provided writable buffer.
+
+        @param buf: Writable buffer (bytearray, array, mmap...)
+        @type  buf: buffer
+        @return:    Number of bytes read, 0 at the end of the body
+        @rtype:     int
+        """
+        view = memoryview(buf)
+        data = self.read(len(view))
+        n = len(data)
+        view[:n] = data
+        return n
+
+    def iter_chunks(self, chunk_size=None):
+        """
+        Iterate over the body in chunks of at most chunk_size bytes.
+
+        @param chunk_size: Chunk size, defaults to the body's chunk_size
+        @type  chunk_size: int
+        """
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        data = self.read(chunk_size)
+        while data:
+            yield data
+            data = self.read(chunk_size)
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        """
+        Stop reading; an unfinished response's connection is not reused.
+        """
+        response, self._response = self._response, None
+        if response is not None:
+            response.close()
 
 
 class S3Object(object):
@@ -21,6 +123,19 @@ class S3Object(object):
     
     def __str__(self):
         return self.key
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Release a streamed body's connection. Does nothing for buffered objects.
+        """
+        if hasattr(self.data, 'close'):
+            self.data.close()
     
     def save(self):
         """
@@ -56,14 +171,21 @@ class S3Bucket(object):
     S3Bucket class
     
     Behaves like a dictionary of keys in the bucket, with some additional methods.
+    If an S3BucketIndex is attached, has_key() is answered from it and saves
+    and deletes keep it up to date. If a CompressionPolicy is attached as
+    compression, saves compress the objects it selects; gets decompress
+    such objects whether or not a policy is attached.
     """
     
     def __init__(self, name, connection):
         self.name = name
         self._s3_conn = connection
+        self.index = None
+        self.cache = None
+        self.compression = None
 
     def _request(self, method='', obj=None, send_io=None, params=None, headers=None, *args):
-        return getattr(self._s3_conn.clone(), method)(self.name, obj, send_io=send_io,
+        return getattr(self._s3_conn, method)(self.name, obj, send_io=send_io,
                                               params=params, headers=headers, *args)
 
     def __str__(self):
@@ -73,30 +195,99 @@ class S3Bucket(object):
         return self.name
 
 
-    def get(self, key, headers=None):
+    def _object(self, key, response, data, decoded=True):
+        metadata = {}
+        last_modified = ''
+        for header in response.getheaders():
+            if header[0].startswith('x-amz-meta-'):
+                metadata[header[0][11:]] = header[1]
+            elif header[0].lower() == 'last-modified':
+                last_modified = header[1]
+        codec = CODECS.get(metadata.get(CODEC_META))
+        if decoded and codec is not None:
+            size = metadata.pop(SIZE_META, None)
+            del metadata[CODEC_META]
+            if isinstance(data, S3StreamingBody):
+                if size is not None:
+                    size = int(size)
+                data = DecodingBody(data, codec, size)
+            else:
+                data = decode(codec, data)
+        return S3Object(key, data, metadata, last_modified, self)
+
+
+    def get(self, key, headers=None, stream=False, byte_range=None):
         """
         Get an S3Object from the bucket.
         
-        @param key:     Key of the object
-        @type  key:     string
-        @param headers: Dictionary of additional headers
-        @type  headers: dict
-        @return:        Selected S3Object if found or None
-        @rtype:         S3Object
+        With stream set, the object's data is an S3StreamingBody that reads
+        from the socket on demand instead of a string. Close it (or use the
+        object as a context manager) if it is not read to the end.
+        
+        If an S3BucketCache is attached, plain gets (no headers, range or
+        stream) are served through it.
+        
+        Compressed objects are decompressed, streamed ones in a background
+        thread. A byte_range applies to the stored, compressed bytes, so
+        ranged gets return those as they are; download() fetches compressed
+        objects whole instead.
+        
+        @param key:        Key of the object
+        @type  key:        string
+        @param headers:    Dictionary of additional headers
+        @type  headers:    dict
+        @param stream:     Return a lazy body instead of reading it all
+        @type  stream:     bool
+        @param byte_range: Inclusive (first, last) byte offsets to get; last
+                           may be None to read to the end of the object
+        @type  byte_range: tuple
+        @return:           Selected S3Object if found or None
+        @rtype:            S3Object
         """
+        if self.cache is not None and not headers and not stream and byte_range is None:
+            return self.cache.get(key)
         if headers is None:
             headers = {}
+        if byte_range is not None:
+            first, last = byte_range
+            if last is None:
+                headers['Range'] = 'bytes=%d-' % first
+            else:
+                headers['Range'] = 'bytes=%d-%d' % (first, last)
         response = self._request('GET', key, headers=headers)
-        headers = response.getheaders()
-        data = response.read()
-        metadata = {}
-        last_modified = ''
-        for header in headers:
-            if header[0].startswith('x-amz-meta-'):
-                metadata[header[0][11:]] = header[1]
-            elif header[0] == 'Last-Modified':
-                last_modified = header[1]
-        return S3Object(key, data, metadata, last_modified, self)
+        decoded = byte_range is None
+        if stream:
+            return self._object(key, response, S3StreamingBody(response), decoded)
+        return self._object(key, response, response.read(), decoded)
+
+
+    def download(self, key, target, part_size=DEFAULT_PART_SIZE, workers=DEFAULT_WORKERS,
+                 retries=DEFAULT_RETRIES, callback=None):
+        """
+        Download a (large) object into a file over several connections at once.
+
+        The object is split into byte ranges of part_size that are fetched
+        concurrently and written straight to their offset in the target file.
+        Use a connection pool at least as big as workers. A compressed object
+        cannot be split, so it is fetched in one GET and decompressed.
+
+        @param key:       Key of the object
+        @type  key:       string
+        @param target:    File name, or a seekable file object opened for writing
+        @type  target:    string or file
+        @param part_size: Size of each ranged GET in bytes
+        @type  part_size: int
+        @param workers:   Number of parts fetched concurrently
+        @type  workers:   int
+        @param retries:   How many times a failed part is retried
+        @type  retries:   int
+        @param callback:  Called with the TransferStats as data arrives
+        @type  callback:  callable
+        @return:          Transfer statistics, including throughput
+        @rtype:           TransferStats
+        """
+        return download(self, key, target, part_size=part_size, workers=workers,
+                        retries=retries, callback=callback)
 
 
     def head(self, key, headers=None):
@@ -115,9 +306,38 @@ class S3Bucket(object):
         return dict(self._request('HEAD', key, headers=headers).getheaders())
 
 
-    def list(self, prefix=None, marker=None, max_keys=None, delimiter=None):
+    def get_many(self, keys, workers=DEFAULT_WORKERS,
+                 max_in_flight_bytes=DEFAULT_MAX_IN_FLIGHT_BYTES, ordered=False):
+        """
+        Get many S3Objects concurrently over pooled connections.
+        
+        Objects are yielded as soon as they have been read, or in the order
+        of keys if ordered is set. Fetched bodies the caller has not yet
+        received count against max_in_flight_bytes; once it is used up the
+        workers wait.
+        
+        @param keys:                Keys (or S3Objects, or listing entries)
+        @type  keys:                iterable
+        @param workers:             Number of concurrent GETs
+        @type  workers:             int
+        @param max_in_flight_bytes: Budget for fetched, unconsumed data
+        @type  max_in_flight_bytes: int
+        @param ordered:             Keep the order of keys
+        @type  ordered:             bool
+        @return:                    Generator of S3Objects
+        @rtype:                     generator
+        """
+        return get_many(self, keys, workers=workers, max_in_flight_bytes=max_in_flight_bytes,
+                        ordered=ordered)
+
+
+    def list(self, prefix=None, marker=None, max_keys=None, delimiter=None,
+             workers=DEFAULT_WORKERS):
         """
-        List bucket objects.
+        Lazily list bucket objects, fetching them concurrently.
+        
+        Common prefixes (when listing with a delimiter) are skipped, as they
+        are not objects.
         
         @param prefix:    Limits the response to keys which begin with the
                           indicated prefix. You can use prefixes to separate a
@@ -140,18 +360,26 @@ class S3Bucket(object):
                           CommonPrefixes collection. These rolled-up keys are
                           not returned elsewhere in the response.
         @type  delimiter: char
+        @param workers:   Number of concurrent GETs
+        @type  workers:   int
+        @return:          Generator of S3Objects, in key order
+        @rtype:           generator
         """
-        keys = self.keys(prefix=prefix, marker=marker, max_keys=max_keys, delimiter=delimiter)
-        objects = []
-        for key in keys:
-            objects.append(self.get(key))
-        return objects
+        if max_keys:
+            entries = self._list_entries_page(prefix, marker, max_keys, delimiter)[0]
+        else:
+            entries = self.iterentries(prefix=prefix, marker=marker, delimiter=delimiter)
+        entries = (entry for entry in entries if not entry.is_prefix())
+        return self.get_many(entries, workers=workers, ordered=True)
 
 
     def save(self, s3object, headers=None):
         """
         Save an S3Object into bucket.
         
+        With a CompressionPolicy attached, the object is compressed if the
+        policy selects a codec for its Content-Type header and size.
+        
         @param s3object: An S3Object that has to be saved
         @type  s3object: S3Object
         @param headers:  Dictionary of additional headers
@@ -164,23 +392,191 @@ class S3Bucket(object):
             headers = {}
         for key in s3object.metadata:
             headers['x-amz-meta-' + key] = s3object.metadata[key]
-        self._request('PUT', s3object.key, send_io=data, headers=headers)
+        size = self._s3_conn._io_len(data)
+        if self._compressed_put(s3object.key, data, size, headers):
+            return
+        response = self._request('PUT', s3object.key, send_io=data, headers=headers)
+        self._saved(s3object.key, size, response)
+
+
+    def _compressed_put(self, key, data, size, headers):
+        # PUT data compressed if the policy wants it; False if it does not
+        if self.compression is None:
+            return False
+        content_type = None
+        for name in headers:
+            if name.lower() == 'content-type':
+                content_type = headers[name]
+        codec = self.compression.codec_for(content_type, size)
+        if codec is None:
+            return False
+        body = encode(codec, data, self.compression.spool_size)
+        try:
+            for name in headers.keys():
+                if name.lower() in ('content-md5', 'content-length'):
+                    del headers[name]
+            headers['Content-Encoding'] = codec.name
+            headers['Content-MD5'] = body.md5
+            headers['x-amz-meta-' + CODEC_META] = codec.name
+            if size is not None:
+                headers['x-amz-meta-' + SIZE_META] = str(size)
+            response = self._request('PUT', key, send_io=body, headers=headers)
+            self._saved(key, body.len, response)
+        finally:
+            body.close()
+        return True
+
+
+    def _saved(self, key, size, response):
+        if self.cache is not None:
+            self.cache.invalidate(key)
+        if self.index is not None:
+            etag = response.getheader('etag')
+            if etag:
+                etag = etag.strip('"')
+            self.index.add(S3ListEntry(key, size, etag, int(time.time())))
+
+
+    def save_file(self, key, path, metadata=None, headers=None, md5=True, compress=True):
+        """
+        Upload a local file without reading it into memory.
+
+        The file is memory mapped; Content-MD5 is computed over the mapping
+        and the body is written to the socket straight from it, so memory
+        use does not depend on the file size. With a CompressionPolicy
+        attached the file may be compressed like in save, and Content-MD5 is
+        always sent.
+
+        @param key:      Key for the new object
+        @type  key:      string
+        @param path:     Path of the file to upload
+        @type  path:     string
+        @param metadata: Object metadata
+        @type  metadata: dict
+        @param headers:  Dictionary of additional headers
+        @type  headers:  dict
+        @param md5:      Send a Content-MD5 header so S3 verifies the upload
+        @type  md5:      bool
+        @param compress: Let the CompressionPolicy compress the file
+        @type  compress: bool
+        """
+        if headers is None:
+            headers = {}
+        if metadata:
+            for name in metadata:
+                headers['x-amz-meta-' + name.lower()] = metadata[name]
+        body = MappedFile(path)
+        try:
+            if compress and self._compressed_put(key, body, body.len, headers):
+                return
+            if md5:
+                headers['Content-MD5'] = body.md5()
+            response = self._request('PUT', key, send_io=body, headers=headers)
+            self._saved(key, body.len, response)
+        finally:
+            body.close()
 
 
     def delete(self, objects):
         """
         Delete an S3Object, a key or list of keys or objects from bucket.
         
+        A list is deleted concurrently; the first failure is raised once
+        all deletes have been attempted.
+        
         @param objects: S3Object, S3Object key, or list of both to be deleted
         @type  objects: S3Object, string, list of S3Objects or list of strings
         """
         if not isinstance(objects, list):
             objects = [objects,]
-        for obj in objects:
-            if isinstance(obj, S3Object):
-                self._request('DELETE', obj.key)
-            else:
-                self._request('DELETE', obj)
+        if len(objects) == 1:
+            self._delete_key(getattr(objects[0], 'key', objects[0]))
+            return
+        failure = None
+        for key, error in self.delete_many(objects):
+            if error is not None and failure is None:
+                failure = error
+        if failure is not None:
+            raise failure
+
+
+    def pipeline(self, depth=DEFAULT_PIPELINE_DEPTH):
+        """
+        Batch small requests on one connection with HTTP/1.1 pipelining.
+        
+            with bucket.pipeline() as p:
+                exists = p.head(key)
+                p.delete(other_key)
+        
+        @param depth: Maximum number of requests written ahead of their responses
+        @type  depth: int
+        @return:      Pipeline; its requests are sent when the with block ends
+                      or execute() is called
+        @rtype:       S3Pipeline
+        """
+        return S3Pipeline(self, depth=depth)
+
+
+    def _delete_key(self, key):
+        self._request('DELETE', key)
+        self._deleted(key)
+
+
+    def _deleted(self, key):
+        if self.cache is not None:
+            self.cache.invalidate(key)
+        if self.index is not None:
+            self.index.remove(key)
+
+
+    def delete_many(self, keys, workers=DEFAULT_DELETE_WORKERS, rate=None,
+                    retries=DEFAULT_RETRIES):
+        """
+        Delete objects concurrently over pooled connections.
+        
+        Keys are pulled lazily from any iterable (a listing generator
+        included) and results are streamed back as the DELETEs complete,
+        so the caller can report progress and collect per-key failures.
+        
+        @param keys:    Keys, S3Objects or listing entries
+        @type  keys:    iterable
+        @param workers: Number of concurrent DELETEs
+        @type  workers: int
+        @param rate:    Maximum number of DELETEs per second, None for no limit
+        @type  rate:    float
+        @param retries: How many times a transient failure is retried
+        @type  retries: int
+        @return:        Generator of (key, exception or None) pairs
+        @rtype:         generator
+        """
+        return delete_many(self, keys, workers=workers, rate=rate, retries=retries)
+
+
+    def delete_prefix(self, prefix, workers=DEFAULT_DELETE_WORKERS, rate=None,
+                      retries=DEFAULT_RETRIES, page_size=None):
+        """
+        Delete every object whose key starts with prefix.
+        
+        The listing is paged in the background while the deletes of the
+        previous page are running, so listing and deleting overlap.
+        
+        @param prefix:    Key prefix; must not be empty
+        @type  prefix:    string
+        @param workers:   Number of concurrent DELETEs
+        @type  workers:   int
+        @param rate:      Maximum number of DELETEs per second
+        @type  rate:      float
+        @param retries:   How many times a transient failure is retried
+        @type  retries:   int
+        @param page_size: Number of keys per listing request
+        @type  page_size: int
+        @return:          Generator of (key, exception or None) pairs
+        @rtype:           generator
+        """
+        if not prefix:
+            raise S3Error('InvalidArgument', 'Refusing to delete the whole bucket', self.name)
+        return self.delete_many(self.iterkeys(prefix=prefix, page_size=page_size),
+                                workers=workers, rate=rate, retries=retries)
 
 
     def keys(self, prefix=None, marker=None, max_keys=None, delimiter=None):
@@ -209,14 +605,100 @@ class S3Bucket(object):
                           not returned elsewhere in the response.
         @type  delimiter: char
         """
+        return self._list_page(prefix, marker, max_keys, delimiter)[0]
+
+    def _list_params(self, prefix=None, marker=None, max_keys=None, delimiter=None):
         params = {}
         if prefix: params['prefix'] = prefix
         if marker: params['marker'] = marker
         if max_keys: params['max-keys'] = max_keys
         if delimiter: params['delimiter'] = delimiter
-        
+        return params
+
+    def _list_page(self, prefix=None, marker=None, max_keys=None, delimiter=None):
+        params = self._list_params(prefix, marker, max_keys, delimiter)
         response = self._request('GET', params=params)
-        return parseListKeys(response.read())
+        return parseListKeysPage(response.read())
+
+    def _list_entries_page(self, prefix=None, marker=None, max_keys=None, delimiter=None):
+        params = self._list_params(prefix, marker, max_keys, delimiter)
+        response = self._request('GET', params=params)
+        try:
+            return parseListEntries(response)
+        finally:
+            response.close()
+
+    def _iterpages(self, list_page, prefix, delimiter, page_size, marker):
+        page = list_page(prefix, marker, page_size, delimiter)
+        while True:
+            items, truncated, marker = page
+            pending = None
+            if truncated and marker:
+                pending = BackgroundCall(list_page, prefix, marker, page_size, delimiter)
+            for item in items:
+                yield item
+            if pending is None:
+                return
+            page = pending.result()
+
+    def iterkeys(self, prefix=None, delimiter=None, page_size=None, marker=None):
+        """
+        Iterate over all object keys in bucket, following the listing across
+        as many pages as needed.
+        
+        The next page is requested in the background while the current one
+        is being consumed, and at most two pages are held in memory.
+        
+        @param prefix:    Only keys which begin with prefix
+        @type  prefix:    string
+        @param delimiter: Roll up keys sharing the part up to the delimiter
+                          into a single common prefix (see keys)
+        @type  delimiter: char
+        @param page_size: Number of keys requested per page (max-keys)
+        @type  page_size: int
+        @param marker:    Start listing after this key
+        @type  marker:    string
+        @return:          Generator of keys
+        @rtype:           generator
+        """
+        return self._iterpages(self._list_page, prefix, delimiter, page_size, marker)
+
+    def iterentries(self, prefix=None, delimiter=None, page_size=None, marker=None):
+        """
+        Like iterkeys, but yields S3ListEntry records carrying each object's
+        size, ETag, modification time (seconds since the epoch) and owner id,
+        as reported by the listing itself.
+        
+        @param prefix:    Only keys which begin with prefix
+        @type  prefix:    string
+        @param delimiter: Roll up keys sharing the part up to the delimiter
+                          into a single common prefix entry
+        @type  delimiter: char
+        @param page_size: Number of keys requested per page (max-keys)
+        @type  page_size: int
+        @param marker:    Start listing after this key
+        @type  marker:    string
+        @return:          Generator of listing entries
+        @rtype:           generator
+        """
+        return self._iterpages(self._list_entries_page, prefix, delimiter, page_size, marker)
+
+    def listing(self, prefix=None, delimiter=None, page_size=None, marker=None):
+        """
+        Fetch a complete listing into a compact S3Listing.
+        
+        @param prefix:    Only keys which begin with prefix
+        @type  prefix:    string
+        @param delimiter: Roll up keys into common prefixes
+        @type  delimiter: char
+        @param page_size: Number of keys requested per page (max-keys)
+        @type  page_size: int
+        @param marker:    Start listing after this key
+        @type  marker:    string
+        @return:          All entries of the listing
+        @rtype:           S3Listing
+        """
+        return S3Listing(self.iterentries(prefix, delimiter, page_size, marker))
 
     values = list
 
@@ -224,16 +706,19 @@ class S3Bucket(object):
         """
         Returns (key, value) pairs, where, keys are object names, and values are S3Objects.
         
-        @return: List of (bucket name, bucket) pairs
-        @rtype:  list
+        @return: Generator of (object key, S3Object) pairs
+        @rtype:  generator
         """
-        return zip(self.keys(), self.list())
+        return ((obj.key, obj) for obj in self.list())
 
     def has_key(self, key):
         """
         Does key exists in bucket.
         """
-        return key in self.keys(prefix=key)
+        if self.index is not None:
+            return self.index.has_key(key)
+        # key sorts before anything else it is a prefix of
+        return self.keys(prefix=key, max_keys=1) == [key]
 
 
     def __getitem__(self, key):
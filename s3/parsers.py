@@ -1,4 +1,5 @@
 import s3
+from s3.listing import S3ListEntry, parse_timestamp
 try:
     from xml.etree import cElementTree as et
 except:
@@ -7,6 +8,18 @@ except:
 
 xmlns = 'http://s3.amazonaws.com/doc/' + s3.VERSION + '/'
 
+STATUS_CODES = {
+    304: 'NotModified',
+    400: 'BadRequest',
+    403: 'Forbidden',
+    404: 'NotFound',
+    409: 'Conflict',
+    412: 'PreconditionFailed',
+    416: 'InvalidRange',
+    500: 'InternalError',
+    503: 'ServiceUnavailable',
+}
+
 def parseError(xml):
     '''
     Parse the response XML if error occured, and creates an SQSError exception.
@@ -52,6 +65,28 @@ def parseGetBucket(name, xml, connection, default):
     else:
         return default
 
+def parseErrorResponse(status, reason, body, resource=''):
+    '''
+    Create the S3Error for an error response. Responses without an error
+    document (to HEAD requests, 304 Not Modified) get a code made from the
+    status.
+    
+    @param status:   HTTP status
+    @type  status:   int
+    @param reason:   HTTP reason phrase
+    @type  reason:   string
+    @param body:     Response body
+    @type  body:     string
+    @param resource: Requested resource
+    @type  resource: string
+    @return:         Returns the S3Error exception
+    @rtype:          S3Error
+    '''
+    if body:
+        return parseError(body)
+    return s3.S3Error(STATUS_CODES.get(status, str(status)), reason, resource)
+
+
 def parseGetBucketNames(xml):
     """
     Parse the response XML for geting a list of bucket names
@@ -94,12 +129,98 @@ def parseListKeys(xml):
     @return:       List of object keys
     @rtype:        list
     '''
+    return parseListKeysPage(xml)[0]
+
+def parseListKeysPage(xml):
+    '''Parse one page of a (possibly truncated) bucket listing
+    
+    @param xml:    The XML response
+    @type  xml:    string
+    @return:       (keys, is_truncated, next_marker) where keys is the list
+                   of object keys and common prefixes on the page, and
+                   next_marker the marker for the following page
+    @rtype:        tuple
+    '''
     root = et.fromstring(xml)
     keys = []
+    marker = None
     contents = root.findall('{%s}Contents' % xmlns)
     for obj in contents:
         keys.append(obj.find('{%s}Key' % xmlns).text)
+    if keys:
+        marker = keys[-1]
     prefixes = root.findall('{%s}CommonPrefixes' % xmlns)
     for prefix in prefixes:
         keys.append(prefix.find('{%s}Prefix' % xmlns).text)
-    return keys
+    if prefixes and keys[-1] > marker:
+        marker = keys[-1]
+    truncated = root.findtext('{%s}IsTruncated' % xmlns) == 'true'
+    next_marker = root.findtext('{%s}NextMarker' % xmlns)
+    if next_marker:
+        marker = next_marker
+    return keys, truncated, marker
+
+
+def parseListEntries(source):
+    '''Incrementally parse one page of a bucket listing, keeping each
+    object's size, ETag, modification time and owner
+    
+    Elements are discarded as soon as they have been turned into entries,
+    so the parser never holds more than one <Contents> element.
+    
+    @param source: The XML response as a file-like object (e.g. the
+                   HTTP response itself)
+    @type  source: file
+    @return:       (entries, is_truncated, next_marker) where entries is a
+                   list of S3ListEntry for objects and common prefixes
+    @rtype:        tuple
+    '''
+    contents = '{%s}Contents' % xmlns
+    common_prefix = '{%s}CommonPrefixes' % xmlns
+    key_tag = '{%s}Key' % xmlns
+    size_tag = '{%s}Size' % xmlns
+    etag_tag = '{%s}ETag' % xmlns
+    modified_tag = '{%s}LastModified' % xmlns
+    owner_tag = '{%s}Owner/{%s}ID' % (xmlns, xmlns)
+    prefix_tag = '{%s}Prefix' % xmlns
+    truncated_tag = '{%s}IsTruncated' % xmlns
+    next_marker_tag = '{%s}NextMarker' % xmlns
+    owners = {}
+
+    entries = []
+    truncated = False
+    last_key = None
+    next_marker = None
+    root = None
+    for event, elem in et.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            continue
+        tag = elem.tag
+        if tag == contents:
+            key = elem.findtext(key_tag)
+            etag = elem.findtext(etag_tag)
+            if etag:
+                etag = etag.strip('"')
+            modified = elem.findtext(modified_tag)
+            if modified:
+                modified = parse_timestamp(modified)
+            owner = elem.findtext(owner_tag)
+            owner = owners.setdefault(owner, owner)
+            entries.append(S3ListEntry(key, int(elem.findtext(size_tag) or 0), etag,
+                                       modified, owner))
+            if key > last_key:
+                last_key = key
+            root.clear()
+        elif tag == common_prefix:
+            key = elem.findtext(prefix_tag)
+            entries.append(S3ListEntry(key))
+            if key > last_key:
+                last_key = key
+            root.clear()
+        elif tag == truncated_tag:
+            truncated = elem.text == 'true'
+        elif tag == next_marker_tag:
+            next_marker = elem.text
+    return entries, truncated, next_marker or last_key
@@ -0,0 +1,263 @@
+import time
+import socket
+import httplib
+
+from s3.errors import S3Error
+from s3.parsers import parseErrorResponse
+from s3.connection import PORTS_BY_SECURITY
+
+DEFAULT_PIPELINE_DEPTH = 32
+DEFAULT_PIPELINE_RETRIES = 3
+
+
+class _SharedFile(object):
+    """
+    Buffered reader over the pipelined socket, shared by the responses read
+    from it one after the other. HTTPResponse closes its file once the body
+    is read; that must not throw away what is buffered for the next one.
+    """
+    def __init__(self, sock):
+        self._fp = sock.makefile('rb')
+
+    def makefile(self, *args):
+        return self
+
+    def read(self, *args):
+        return self._fp.read(*args)
+
+    def readline(self, *args):
+        return self._fp.readline(*args)
+
+    def close(self):
+        pass
+
+
+class PipelinedRequest(object):
+    """
+    Handle to one request of an S3Pipeline. result() is available once the
+    pipeline has been executed.
+    """
+    def __init__(self, method, key, headers, body, handler):
+        self.method = method
+        self.key = key
+        self.headers = headers
+        self.body = body
+        self._handler = handler
+        self._done = False
+        self._result = None
+        self._error = None
+
+    def __repr__(self):
+        return '<PipelinedRequest %s %s>' % (self.method, self.key)
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        """
+        The value the equivalent S3Bucket method would have returned.
+
+        @raise S3Error: The request failed
+        """
+        if not self._done:
+            raise S3Error('PipelineNotExecuted', 'The pipeline has not been executed yet', self.key)
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def _finish(self, result=None, error=None):
+        self._done = True
+        self._result = result
+        self._error = error
+
+
+class S3Pipeline(object):
+    """
+    Batch of small requests (head, get, save of a string, delete) to one
+    bucket, sent back to back on a single keep-alive connection with HTTP/1.1
+    pipelining: up to depth requests are written before the responses are
+    read, in order. That costs one round trip per batch instead of one per
+    request.
+
+    If the server closes the connection part way through, the requests it has
+    not answered are sent again on a new connection; if it did not answer any
+    of them, the pipeline falls back to one request at a time.
+
+        with bucket.pipeline() as p:
+            size = p.head('a')
+            obj = p.get('b')
+            p.delete('c')
+        print size.result()['content-length'], obj.result().data
+    """
+
+    def __init__(self, bucket, depth=DEFAULT_PIPELINE_DEPTH, retries=DEFAULT_PIPELINE_RETRIES):
+        """
+        @param bucket:  Bucket the requests go to
+        @type  bucket:  S3Bucket
+        @param depth:   Maximum number of requests written ahead of their responses
+        @type  depth:   int
+        @param retries: How many times unanswered requests are resent after
+                        the server closed the connection without answering any
+        @type  retries: int
+        """
+        self._bucket = bucket
+        self.depth = depth
+        self.retries = retries
+        self._queue = []
+
+    def __len__(self):
+        return len(self._queue)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+        else:
+            self._queue = []
+
+    def _add(self, method, key, headers, body, handler):
+        request = PipelinedRequest(method, key, dict(headers or {}), body, handler)
+        self._queue.append(request)
+        return request
+
+    def head(self, key, headers=None):
+        """
+        Queue a HEAD; the result is a dictionary of the object's headers.
+        """
+        return self._add('HEAD', key, headers, None,
+                         lambda response, body: dict(response.getheaders()))
+
+    def get(self, key, headers=None):
+        """
+        Queue a GET; the result is an S3Object.
+        """
+        return self._add('GET', key, headers, None,
+                         lambda response, body: self._bucket._object(key, response, body))
+
+    def save(self, s3object, headers=None):
+        """
+        Queue a PUT of an S3Object whose data is a string.
+        """
+        data = s3object.data
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if not isinstance(data, str):
+            raise TypeError('Only objects with string data can be pipelined')
+        headers = dict(headers or {})
+        for name in s3object.metadata:
+            headers['x-amz-meta-' + name] = s3object.metadata[name]
+        key = s3object.key
+        def saved(response, body):
+            self._bucket._saved(key, len(data), response)
+        return self._add('PUT', key, headers, data, saved)
+
+    def delete(self, key):
+        """
+        Queue a DELETE of a key or S3Object.
+        """
+        key = getattr(key, 'key', key)
+        def deleted(response, body):
+            self._bucket._deleted(key)
+        return self._add('DELETE', key, None, None, deleted)
+
+    def execute(self):
+        """
+        Send the queued requests and read their responses.
+
+        Failed requests (error responses) are reported by their handle's
+        result(); execute() only raises if the requests could not be sent.
+
+        @return: The handles of the executed requests, in order
+        @rtype:  list
+        """
+        queue, self._queue = self._queue, []
+        pending = queue
+        depth = self.depth
+        failures = 0
+        while pending:
+            answered = self._run(pending[:depth])
+            if answered:
+                failures = 0
+            else:
+                # nothing came back: the server may not pipeline at all
+                depth = 1
+                failures += 1
+                if failures > self.retries:
+                    raise S3Error('PipelineFailed', 'The server closed the connection '
+                                  'without answering', pending[0].key)
+            pending = pending[answered:]
+        return queue
+
+    def _request_data(self, conn, request):
+        s3conn = self._bucket._s3_conn
+        path = s3conn._path(self._bucket.name, request.key)
+        length = None
+        if request.body is not None:
+            length = len(request.body)
+        headers = s3conn._headers(request.method, path, length=length,
+                                  headers=dict(request.headers))
+        host = s3conn._host
+        if s3conn._port != PORTS_BY_SECURITY[s3conn._secure]:
+            host = '%s:%d' % (host, s3conn._port)
+        lines = ['%s %s HTTP/1.1' % (request.method, path), 'Host: %s' % host,
+                 'Accept-Encoding: identity']
+        for name, value in headers.items():
+            lines.append('%s: %s' % (name, value))
+        return '\r\n'.join(lines) + '\r\n\r\n' + (request.body or '')
+
+    def _run(self, batch):
+        """
+        Pipeline one batch on a pooled connection.
+
+        @return: Number of requests of batch that were answered
+        @rtype:  int
+        """
+        s3conn = self._bucket._s3_conn
+        pool = s3conn._pool
+        metrics = s3conn._metrics
+        conn = pool.acquire()
+        answered = 0
+        will_close = True
+        started = time.time()
+        try:
+            if metrics is not None:
+                metrics.connection('s3', conn.sock is not None)
+            if conn.sock is None:
+                conn.connect()
+            conn.sock.sendall(''.join([self._request_data(conn, request) for request in batch]))
+            shared = _SharedFile(conn.sock)
+            for request in batch:
+                response = httplib.HTTPResponse(shared, method=request.method)
+                response.begin()
+                if metrics is not None:
+                    metrics.request('s3', request.method, response.status,
+                                    time.time() - started, len(request.body or ''),
+                                    int(response.getheader('content-length') or 0))
+                body = response.read()
+                will_close = response.will_close
+                if response.status < 200 or response.status > 299:
+                    request._finish(error=parseErrorResponse(response.status, response.reason,
+                                                             body, request.key))
+                else:
+                    try:
+                        request._finish(request._handler(response, body))
+                    except Exception, e:
+                        request._finish(error=e)
+                answered += 1
+                if will_close:
+                    break
+        except (socket.error, httplib.HTTPException):
+            will_close = True
+            if metrics is not None and answered < len(batch):
+                metrics.request('s3', batch[answered].method, None, time.time() - started,
+                                0, 0)
+        except:
+            pool.discard(conn)
+            raise
+        if will_close:
+            pool.discard(conn)
+        else:
+            pool.release(conn)
+        return answered
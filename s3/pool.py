@@ -0,0 +1,255 @@
+import httplib
+import select
+import socket
+import threading
+import time
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_IDLE_TIMEOUT = 60
+
+
+def _nodelay(conn):
+    # headers and body go out in separate writes; with Nagle on, the body
+    # waits for the ACK of the headers, which the server may delay ~40ms
+    conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def unanswered(method, error):
+    """
+    Can a request on a kept-alive connection be sent again after it failed
+    reading the response? Only if the server closed the connection before
+    sending a byte of a response, and only for requests that do not change
+    anything when repeated: a PUT or POST it did process would be applied
+    twice. Timeouts and partial responses are never retried.
+
+    @param method: HTTP method of the request
+    @type  method: string
+    @param error:  Exception raised by getresponse()
+    @type  error:  Exception
+    @rtype:        bool
+    """
+    if method in ('PUT', 'POST') or not isinstance(error, httplib.BadStatusLine):
+        return False
+    # older httplibs report the empty status line as '' or "''"
+    return error.line in ('', "''") or error.line.startswith('No status line received')
+
+
+class HTTPConnection(httplib.HTTPConnection):
+    affinity = None
+
+    def connect(self):
+        httplib.HTTPConnection.connect(self)
+        _nodelay(self)
+
+
+class HTTPSConnection(httplib.HTTPSConnection):
+    affinity = None
+
+    def connect(self):
+        httplib.HTTPSConnection.connect(self)
+        _nodelay(self)
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of persistent HTTP/1.1 connections to a single
+    (host, port, secure) endpoint.
+
+    Connections are lent out with acquire() and handed back with release()
+    once the response body has been drained. At most C{size} idle connections
+    are kept; with C{block} set, at most C{size} connections exist at all and
+    acquire() waits for one to be released.
+    """
+
+    def __init__(self, host, port, secure=True, size=DEFAULT_POOL_SIZE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, block=False, debug=0):
+        """
+        @param host:         Server host name
+        @type  host:         string
+        @param port:         Server port
+        @type  port:         int
+        @param secure:       Use HTTPS connections
+        @type  secure:       bool
+        @param size:         Maximum number of idle connections kept
+        @type  size:         int
+        @param idle_timeout: Seconds after which an idle connection is
+                             considered stale and reopened, None for never
+        @type  idle_timeout: int
+        @param block:        Never have more than size connections open
+        @type  block:        bool
+        """
+        self.host = host
+        self.port = port
+        self.secure = secure
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.block = block
+        self.debug = debug
+        self.created = 0
+        self.reused = 0
+        self._idle = []
+        self._in_use = 0
+        self._cond = threading.Condition(threading.Lock())
+
+    def __repr__(self):
+        return '<ConnectionPool %s:%d idle=%d in_use=%d>' % (self.host, self.port,
+                                                           len(self._idle), self._in_use)
+
+    def set_debuglevel(self, debug):
+        self.debug = debug
+
+    def _new_conn(self):
+        if self.secure:
+            conn = HTTPSConnection(self.host, self.port)
+        else:
+            conn = HTTPConnection(self.host, self.port)
+        return conn
+
+    def _is_stale(self, conn, released_at):
+        if conn.sock is None:
+            return False
+        if self.idle_timeout is not None and time.time() - released_at > self.idle_timeout:
+            return True
+        # an idle keep-alive socket has nothing to read; if it is readable
+        # the server has closed it (or sent garbage)
+        try:
+            readable = select.select([conn.sock], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            return True
+        return bool(readable)
+
+    def acquire(self, affinity=None):
+        """
+        Borrow a connection from the pool.
+
+        A connection whose C{sock} is None will open a new socket on its first
+        request; otherwise it is a kept-alive one.
+
+        Given an affinity key, the idle connection last used with the same
+        key is preferred over the most recently released one, so requests
+        for one queue or object keep going over the same warm connection.
+
+        @param affinity: Any hashable key, None for no preference
+        @type  affinity: object
+        @return:         HTTP connection
+        @rtype:          httplib.HTTPConnection
+        """
+        self._cond.acquire()
+        try:
+            while self.block and not self._idle and self._in_use >= self.size:
+                self._cond.wait()
+            conn = None
+            if self._idle:
+                index = -1
+                if affinity is not None:
+                    for i in xrange(len(self._idle) - 1, -1, -1):
+                        if self._idle[i][0].affinity == affinity:
+                            index = i
+                            break
+                conn, released_at = self._idle.pop(index)
+                if self._is_stale(conn, released_at):
+                    conn.close()
+            self._in_use += 1
+        finally:
+            self._cond.release()
+        if conn is None:
+            conn = self._new_conn()
+        conn.affinity = affinity
+        conn.set_debuglevel(self.debug)
+        if conn.sock is None:
+            self.created += 1
+        else:
+            self.reused += 1
+        return conn
+
+    def release(self, conn):
+        """
+        Return a connection whose last response has been fully read.
+
+        @param conn: Connection obtained with acquire()
+        @type  conn: httplib.HTTPConnection
+        """
+        self._cond.acquire()
+        try:
+            self._in_use -= 1
+            if len(self._idle) < self.size:
+                self._idle.append((conn, time.time()))
+                conn = None
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        if conn is not None:
+            conn.close()
+
+    def discard(self, conn):
+        """
+        Close a broken connection (or one with an unread response) instead of
+        returning it to the pool.
+
+        @param conn: Connection obtained with acquire()
+        @type  conn: httplib.HTTPConnection
+        """
+        conn.close()
+        self._cond.acquire()
+        try:
+            self._in_use -= 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def clear(self):
+        """
+        Close all idle connections.
+        """
+        self._cond.acquire()
+        try:
+            idle, self._idle = self._idle, []
+        finally:
+            self._cond.release()
+        for conn, released_at in idle:
+            conn.close()
+
+
+class PooledResponse(object):
+    """
+    Wraps an httplib.HTTPResponse and hands its connection back to the pool
+    as soon as the body has been read to the end, or discards it if the
+    response is closed early.
+    """
+
+    def __init__(self, response, conn, pool):
+        self._response = response
+        self._conn = conn
+        self._pool = pool
+        if response.isclosed():
+            self._release()
+
+    def __getattr__(self, attr):
+        return getattr(self._response, attr)
+
+    def _release(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._pool.release(conn)
+
+    def _discard(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._pool.discard(conn)
+
+    def read(self, amt=None):
+        try:
+            data = self._response.read(amt)
+        except:
+            self._discard()
+            raise
+        if self._response.isclosed():
+            self._release()
+        return data
+
+    def close(self):
+        if self._response.isclosed():
+            self._release()
+        else:
+            self._response.close()
+            self._discard()
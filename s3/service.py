@@ -1,6 +1,13 @@
+import time
+import threading
+
+import s3
 from s3.objects import S3Bucket
 from s3.connection import S3Connection
-from s3.parsers import parseListBuckets, parseGetBucket, parseGetBucketNames
+from s3.pool import DEFAULT_POOL_SIZE, DEFAULT_IDLE_TIMEOUT
+from s3.parsers import parseGetBucketNames
+
+DEFAULT_BUCKET_CACHE_TTL = 0
 
 
 class S3Service(object):
@@ -8,10 +15,83 @@ class S3Service(object):
     S3 Service class.
     
     Behaves like a dictionary of buckets, with some additional functions.
+    All requests share one pool of keep-alive connections, so a single
+    S3Service can be used from many threads.
     """
     
-    def __init__(self, pub_key, priv_key):
-        self._s3_conn = S3Connection(pub_key, priv_key)
+    def __init__(self, pub_key, priv_key, secure=True, host=s3.DEFAULT_HOST, port=None,
+                 pool_size=DEFAULT_POOL_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 bucket_cache_ttl=DEFAULT_BUCKET_CACHE_TTL, verify_buckets=True, metrics=None,
+                 hedge=None):
+        """
+        @param pub_key:          AWS access key id
+        @type  pub_key:          string
+        @param priv_key:         AWS secret access key
+        @type  priv_key:         string
+        @param secure:           Use HTTPS
+        @type  secure:           bool
+        @param host:             S3 host name
+        @type  host:             string
+        @param port:             S3 port, default depends on secure
+        @type  port:             int
+        @param pool_size:        Maximum number of idle keep-alive connections
+        @type  pool_size:        int
+        @param idle_timeout:     Seconds an idle connection is kept before it
+                                 is reopened
+        @type  idle_timeout:     int
+        @param bucket_cache_ttl: Seconds the list of buckets is cached and
+                                 shared between threads, 0 to ask S3 every time
+        @type  bucket_cache_ttl: int
+        @param verify_buckets:   If false, get() and service[name] return a
+                                 bucket handle without checking it exists
+        @type  verify_buckets:   bool
+        @param metrics:          Receives a report of every request
+        @type  metrics:          RequestMetrics
+        @param hedge:            Hedging of slow read requests, None for none
+        @type  hedge:            HedgePolicy
+        """
+        self._s3_conn = S3Connection(pub_key, priv_key, secure=secure, host=host, port=port,
+                                     pool_size=pool_size, idle_timeout=idle_timeout,
+                                     metrics=metrics, hedge=hedge)
+        self.bucket_cache_ttl = bucket_cache_ttl
+        self.verify_buckets = verify_buckets
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._names = None
+        self._names_time = 0
+        self._cache_lock = threading.Lock()
+
+    def _bucket_names(self):
+        # the lock only guards the cache; the listing request is made
+        # without it so that threads do not queue behind each other's
+        self._cache_lock.acquire()
+        try:
+            if self._names is not None and time.time() - self._names_time < self.bucket_cache_ttl:
+                self.cache_hits += 1
+                return list(self._names)
+            self.cache_misses += 1
+        finally:
+            self._cache_lock.release()
+        response = self._s3_conn.get()
+        names = parseGetBucketNames(response.read())
+        if self.bucket_cache_ttl:
+            self._cache_lock.acquire()
+            try:
+                self._names = names
+                self._names_time = time.time()
+            finally:
+                self._cache_lock.release()
+        return list(names)
+
+    def clear_cache(self):
+        """
+        Forget the cached list of buckets.
+        """
+        self._cache_lock.acquire()
+        try:
+            self._names = None
+        finally:
+            self._cache_lock.release()
 
     def get(self, name, default=None):
         """
@@ -22,8 +102,9 @@ class S3Service(object):
         @return:     Bucket if exists, else None
         @rtype:      S3Bucket or None
         """
-        response = self._s3_conn.clone().get()
-        return parseGetBucket(name, response.read(), self._s3_conn, default)
+        if not self.verify_buckets or name in self._bucket_names():
+            return S3Bucket(name, self._s3_conn)
+        return default
 
     def list(self):
         """
@@ -32,8 +113,7 @@ class S3Service(object):
         @return:       List of buckets associated with the authenticated user
         @rtype:        list
         """
-        response = self._s3_conn.clone().get()
-        return parseListBuckets(response.read(), self._s3_conn)
+        return [S3Bucket(name, self._s3_conn) for name in self._bucket_names()]
 
     def create(self, name):
         """
@@ -44,7 +124,13 @@ class S3Service(object):
         @return:     Returns the newly created bucket
         @rtype:      S3Bucket
         """
-        self._s3_conn.clone().put(name)
+        self._s3_conn.put(name)
+        self._cache_lock.acquire()
+        try:
+            if self._names is not None and name not in self._names:
+                self._names.append(name)
+        finally:
+            self._cache_lock.release()
         return S3Bucket(name, self._s3_conn)
 
 
@@ -55,7 +141,13 @@ class S3Service(object):
         @param name: Name of the queue that should be deleted
         @type  name: string
         """
-        self._s3_conn.clone().delete(name)
+        self._s3_conn.delete(name)
+        self._cache_lock.acquire()
+        try:
+            if self._names is not None and name in self._names:
+                self._names.remove(name)
+        finally:
+            self._cache_lock.release()
 
 
     def keys(self):
@@ -65,8 +157,7 @@ class S3Service(object):
         @return: List of bucket names
         @rtype:  list
         """
-        response = self._s3_conn.clone().get()
-        return parseGetBucketNames(response.read())
+        return self._bucket_names()
         
     values = list
 
@@ -77,7 +168,7 @@ class S3Service(object):
         @return: List of (bucket name, bucket) pairs
         @rtype:  list
         """
-        return zip(self.keys(), self.list())
+        return [(name, S3Bucket(name, self._s3_conn)) for name in self._bucket_names()]
 
 
     def has_key(self, key):
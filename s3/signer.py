@@ -0,0 +1,109 @@
+import re
+import time
+import hmac
+import base64
+import hashlib
+
+HTTP_DATE_FORMAT = "%a, %d %b %Y %H:%M:%S GMT"
+
+_date_cache = (None, None)
+
+def http_date(now=None):
+    """
+    RFC 1123 date for the Date header; formatted at most once per second.
+
+    @param now: Seconds since the epoch, defaults to the current time
+    @type  now: float
+    @return:    Formatted date
+    @rtype:     string
+    """
+    global _date_cache
+    second = int(now or time.time())
+    cached = _date_cache
+    if cached[0] == second:
+        return cached[1]
+    value = time.strftime(HTTP_DATE_FORMAT, time.gmtime(second))
+    _date_cache = (second, value)
+    return value
+
+
+_SUBRESOURCE = re.compile("[&?](acl|torrent)($|=|&)")
+
+def string_to_sign(method, path, headers):
+    """
+    Build S3's canonical string to sign for a request.
+
+    Only the ?acl and ?torrent sub-resources of the query string are part
+    of the signed path.
+
+    @param method:  HTTP method
+    @type  method:  string
+    @param path:    Request path, with or without a query string
+    @type  path:    string
+    @param headers: Request headers
+    @type  headers: dict
+    @return:        String to sign
+    @rtype:         string
+    """
+    get = headers.get
+    parts = [method, get("Content-MD5", ""), get("Content-Type", ""), get("Date", "")]
+    xamzs = [k for k in headers if k[:6] == "x-amz-"]
+    if xamzs:
+        xamzs.sort()
+        for k in xamzs:
+            parts.append(k + ":" + headers[k].strip())
+    if '?' in path:
+        stripped_path = path.split('?', 1)[0]
+        match = _SUBRESOURCE.search(path)
+        if match:
+            stripped_path += "?" + match.group(1)
+        path = stripped_path
+    parts.append(path)
+    return "\n".join(parts)
+
+
+class Signer(object):
+    """
+    HMAC-SHA1 request signer shared by the s3 and sqs connections and URL
+    generators.
+
+    The secret key is fed to the HMAC once; every signature starts from a
+    copy of that keyed state instead of rebuilding it.
+    """
+
+    def __init__(self, pub_key, priv_key):
+        self.pub_key = pub_key
+        self._hmac = hmac.new(priv_key, digestmod=hashlib.sha1)
+
+    def sign(self, string):
+        """
+        Base64 encoded HMAC-SHA1 signature of string.
+        """
+        h = self._hmac.copy()
+        h.update(string)
+        return base64.b64encode(h.digest())
+
+    def sign_many(self, strings):
+        """
+        Sign a batch of strings.
+
+        @param strings: Strings to sign
+        @type  strings: iterable
+        @return:        Signatures, in the same order
+        @rtype:         list
+        """
+        copy = self._hmac.copy
+        b64encode = base64.b64encode
+        signatures = []
+        append = signatures.append
+        for string in strings:
+            h = copy()
+            h.update(string)
+            append(b64encode(h.digest()))
+        return signatures
+
+    def authorization(self, method, path, headers):
+        """
+        Value of the Authorization header of an S3 request.
+        """
+        return "AWS %s:%s" % (self.pub_key, self.sign(string_to_sign(method, path, headers)))
@@ -0,0 +1,395 @@
+"""
+Mirror a local directory tree to a bucket prefix (push) or back (pull),
+transferring only the files that differ.
+
+Both sides are walked in key order and merged. Files whose size differs
+from the listed object are transferred; when sizes match, the file's MD5 is
+compared with the object's ETag. Hashing runs on a process pool, transfers
+on a thread pool.
+
+Pushed files are stored uncompressed whatever the bucket's
+CompressionPolicy, since the listed size and ETag of a compressed object
+are those of the compressed bytes and would never match the file. Objects
+stored compressed by other writers are listed with their compressed size,
+so objects whose size differs from the file are HEADed: for a compressed
+one, the uncompressed size recorded with it is compared instead and, its
+ETag being no use either, the modification times as for multipart uploads.
+"""
+import os
+import time
+import fnmatch
+import hashlib
+import multiprocessing
+
+from s3.codec import CODECS, CODEC_META, SIZE_META
+from s3.errors import S3Error
+from s3.transfer import imap_unordered, DEFAULT_WORKERS, DEFAULT_DELETE_WORKERS
+
+HASH_BLOCK_SIZE = 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+
+def _md5_file(path):
+    """
+    Hex MD5 digest of a file; runs in the hashing processes.
+    """
+    digest = hashlib.md5()
+    f = open(path, 'rb')
+    try:
+        data = f.read(HASH_BLOCK_SIZE)
+        while data:
+            digest.update(data)
+            data = f.read(HASH_BLOCK_SIZE)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+
+def _is_md5(etag):
+    # multipart uploads have ETags like '<md5 of md5s>-<parts>'
+    if not etag or len(etag) != 32:
+        return False
+    try:
+        int(etag, 16)
+    except ValueError:
+        return False
+    return True
+
+
+class SyncReport(object):
+    """
+    Outcome of a sync run.
+
+    actions lists every (action, key, size) decided, action being 'upload',
+    'download', 'delete' or 'skip'. A dry run only decides; its counters
+    are what would have been transferred and deleted.
+    failed lists (key, exception) for transfers and deletes that failed.
+    """
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.actions = []
+        self.failed = []
+        self.transferred = 0
+        self.bytes_transferred = 0
+        self.skipped = 0
+        self.bytes_skipped = 0
+        self.deleted = 0
+        self.hashed = 0
+        self.started = time.time()
+        self.finished = None
+
+    def __str__(self):
+        return ('%s%d transferred (%d bytes), %d skipped (%d bytes), %d deleted, '
+                '%d hashed, %d failed in %.1fs' %
+                (self.dry_run and 'dry run: ' or '', self.transferred, self.bytes_transferred,
+                 self.skipped, self.bytes_skipped, self.deleted, self.hashed,
+                 len(self.failed), (self.finished or time.time()) - self.started))
+
+    def _planned(self, transfers, deletes):
+        self.transferred = len(transfers)
+        self.bytes_transferred = sum([size for key, size in transfers])
+        self.deleted = len(deletes or ())
+
+    def _skip(self, key, size):
+        self.actions.append(('skip', key, size))
+        self.skipped += 1
+        self.bytes_skipped += size
+
+
+def _selected(key, include, exclude):
+    if include and not [p for p in include if fnmatch.fnmatchcase(key, p)]:
+        return False
+    if exclude and [p for p in exclude if fnmatch.fnmatchcase(key, p)]:
+        return False
+    return True
+
+
+def _local_files(directory, include, exclude):
+    """
+    Sorted list of (relative key, path, size, mtime) of the files under
+    directory. Keys use '/' and sort like S3 keys, by their UTF-8 bytes.
+    """
+    files = []
+    for root, dirs, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, directory).replace(os.sep, '/')
+            if isinstance(rel, unicode):
+                rel = rel.encode('utf-8')
+            if not _selected(rel, include, exclude):
+                continue
+            st = os.stat(path)
+            files.append((rel, path, st.st_size, st.st_mtime))
+    files.sort()
+    return files
+
+
+def _remote_entries(bucket, prefix, include, exclude):
+    """
+    (relative key, S3ListEntry) of the objects under prefix, in key order.
+    """
+    for entry in bucket.iterentries(prefix=prefix or None):
+        key = entry.key
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        rel = key[len(prefix):]
+        if rel and _selected(rel, include, exclude):
+            yield rel, entry
+
+
+def _merge(local, remote):
+    """
+    Join two key ordered sequences, yielding (key, local item, remote
+    item) with None for the side the key is missing from.
+    """
+    local = iter(local)
+    remote = iter(remote)
+    l = next(local, None)
+    r = next(remote, None)
+    while l is not None or r is not None:
+        if r is None or (l is not None and l[0] < r[0]):
+            yield l[0], l, None
+            l = next(local, None)
+        elif l is None or r[0] < l[0]:
+            yield r[0], None, r
+            r = next(remote, None)
+        else:
+            yield l[0], l, r
+            l = next(local, None)
+            r = next(remote, None)
+
+
+def _local_path(directory, key):
+    """
+    Path a key is pulled to, or None for keys that do not name a file under
+    directory: folder markers, absolute keys, keys with empty, '.' or '..'
+    segments and keys that lead out of it through a symbolic link.
+    """
+    parts = key.split('/')
+    if not key or key.endswith('/') or key.startswith('/') or \
+            [part for part in parts if part in ('', '.', '..')]:
+        return None
+    path = os.path.join(directory, *parts)
+    root = os.path.join(os.path.realpath(directory), '')
+    if not os.path.realpath(path).startswith(root):
+        return None
+    return path
+
+
+def _hash_all(paths, processes):
+    if not paths:
+        return []
+    if processes == 0 or len(paths) == 1:
+        return map(_md5_file, paths)
+    processes = processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(_md5_file, paths, chunksize=max(1, len(paths) // processes // 4))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _source_newer(l, r, pushing):
+    # for objects whose ETag is not the MD5 of the file
+    return r[1].last_modified is not None and int(l[3]) != r[1].last_modified and \
+           (int(l[3]) > r[1].last_modified) == pushing
+
+
+def _uncompressed_size(bucket, key):
+    """
+    Size of the decoded body of a compressed object, or None if the object
+    is not compressed or its size was not recorded.
+    """
+    head = bucket.head(key)
+    if CODECS.get(head.get('x-amz-meta-' + CODEC_META)) is None:
+        return None
+    size = head.get('x-amz-meta-' + SIZE_META)
+    if size is not None:
+        size = int(size)
+    return size
+
+
+def _plan(bucket, directory, prefix, include, exclude, hash_processes, workers, report,
+          pushing):
+    """
+    Merge both sides and sort every key into missing locally, missing
+    remotely or differing (after hashing same-sized files). Objects without
+    an MD5 ETag differ if the source side is the newer one; so do compressed
+    objects, found by HEADing the objects whose size differs, whose
+    uncompressed size matches the file.
+
+    @return: (differing, local only, remote only) lists of (key, local, remote)
+    @rtype:  tuple
+    """
+    differing = []
+    local_only = []
+    remote_only = []
+    compare = []
+    mismatched = []
+    local = _local_files(directory, include, exclude)
+    for key, l, r in _merge(local, _remote_entries(bucket, prefix, include, exclude)):
+        if r is None:
+            local_only.append((key, l, None))
+        elif l is None:
+            remote_only.append((key, None, r))
+        elif l[2] != r[1].size:
+            mismatched.append((key, l, r))
+        elif _is_md5(r[1].etag):
+            compare.append((key, l, r))
+        elif _source_newer(l, r, pushing):
+            differing.append((key, l, r))
+        else:
+            report._skip(key, l[2])
+    if mismatched:
+        def uncompressed_size(item):
+            return _uncompressed_size(bucket, prefix + item[0])
+        for (key, l, r), size, error in imap_unordered(uncompressed_size, mismatched, workers):
+            if error is None and size == l[2] and not _source_newer(l, r, pushing):
+                report._skip(key, l[2])
+            else:
+                differing.append((key, l, r))
+    digests = _hash_all([l[1] for key, l, r in compare], hash_processes)
+    report.hashed += len(digests)
+    for (key, l, r), digest in zip(compare, digests):
+        if digest != r[1].etag:
+            differing.append((key, l, r))
+        else:
+            report._skip(key, l[2])
+    differing.sort()
+    return differing, local_only, remote_only
+
+
+def _run(func, items, workers, report):
+    for item, size, error in imap_unordered(func, items, workers):
+        if error is not None:
+            report.failed.append((item[0], error))
+        else:
+            report.transferred += 1
+            report.bytes_transferred += size
+
+
+def push(bucket, directory, prefix='', delete=False, dry_run=False, include=None,
+         exclude=None, workers=DEFAULT_WORKERS, hash_processes=None):
+    """
+    Upload the files of a local directory tree that are missing from, or
+    differ from, the objects under prefix.
+
+    @param bucket:         Target bucket
+    @type  bucket:         S3Bucket
+    @param directory:      Local directory
+    @type  directory:      string
+    @param prefix:         Key prefix the tree maps to, usually ending in '/'
+    @type  prefix:         string
+    @param delete:         Delete objects under prefix that have no local file
+    @type  delete:         bool
+    @param dry_run:        Only report what would be done
+    @type  dry_run:        bool
+    @param include:        Glob patterns of relative keys to sync; all if None
+    @type  include:        list
+    @param exclude:        Glob patterns of relative keys to leave alone
+    @type  exclude:        list
+    @param workers:        Number of concurrent uploads
+    @type  workers:        int
+    @param hash_processes: Size of the hashing process pool, None for one per
+                           CPU, 0 to hash in this process
+    @type  hash_processes: int
+    @return:               What was (or would be) done
+    @rtype:                SyncReport
+    """
+    report = SyncReport(dry_run)
+    differing, uploads, extraneous = _plan(bucket, directory, prefix, include, exclude,
+                                           hash_processes, workers, report, True)
+    uploads = sorted(uploads + differing)
+    for key, l, r in uploads:
+        report.actions.append(('upload', key, l[2]))
+    if delete:
+        for key, l, r in extraneous:
+            report.actions.append(('delete', key, r[1].size))
+    if dry_run:
+        report._planned([(key, l[2]) for key, l, r in uploads], delete and extraneous)
+    else:
+        def upload(item):
+            key, l, r = item
+            bucket.save_file(prefix + key, l[1], compress=False)
+            return l[2]
+        _run(upload, uploads, workers, report)
+        if delete and extraneous:
+            for key, error in bucket.delete_many([prefix + key for key, l, r in extraneous],
+                                                 workers=DEFAULT_DELETE_WORKERS):
+                if error is None:
+                    report.deleted += 1
+                else:
+                    report.failed.append((key[len(prefix):], error))
+    report.finished = time.time()
+    return report
+
+
+def pull(bucket, directory, prefix='', delete=False, dry_run=False, include=None,
+         exclude=None, workers=DEFAULT_WORKERS, hash_processes=None):
+    """
+    Download the objects under prefix that are missing from, or differ from,
+    the files of a local directory tree. Files are written to a temporary
+    name and renamed into place once complete.
+
+    Takes the same arguments as push(); delete removes local files that have
+    no object under prefix. Folder markers (keys ending in '/') are left
+    out; keys that would be written outside directory fail.
+
+    @return: What was (or would be) done
+    @rtype:  SyncReport
+    """
+    report = SyncReport(dry_run)
+    differing, extraneous, downloads = _plan(bucket, directory, prefix, include, exclude,
+                                             hash_processes, workers, report, False)
+    # folder markers have no file to go to
+    downloads = sorted([item for item in downloads + differing if not item[0].endswith('/')])
+    for key, l, r in downloads:
+        report.actions.append(('download', key, r[1].size))
+    if delete:
+        for key, l, r in extraneous:
+            report.actions.append(('delete', key, l[2]))
+    if dry_run:
+        report._planned([(key, r[1].size) for key, l, r in downloads], delete and extraneous)
+    else:
+        def download(item):
+            key, l, r = item
+            path = _local_path(directory, key)
+            if path is None:
+                raise S3Error('InvalidKey', 'Key does not name a file under the directory',
+                              key)
+            parent = os.path.dirname(path)
+            if not os.path.isdir(parent):
+                try:
+                    os.makedirs(parent)
+                except OSError:
+                    if not os.path.isdir(parent):
+                        raise
+            tmp = '%s.%d.s3sync' % (path, os.getpid())
+            obj = bucket.get(prefix + key, stream=True)
+            size = 0
+            try:
+                f = open(tmp, 'wb')
+                try:
+                    for chunk in obj.data.iter_chunks(DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        size += len(chunk)
+                finally:
+                    f.close()
+                    obj.close()
+                os.rename(tmp, path)
+            except:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+                raise
+            return size
+        _run(download, downloads, workers, report)
+        if delete:
+            for key, l, r in extraneous:
+                try:
+                    os.unlink(l[1])
+                    report.deleted += 1
+                except OSError, e:
+                    report.failed.append((key, e))
+    report.finished = time.time()
+    return report
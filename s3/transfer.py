@@ -0,0 +1,680 @@
+import os
+import sys
+import mmap
+import time
+import base64
+import hashlib
+import socket
+import httplib
+import threading
+from Queue import Queue, Empty
+
+from s3.errors import S3Error
+from s3.codec import CODECS, CODEC_META, SIZE_META
+
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_WORKERS = 8
+DEFAULT_RETRIES = 3
+SEND_BUFFER_SIZE = 256 * 1024
+DEFAULT_MAX_IN_FLIGHT_BYTES = 64 * 1024 * 1024
+DEFAULT_DELETE_WORKERS = 16
+
+# S3 error codes worth retrying; anything else is a permanent failure
+RETRYABLE_CODES = ('InternalError', 'SlowDown', 'ServiceUnavailable', 'RequestTimeout',
+                   'IncompleteBody')
+
+
+class TransferStats(object):
+    """
+    Progress and throughput of a transfer.
+
+    Updated from the worker threads while the transfer is running, so it can
+    be inspected from a progress callback.
+    """
+    def __init__(self, key, size):
+        self.key = key
+        self.size = size
+        self.transferred = 0
+        self.parts = 0
+        self.retries = 0
+        self.started = time.time()
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        size = self.size
+        if size is None:
+            size = '?'
+        return '<TransferStats %s: %d/%s bytes, %d parts, %d retries, %.1f MB/s>' % (
+            self.key, self.transferred, size, self.parts, self.retries,
+            self.throughput / (1024.0 * 1024.0))
+
+    def _add(self, transferred=0, parts=0, retries=0):
+        self._lock.acquire()
+        try:
+            self.transferred += transferred
+            self.parts += parts
+            self.retries += retries
+        finally:
+            self._lock.release()
+
+    def _getElapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    elapsed = property(_getElapsed)
+
+    def _getThroughput(self):
+        elapsed = self.elapsed
+        if elapsed <= 0:
+            return 0.0
+        return self.transferred / elapsed
+
+    throughput = property(_getThroughput)
+
+
+def is_retryable(error):
+    """
+    Is the exception a transient network or server error.
+    """
+    if isinstance(error, S3Error):
+        return error.code in RETRYABLE_CODES
+    return isinstance(error, (socket.error, httplib.HTTPException))
+
+
+def parallel(func, items, workers):
+    """
+    Call func(*item) for each item on up to workers threads.
+
+    Stops handing out items after the first failure and re-raises it once
+    all threads have finished.
+    """
+    queue = Queue()
+    for item in items:
+        queue.put(item)
+    errors = []
+    def work():
+        while not errors:
+            try:
+                item = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                func(*item)
+            except:
+                errors.append(sys.exc_info())
+    threads = [threading.Thread(target=work) for i in range(min(workers, queue.qsize()))]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+
+class BackgroundCall(object):
+    """
+    Runs func(*args) on a daemon thread; result() waits for it and returns
+    its value or re-raises its exception.
+    """
+    def __init__(self, func, *args):
+        self._func = func
+        self._args = args
+        self._value = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            self._value = self._func(*self._args)
+        except:
+            self._error = sys.exc_info()
+
+    def result(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._value
+
+
+class _PathTarget(object):
+    def __init__(self, path, size):
+        f = open(path, 'wb')
+        try:
+            f.truncate(size)
+        finally:
+            f.close()
+        self._path = path
+
+    def part(self, offset):
+        f = open(self._path, 'r+b')
+        f.seek(offset)
+        return f
+
+    def close(self):
+        pass
+
+
+class _FileTarget(object):
+    def __init__(self, fileobj, size):
+        self._f = fileobj
+        self._base = fileobj.tell()
+        self._size = size
+        self._lock = threading.Lock()
+        # truncate() past the end does not grow in-memory files (StringIO
+        # even loses track of its length), so only shrink with it and grow
+        # by writing the last byte; parts written out of order then land at
+        # their offsets
+        fileobj.seek(0, 2)
+        end = fileobj.tell()
+        if end > self._base + size and hasattr(fileobj, 'truncate'):
+            fileobj.truncate(self._base + size)
+        elif end < self._base + size:
+            fileobj.seek(self._base + size - 1)
+            fileobj.write('\0')
+
+    def part(self, offset):
+        return _FilePart(self, offset)
+
+    def close(self):
+        self._f.seek(0, 2)
+        if self._f.tell() < self._base + self._size:
+            raise S3Error('IncompleteBody', 'The file object lost data written to it',
+                          '%d of %d bytes' % (self._f.tell() - self._base, self._size))
+        self._f.seek(self._base + self._size)
+
+
+class _FilePart(object):
+    def __init__(self, target, offset):
+        self._target = target
+        self._offset = offset
+
+    def write(self, data):
+        target = self._target
+        target._lock.acquire()
+        try:
+            target._f.seek(target._base + self._offset)
+            target._f.write(data)
+        finally:
+            target._lock.release()
+        self._offset += len(data)
+
+    def close(self):
+        pass
+
+
+class MappedFile(object):
+    """
+    Read-only, memory mapped request body.
+
+    The connection sends it with iter_buffers(), as buffer slices of the
+    mapping, so no string is built per chunk. read() is there for code that
+    expects an ordinary file object.
+    """
+    def __init__(self, path):
+        f = open(path, 'rb')
+        try:
+            self.len = os.fstat(f.fileno()).st_size
+            if self.len:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._map = ''
+        finally:
+            f.close()
+        self._pos = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def md5(self):
+        """
+        Base64 encoded MD5 digest of the whole file, for Content-MD5.
+        """
+        digest = hashlib.md5()
+        for pos in xrange(0, self.len, SEND_BUFFER_SIZE):
+            digest.update(buffer(self._map, pos, SEND_BUFFER_SIZE))
+        return base64.b64encode(digest.digest())
+
+    def iter_buffers(self, size=SEND_BUFFER_SIZE):
+        """
+        Iterate over the rest of the file as zero-copy buffer slices.
+        """
+        while self._pos < self.len:
+            chunk = buffer(self._map, self._pos, size)
+            self._pos += len(chunk)
+            yield chunk
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self.len - self._pos
+        data = self._map[self._pos:self._pos + n]
+        self._pos += len(data)
+        return data
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self._pos
+        elif whence == 2:
+            pos += self.len
+        self._pos = max(0, min(pos, self.len))
+
+    def close(self):
+        if self.len:
+            self._map.close()
+        self.len = self._pos = 0
+
+
+def _fetch_range(bucket, key, start, end, target, stats, etag, retries, callback):
+    pos = start
+    attempt = 0
+    while True:
+        headers = {}
+        if etag:
+            headers['If-Match'] = etag
+        try:
+            obj = bucket.get(key, headers=headers, stream=True, byte_range=(pos, end))
+            if obj.data.len is not None and obj.data.len != end - pos + 1:
+                obj.close()
+                raise S3Error('InvalidRange', 'Server did not honour the Range header',
+                              '%s bytes=%d-%d' % (key, pos, end))
+            part = target.part(pos)
+            try:
+                for chunk in obj.data:
+                    part.write(chunk)
+                    pos += len(chunk)
+                    stats._add(len(chunk))
+                    if callback is not None:
+                        callback(stats)
+            finally:
+                part.close()
+                obj.close()
+            if pos <= end:
+                raise S3Error('IncompleteBody', 'Connection closed before the range was read',
+                              '%s bytes=%d-%d' % (key, start, end))
+            stats._add(parts=1)
+            return
+        except Exception, e:
+            if attempt >= retries or not is_retryable(e):
+                raise
+            attempt += 1
+            stats._add(retries=1)
+
+
+def _fetch_decoded(bucket, key, target, stats, etag, retries, callback):
+    # a compressed object only decompresses from its start, so it is read in
+    # one GET; a retry starts over and skips what was already written
+    written = 0
+    attempt = 0
+    while True:
+        headers = {}
+        if etag:
+            headers['If-Match'] = etag
+        try:
+            obj = bucket.get(key, headers=headers, stream=True)
+            part = target.part(written)
+            pos = 0
+            try:
+                for chunk in obj.data:
+                    if pos + len(chunk) > written:
+                        data = chunk[max(0, written - pos):]
+                        part.write(data)
+                        written += len(data)
+                        stats._add(len(data))
+                        if callback is not None:
+                            callback(stats)
+                    pos += len(chunk)
+            finally:
+                part.close()
+                obj.close()
+            if stats.size is not None and pos != stats.size:
+                raise S3Error('IncompleteBody', 'Decompressed size does not match the object',
+                              '%s %d of %d bytes' % (key, pos, stats.size))
+            stats._add(parts=1)
+            return written
+        except Exception, e:
+            if attempt >= retries or not is_retryable(e):
+                raise
+            attempt += 1
+            stats._add(retries=1)
+
+
+def download(bucket, key, target, part_size=DEFAULT_PART_SIZE, workers=DEFAULT_WORKERS,
+             retries=DEFAULT_RETRIES, callback=None):
+    """
+    Download an object into a file using concurrent ranged GETs.
+
+    The object's size is read with a HEAD request, the file is preallocated
+    and every part is written straight to its offset as it arrives. A part
+    that fails is retried on its own, resuming from the last byte written.
+    A compressed object is fetched in one GET and written decompressed.
+
+    @param bucket:    Bucket containing the object
+    @type  bucket:    S3Bucket
+    @param key:       Key of the object
+    @type  key:       string
+    @param target:    File name, or a seekable file object opened for writing
+    @type  target:    string or file
+    @param part_size: Size of each ranged GET in bytes
+    @type  part_size: int
+    @param workers:   Number of parts fetched concurrently
+    @type  workers:   int
+    @param retries:   How many times a single part is retried
+    @type  retries:   int
+    @param callback:  Called with the TransferStats after every chunk written
+    @type  callback:  callable
+    @return:          Transfer statistics
+    @rtype:           TransferStats
+    """
+    head = bucket.head(key)
+    size = int(head['content-length'])
+    etag = head.get('etag')
+    codec = CODECS.get(head.get('x-amz-meta-' + CODEC_META))
+    if codec is not None:
+        size = head.get('x-amz-meta-' + SIZE_META)
+        if size is not None:
+            size = int(size)
+    stats = TransferStats(key, size)
+    if isinstance(target, basestring):
+        target = _PathTarget(target, size or 0)
+    else:
+        target = _FileTarget(target, size or 0)
+    if codec is not None:
+        try:
+            written = _fetch_decoded(bucket, key, target, stats, etag, retries, callback)
+        finally:
+            stats.finished = time.time()
+        if stats.size is None:
+            stats.size = target._size = written
+        target.close()
+        return stats
+    ranges = []
+    for start in xrange(0, size, part_size):
+        end = min(start + part_size, size) - 1
+        ranges.append((bucket, key, start, end, target, stats, etag, retries, callback))
+    try:
+        parallel(_fetch_range, ranges, workers)
+    finally:
+        stats.finished = time.time()
+    if stats.transferred != size:
+        raise S3Error('IncompleteBody', 'Downloaded size does not match the object',
+                      '%s %d of %d bytes' % (key, stats.transferred, size))
+    target.close()
+    return stats
+
+
+class _ByteBudget(object):
+    """
+    Caps the number of bytes fetched but not yet handed to the caller.
+
+    A request that does not fit waits for the caller to consume results,
+    except when nothing is in flight (so an object larger than the whole
+    budget still gets through) or when it is the one the caller is waiting
+    for in ordered mode.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.next_index = None
+        self.cancelled = False
+        self._cond = threading.Condition()
+
+    def acquire(self, size, index):
+        self._cond.acquire()
+        try:
+            while not self.cancelled and self.in_flight and \
+                  self.in_flight + size > self.limit and index != self.next_index:
+                self._cond.wait()
+            self.in_flight += size
+            return not self.cancelled
+        finally:
+            self._cond.release()
+
+    def release(self, size, next_index=None):
+        self._cond.acquire()
+        try:
+            self.in_flight -= size
+            self.next_index = next_index
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def cancel(self):
+        self._cond.acquire()
+        try:
+            self.cancelled = True
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+
+def get_many(bucket, keys, workers=DEFAULT_WORKERS,
+             max_in_flight_bytes=DEFAULT_MAX_IN_FLIGHT_BYTES, ordered=False):
+    """
+    Fetch many objects concurrently, yielding them as they arrive.
+
+    Keys are pulled lazily from the iterable, so it can be a listing
+    generator. Each body is read only once it fits in the byte budget;
+    bodies count against it until the caller has received them.
+
+    @param bucket:              Bucket containing the objects
+    @type  bucket:              S3Bucket
+    @param keys:                Keys, S3Objects or S3ListEntry records
+    @type  keys:                iterable
+    @param workers:             Number of concurrent GETs
+    @type  workers:             int
+    @param max_in_flight_bytes: Budget for fetched but not yet consumed data
+    @type  max_in_flight_bytes: int
+    @param ordered:             Yield objects in the order of keys instead
+                                of completion order
+    @type  ordered:             bool
+    @return:                    Generator of S3Objects
+    @rtype:                     generator
+    """
+    keys = iter(keys)
+    keys_lock = threading.Lock()
+    results = Queue()
+    budget = _ByteBudget(max_in_flight_bytes)
+    if ordered:
+        budget.next_index = 0
+    counter = [0]
+
+    def next_key():
+        keys_lock.acquire()
+        try:
+            if budget.cancelled:
+                return None, None
+            try:
+                key = keys.next()
+            except StopIteration:
+                return None, None
+            index = counter[0]
+            counter[0] += 1
+            return index, getattr(key, 'key', key)
+        finally:
+            keys_lock.release()
+
+    def work():
+        try:
+            while True:
+                index, key = next_key()
+                if key is None:
+                    break
+                if bucket.cache is not None:
+                    obj = bucket.get(key)
+                    size = len(obj.data)
+                    if not budget.acquire(size, index):
+                        break
+                else:
+                    obj = bucket.get(key, stream=True)
+                    size = obj.data.len or 0
+                    if not budget.acquire(size, index):
+                        obj.close()
+                        break
+                    try:
+                        obj.data = obj.data.read()
+                    except:
+                        budget.release(size, budget.next_index)
+                        raise
+                results.put((index, size, obj, None))
+        except:
+            results.put((None, 0, None, sys.exc_info()))
+        else:
+            results.put((None, 0, None, None))
+
+    threads = [threading.Thread(target=work) for i in range(workers)]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+
+    running = len(threads)
+    pending = {}
+    expected = 0
+    try:
+        while running:
+            index, size, obj, error = results.get()
+            if index is None:
+                running -= 1
+                if error is not None:
+                    raise error[0], error[1], error[2]
+                continue
+            if not ordered:
+                budget.release(size)
+                yield obj
+                continue
+            pending[index] = (size, obj)
+            while expected in pending:
+                size, obj = pending.pop(expected)
+                expected += 1
+                budget.release(size, expected)
+                yield obj
+    finally:
+        budget.cancel()
+
+
+class RateLimiter(object):
+    """
+    Spaces calls to wait() so that at most rate of them return per second,
+    across all threads.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        self._lock.acquire()
+        try:
+            now = time.time()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+        finally:
+            self._lock.release()
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def imap_unordered(func, items, workers, rate=None):
+    """
+    Call func(item) for every item on up to workers threads, pulling items
+    lazily, and yield (item, result, error) in completion order, where
+    error is the exception func raised or None.
+
+    Closing the generator stops the workers after their current call.
+    """
+    items = iter(items)
+    items_lock = threading.Lock()
+    results = Queue()
+    stop = []
+    limiter = None
+    if rate:
+        limiter = RateLimiter(rate)
+    done = object()
+
+    def next_item():
+        items_lock.acquire()
+        try:
+            if stop:
+                return done
+            return items.next()
+        except StopIteration:
+            return done
+        finally:
+            items_lock.release()
+
+    def work():
+        try:
+            while True:
+                item = next_item()
+                if item is done:
+                    break
+                if limiter is not None:
+                    limiter.wait()
+                try:
+                    results.put((item, func(item), None))
+                except Exception, e:
+                    results.put((item, None, e))
+        except:
+            results.put((done, None, sys.exc_info()))
+        else:
+            results.put((done, None, None))
+
+    threads = [threading.Thread(target=work) for i in range(workers)]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    running = len(threads)
+    try:
+        while running:
+            item, result, error = results.get()
+            if item is done:
+                running -= 1
+                if error is not None:
+                    raise error[0], error[1], error[2]
+                continue
+            yield item, result, error
+    finally:
+        stop.append(True)
+
+
+def delete_many(bucket, keys, workers=DEFAULT_DELETE_WORKERS, rate=None,
+                retries=DEFAULT_RETRIES):
+    """
+    Delete objects concurrently, yielding (key, error) for every key as its
+    DELETE completes; error is None on success.
+
+    @param bucket:  Bucket containing the objects
+    @type  bucket:  S3Bucket
+    @param keys:    Keys, S3Objects or listing entries; pulled lazily, so
+                    this can be a listing generator
+    @type  keys:    iterable
+    @param workers: Number of concurrent DELETEs
+    @type  workers: int
+    @param rate:    Maximum number of DELETEs per second, None for no limit
+    @type  rate:    float
+    @param retries: How many times a transient failure is retried
+    @type  retries: int
+    @return:        Generator of (key, exception or None)
+    @rtype:         generator
+    """
+    def delete(key):
+        attempt = 0
+        while True:
+            try:
+                bucket._delete_key(key)
+                return
+            except Exception, e:
+                if attempt >= retries or not is_retryable(e):
+                    raise
+                attempt += 1
+
+    keys = (getattr(key, 'key', key) for key in keys)
+    for key, result, error in imap_unordered(delete, keys, workers, rate):
+        yield key, error
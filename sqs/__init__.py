@@ -5,6 +5,9 @@ from sqs.connection import SQSConnection
 from sqs.errors import SQSError
 from sqs.objects import SQSQueue, SQSMessage
 from sqs.service import SQSService
+from sqs.consumer import SQSConsumer
+from sqs.batch import SQSBatchWriter
+from sqs.offload import S3Offload
 from sqs.generator import SQSGenerator
 
 Service = SQSService
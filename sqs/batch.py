@@ -0,0 +1,309 @@
+import sys
+import time
+import threading
+
+import sqs
+from sqs.errors import SQSError
+
+# first line of an envelope body; a body without it is an ordinary message
+ENVELOPE_PREFIX = 'SQSB1\n'
+MAX_BODY_SIZE = 8 * 1024
+DEFAULT_LINGER = 0.05
+MAX_RETRY_WAIT = 5.0
+
+
+def _encoded(body):
+    if isinstance(body, unicode):
+        return body.encode('utf-8')
+    return str(body)
+
+
+def pack(bodies):
+    """
+    Pack message bodies into one envelope body: ENVELOPE_PREFIX, then each
+    body as its length in bytes, a colon and the body itself.
+
+    @param bodies: Message bodies
+    @type  bodies: list
+    @return:       Envelope body
+    @rtype:        string
+    """
+    parts = [ENVELOPE_PREFIX]
+    for body in bodies:
+        body = _encoded(body)
+        parts.append('%d:%s' % (len(body), body))
+    return ''.join(parts)
+
+
+def unpack(body):
+    """
+    The message bodies of an envelope.
+
+    @param body: Body of a received message
+    @type  body: string
+    @return:     Bodies (UTF-8 strings), or None if body is not an envelope
+    @rtype:      list
+    """
+    body = _encoded(body)
+    if not body.startswith(ENVELOPE_PREFIX):
+        return None
+    bodies = []
+    pos = len(ENVELOPE_PREFIX)
+    while pos < len(body):
+        colon = body.find(':', pos)
+        if colon < 0 or not body[pos:colon].isdigit():
+            return None
+        end = colon + 1 + int(body[pos:colon])
+        if end > len(body):
+            return None
+        bodies.append(body[colon + 1:end])
+        pos = end
+    return bodies
+
+
+class Envelope(object):
+    """
+    A received envelope; it is deleted from the queue once every message
+    packed in it has been deleted.
+    """
+    def __init__(self, id, count):
+        self.id = id
+        self.count = count
+        self._acked = set()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<Envelope %s %d/%d>' % (self.id, len(self._acked), self.count)
+
+    def ack(self, index):
+        """
+        Mark message index as done.
+
+        @return: True when this completed the envelope
+        @rtype:  bool
+        """
+        self._lock.acquire()
+        try:
+            if index in self._acked:
+                return False
+            self._acked.add(index)
+            return len(self._acked) == self.count
+        finally:
+            self._lock.release()
+
+
+def unpack_messages(messages, queue):
+    """
+    Replace received envelopes with the messages packed in them. Each such
+    message has the envelope and its index in it as attributes; its id is
+    the envelope's id and the index.
+    """
+    result = []
+    for message in messages:
+        bodies = unpack(message.body)
+        if bodies is None:
+            message.queue = queue
+            result.append(message)
+            continue
+        envelope = Envelope(message.id, len(bodies))
+        for index, body in enumerate(bodies):
+            logical = sqs.SQSMessage(body, '%s#%d' % (message.id, index), queue)
+            logical.envelope = envelope
+            logical.index = index
+            result.append(logical)
+    return result
+
+
+class SQSBatchWriter(object):
+    """
+    Producer that packs many messages into each SQS message.
+
+    write() adds a message to the current envelope. An envelope is sent
+    when the next message would not fit into max_body_size bytes, by the
+    thread writing that message, or linger seconds after its first message,
+    by a background thread. A write() that raises has not queued its
+    message, so it may be retried. If a background send fails, its
+    messages are kept and sent again, waiting twice as long after each
+    failure up to MAX_RETRY_WAIT seconds; the first error is raised from
+    the next write(), flush() or close() call. Safe to use from many
+    threads.
+
+    The messages come out one by one from the queue's read and get_messages
+    once the queue's unpack attribute is set.
+
+        writer = SQSBatchWriter(queue)
+        for event in events:
+            writer.write(event)
+        writer.close()
+    """
+
+    def __init__(self, queue, max_body_size=MAX_BODY_SIZE, linger=DEFAULT_LINGER):
+        """
+        @param queue:         Queue to write to
+        @type  queue:         SQSQueue
+        @param max_body_size: Largest envelope body, at most the service's
+                              maximum message size
+        @type  max_body_size: int
+        @param linger:        Seconds a message may wait for more to fill its
+                              envelope
+        @type  linger:        float
+        """
+        self.queue = queue
+        self.max_body_size = max_body_size
+        self.linger = linger
+        self.messages = 0
+        self.envelopes = 0
+        self._items = []
+        self._size = len(ENVELOPE_PREFIX)
+        self._first_at = None
+        self._error = None
+        self._retry_wait = 0
+        self._retry_at = 0
+        self._closed = False
+        self._cond = threading.Condition(threading.Lock())
+        self._flusher = threading.Thread(target=self._linger)
+        self._flusher.setDaemon(True)
+        self._flusher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _raise_error(self):
+        # called with the lock held
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error[0], error[1], error[2]
+
+    def _take(self):
+        # called with the lock held
+        items, self._items = self._items, []
+        self._size = len(ENVELOPE_PREFIX)
+        self._first_at = None
+        return items
+
+    def write(self, body):
+        """
+        Queue a message.
+
+        @param body: Message body
+        @type  body: string
+        """
+        body = _encoded(body)
+        item = '%d:%s' % (len(body), body)
+        if len(ENVELOPE_PREFIX) + len(item) > self.max_body_size:
+            raise SQSError('MessageTooLong', 'Message does not fit into an envelope',
+                           '%d bytes' % len(body))
+        while True:
+            self._cond.acquire()
+            try:
+                if self._closed:
+                    raise SQSError('WriterClosed', 'The batch writer has been closed')
+                self._raise_error()
+                if self._size + len(item) <= self.max_body_size:
+                    self._items.append(item)
+                    self._size += len(item)
+                    if self._first_at is None:
+                        self._first_at = time.time()
+                        self._cond.notify()
+                    return
+                full = self._take()
+            finally:
+                self._cond.release()
+            # the message goes in only once the full envelope is sent
+            self._send(full)
+
+    def _send(self, items):
+        # send items in as few envelopes as they fit in; on failure the
+        # unsent ones go back ahead of what was written since
+        while items:
+            batch, size = [], len(ENVELOPE_PREFIX)
+            while items and size + len(items[0]) <= self.max_body_size:
+                size += len(items[0])
+                batch.append(items.pop(0))
+            try:
+                self.queue.write(sqs.SQSMessage(ENVELOPE_PREFIX + ''.join(batch)))
+            except:
+                self._cond.acquire()
+                try:
+                    self._items[:0] = batch + items
+                    self._size += sum([len(item) for item in batch + items])
+                    if self._first_at is None:
+                        self._first_at = time.time()
+                finally:
+                    self._cond.release()
+                raise
+            self._cond.acquire()
+            try:
+                self.messages += len(batch)
+                self.envelopes += 1
+            finally:
+                self._cond.release()
+
+    def _linger(self):
+        while True:
+            self._cond.acquire()
+            try:
+                while not self._closed:
+                    if self._first_at is None:
+                        self._cond.wait()
+                        continue
+                    due = max(self._first_at + self.linger, self._retry_at)
+                    if time.time() >= due:
+                        break
+                    self._cond.wait(due - time.time())
+                if self._closed:
+                    return
+                items = self._take()
+            finally:
+                self._cond.release()
+            try:
+                self._send(items)
+            except:
+                error = sys.exc_info()
+                self._cond.acquire()
+                try:
+                    # keep the first error; later ones are usually its echo
+                    if self._error is None:
+                        self._error = error
+                    self._retry_wait = min(max(self._retry_wait * 2, self.linger, 0.05),
+                                           MAX_RETRY_WAIT)
+                    self._retry_at = time.time() + self._retry_wait
+                finally:
+                    self._cond.release()
+            else:
+                self._retry_wait = self._retry_at = 0
+
+    def flush(self):
+        """
+        Send the current envelope now.
+        """
+        self._cond.acquire()
+        try:
+            error, self._error = self._error, None
+            items = self._take()
+        finally:
+            self._cond.release()
+        try:
+            self._send(items)
+        except:
+            if error is None:
+                raise
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+    def close(self):
+        """
+        Send what is left and stop the background thread.
+        """
+        self._cond.acquire()
+        try:
+            closed, self._closed = self._closed, True
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        if not closed:
+            self._flusher.join()
+            self.flush()
@@ -1,48 +1,103 @@
 import re
-import sha
-import hmac
 import time
-import base64
 import socket
 import urllib
 import httplib
 
 import sqs
 from sqs.parsers import parseError
+from s3.signer import Signer, http_date
+from s3.pool import ConnectionPool, DEFAULT_POOL_SIZE, DEFAULT_IDLE_TIMEOUT, unanswered
 
 
 DEFAULT_CONTENT_TYPE = 'text/plain'
 PORTS_BY_SECURITY = { True: 443, False: 80 }
 
+
+class SQSResponse(object):
+    """
+    Response whose body has been read, so its connection could go back to
+    the pool. read() returns the body once, like httplib's responses.
+    """
+    def __init__(self, response, body):
+        self.status = response.status
+        self.reason = response.reason
+        self.msg = response.msg
+        self._body = body
+
+    def getheader(self, name, default=None):
+        return self.msg.getheader(name, default)
+
+    def getheaders(self):
+        return self.msg.items()
+
+    def read(self, amt=None):
+        if amt is None:
+            data, self._body = self._body, ''
+        else:
+            data, self._body = self._body[:amt], self._body[amt:]
+        return data
+
+
 class SQSConnection(object):
     """SQS Connection class.
     
     You shoud never use this class directly. User SQSService instead.
+
+    Requests go over keep-alive connections borrowed from a ConnectionPool
+    (shared with clones), so a connection can be used from many threads and
+    requests for one queue prefer the connection last used for it. With
+    persistent off, every connection has a single socket of its own and is
+    cloned for each request, as it used to be.
     """
-    def __init__(self, pub_key, priv_key, host=sqs.DEFAULT_HOST, port=None, secure=True, debug=0):
+    def __init__(self, pub_key, priv_key, host=sqs.DEFAULT_HOST, port=None, secure=True, debug=0,
+                 metrics=None, pool=None, pool_size=DEFAULT_POOL_SIZE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, persistent=True):
         self._pub_key = pub_key
         self._priv_key = priv_key
+        self._signer = Signer(pub_key, priv_key)
         self._host = host
         if not port:
             self._port = PORTS_BY_SECURITY[secure]
         else:
             self._port = port
         self._secure = secure
-        if (secure):
-            self._conn = httplib.HTTPSConnection("%s:%d" % (self._host, self._port))
-        else:
-            self._conn = httplib.HTTPConnection("%s:%d" % (self._host, self._port))
+        self._conn = None
+        if not persistent:
+            pool = None
+            if (secure):
+                self._conn = httplib.HTTPSConnection("%s:%d" % (self._host, self._port))
+            else:
+                self._conn = httplib.HTTPConnection("%s:%d" % (self._host, self._port))
+        elif pool is None:
+            pool = ConnectionPool(self._host, self._port, secure,
+                                  size=pool_size, idle_timeout=idle_timeout)
+        self._pool = pool
+        self._metrics = metrics
         self._set_debug(debug)
 
 
     def _set_debug(self, debug):
         self._debug = debug
-        self._conn.set_debuglevel(debug)
+        if self._pool is not None:
+            self._pool.set_debuglevel(debug)
+        else:
+            self._conn.set_debuglevel(debug)
 
 
     def clone(self):
-        """C.clone() -> new connection to sqs"""
-        return SQSConnection(self._pub_key, self._priv_key, self._host, self._port, self._secure, self._debug)
+        """C.clone() -> new connection to sqs, sharing this connection's pool"""
+        return SQSConnection(self._pub_key, self._priv_key, self._host, self._port, self._secure,
+                             self._debug, self._metrics, pool=self._pool,
+                             persistent=self._pool is not None)
+
+
+    def _connection(self):
+        # connection to make one request with: pooled ones are thread-safe,
+        # the others are cloned so each request has a socket of its own
+        if self._pool is not None:
+            return self
+        return self.clone()
 
 
     def _auth_header_value(self, method, path, headers):
@@ -53,19 +108,16 @@ class SQSConnection(object):
         auth_parts = [method,
                       headers.get("Content-MD5", ""),
                       headers.get("Content-Type", DEFAULT_CONTENT_TYPE),
-                      headers.get("Date", time.strftime("%a, %d %b %Y %X GMT", time.gmtime())),
+                      headers.get("Date") or http_date(),
                       path]
-        auth_str = "\n".join(auth_parts)
-        auth_str = base64.encodestring(
-            hmac.new(self._priv_key, auth_str, sha).digest()).strip()
-        return "AWS %s:%s" % (self._pub_key, auth_str)
+        return "AWS %s:%s" % (self._pub_key, self._signer.sign("\n".join(auth_parts)))
 
 
     def _headers(self, method, path, length=None, headers=None):
         if not headers:
             headers = {}
         if not headers.has_key('Date'):
-            headers["Date"] = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
+            headers["Date"] = http_date()
         if not headers.has_key('AWS-Version'):
             headers['AWS-Version'] = sqs.VERSION
         if not headers.has_key('Content-Type'):
@@ -114,6 +166,9 @@ class SQSConnection(object):
                 length = self._io_len(send_io)
 
             headers = self._headers(method, path, length=length, headers=headers)
+            if self._pool is not None:
+                return self._pooled(method, path + self._params(params), headers, length,
+                                    send_io, queue)
 
             def do_conn():
                 self._conn.putrequest(method, path + self._params(params))
@@ -121,6 +176,11 @@ class SQSConnection(object):
                     self._conn.putheader(k, v)
                 self._conn.endheaders()
 
+            metrics = self._metrics
+            if metrics is not None:
+                started = time.time()
+                metrics.connection('sqs', self._conn.sock is not None)
+
             retry = False
             try:
                 do_conn()
@@ -130,6 +190,9 @@ class SQSConnection(object):
                 if e[0] == 32:
                     retry = True
             if retry:
+                if metrics is not None:
+                    metrics.retry('sqs', method)
+                    metrics.connection('sqs', False)
                 do_conn()
 
             if send_io is not None:
@@ -139,11 +202,90 @@ class SQSConnection(object):
                     data = send_io.read(httplib.MAXAMOUNT)
                 send_io.read() # seems to be needed to finish the response
             try:
-                r = self._conn.getresponse()
-            except httplib.ResponseNotReady, e:
-                e.args += ('You are probably overlapping SQS ops',)
-                raise e
+                try:
+                    r = self._conn.getresponse()
+                except httplib.ResponseNotReady, e:
+                    e.args += ('You are probably overlapping SQS ops',)
+                    raise e
+            except:
+                if metrics is not None:
+                    metrics.request('sqs', method, None, time.time() - started,
+                                    int(length or 0), 0)
+                raise
+            if metrics is not None:
+                metrics.request('sqs', method, r.status, time.time() - started, int(length or 0),
+                                int(r.getheader('content-length') or 0))
             if r.status < 200 or r.status > 299:
                 raise parseError(r.read())
             return r
         return f
+
+    def _pooled(self, method, url, headers, length, send_io, queue):
+        start = None
+        if send_io is not None and hasattr(send_io, "seek"):
+            start = send_io.tell()
+        metrics = self._metrics
+        if metrics is not None:
+            started = time.time()
+        affinity = None
+        if queue is not None:
+            # the queue's id, without /front or /back
+            affinity = '/'.join(queue.split('/')[:3])
+        conn = self._pool.acquire(affinity=affinity)
+        reused = conn.sock is not None
+        if metrics is not None:
+            metrics.connection('sqs', reused)
+        try:
+            # the server may have closed a kept-alive socket; retry once on
+            # a fresh one if writing failed, or if it hung up without
+            # answering a request that is safe to repeat, never after a
+            # message may have been accepted
+            replayable = send_io is None or start is not None
+            try:
+                self._send(conn, method, url, headers, send_io)
+            except (socket.error, httplib.HTTPException):
+                if not reused or not replayable:
+                    raise
+                self._retry(conn, method, url, headers, send_io, start)
+                reused = False
+            try:
+                r = conn.getresponse()
+            except httplib.HTTPException, e:
+                if not reused or not replayable or not unanswered(method, e):
+                    raise
+                self._retry(conn, method, url, headers, send_io, start)
+                r = conn.getresponse()
+            body = r.read()
+        except:
+            self._pool.discard(conn)
+            if metrics is not None:
+                metrics.request('sqs', method, None, time.time() - started, int(length or 0), 0)
+            raise
+        self._pool.release(conn)
+        if metrics is not None:
+            metrics.request('sqs', method, r.status, time.time() - started, int(length or 0),
+                            len(body))
+        if r.status < 200 or r.status > 299:
+            raise parseError(body)
+        return SQSResponse(r, body)
+
+    def _retry(self, conn, method, url, headers, send_io, start):
+        # send the request again on a fresh socket
+        conn.close()
+        if send_io is not None:
+            send_io.seek(start)
+        if self._metrics is not None:
+            self._metrics.retry('sqs', method)
+            self._metrics.connection('sqs', False)
+        self._send(conn, method, url, headers, send_io)
+
+    def _send(self, conn, method, url, headers, send_io):
+        conn.putrequest(method, url)
+        for k,v in headers.items():
+            conn.putheader(k, v)
+        conn.endheaders()
+        if send_io is not None:
+            data = send_io.read(httplib.MAXAMOUNT)
+            while len(data) > 0:
+                conn.send(data)
+                data = send_io.read(httplib.MAXAMOUNT)
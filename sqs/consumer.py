@@ -0,0 +1,264 @@
+import time
+import threading
+from Queue import Queue
+
+from s3.transfer import imap_unordered
+
+DEFAULT_WORKERS = 8
+DEFAULT_PREFETCH = 20
+DEFAULT_BATCH_SIZE = 10
+DEFAULT_DELETE_WORKERS = 4
+DEFAULT_IDLE_WAIT = 1.0
+MAX_IDLE_WAIT = 20.0
+
+
+class SQSConsumer(object):
+    """
+    Multi-threaded consumer of an SQSQueue.
+
+    A receiver thread keeps a buffer of up to prefetch messages filled with
+    batched get_messages calls; worker threads take messages from it and
+    call handler(message). Messages the handler returns from are deleted in
+    the background, several at once over the pooled connections; messages
+    it raises for are left alone and reappear once their visibility timeout
+    is over. When the queue is empty the receiver backs off, up to
+    MAX_IDLE_WAIT seconds between receives.
+
+    Keep prefetch small compared with what workers get through in a
+    visibility timeout: a message that waited in the buffer longer than
+    visibility_timeout (if given) may already have been handed to another
+    consumer, so it is dropped and counted as expired.
+
+        consumer = SQSConsumer(queue, handle, workers=16)
+        consumer.start()
+        ...
+        consumer.stop()     # finishes the buffered messages first
+
+    Counters (received, processed, failed, expired, deleted, delete_errors,
+    empty_receives) are public attributes; stats() adds rates and lag.
+    """
+
+    def __init__(self, queue, handler, workers=DEFAULT_WORKERS, prefetch=DEFAULT_PREFETCH,
+                 batch_size=DEFAULT_BATCH_SIZE, visibility_timeout=None,
+                 delete_workers=DEFAULT_DELETE_WORKERS, idle_wait=DEFAULT_IDLE_WAIT):
+        """
+        @param queue:              Queue to consume
+        @type  queue:              SQSQueue
+        @param handler:            Called with each SQSMessage; the message is
+                                   deleted unless it raises
+        @type  handler:            callable
+        @param workers:            Number of handler threads
+        @type  workers:            int
+        @param prefetch:           Maximum number of received messages waiting
+                                   for a worker
+        @type  prefetch:           int
+        @param batch_size:         Maximum number of messages per receive
+        @type  batch_size:         int
+        @param visibility_timeout: Visibility timeout requested on receive,
+                                   None for the queue's
+        @type  visibility_timeout: int
+        @param delete_workers:     Number of concurrent deletes
+        @type  delete_workers:     int
+        @param idle_wait:          First wait after an empty receive, in
+                                   seconds; doubled while the queue stays empty
+        @type  idle_wait:          float
+        """
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self.prefetch = prefetch
+        self.batch_size = batch_size
+        self.visibility_timeout = visibility_timeout
+        self.delete_workers = delete_workers
+        self.idle_wait = idle_wait
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+        self.expired = 0
+        self.deleted = 0
+        self.delete_errors = 0
+        self.empty_receives = 0
+        self.last_error = None
+        self._lag = 0.0
+        self._in_flight = 0
+        self._started = None
+        self._stopped = None
+        self._buffer = Queue(prefetch)
+        self._acks = Queue()
+        self._running = False
+        self._draining = True
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._receiver = None
+        self._workers = []
+        self._deleter = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _count(self, counter, n=1):
+        self._lock.acquire()
+        try:
+            setattr(self, counter, getattr(self, counter) + n)
+        finally:
+            self._lock.release()
+
+    def start(self):
+        """
+        Start receiving and handling messages in the background.
+        """
+        if self._running:
+            return
+        self._running = True
+        self._started = time.time()
+        self._stopped = None
+        self._wakeup.clear()
+        self._receiver = self._thread(self._receive)
+        self._workers = [self._thread(self._work) for i in range(self.workers)]
+        self._deleter = self._thread(self._delete)
+
+    def _thread(self, target):
+        thread = threading.Thread(target=target)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+    def stop(self, drain=True, timeout=None):
+        """
+        Stop receiving and wait for the workers and the pending deletes.
+
+        @param drain:   Handle the buffered messages first; if false they are
+                        left to reappear after their visibility timeout
+        @type  drain:   bool
+        @param timeout: Seconds to wait for each thread, None for no limit
+        @type  timeout: float
+        """
+        if not self._running:
+            return
+        self._running = False
+        self._draining = drain
+        self._wakeup.set()
+        self._receiver.join(timeout)
+        for worker in self._workers:
+            self._buffer.put(None)
+        for worker in self._workers:
+            worker.join(timeout)
+        self._acks.put(None)
+        self._deleter.join(timeout)
+        self._stopped = time.time()
+
+    def run(self):
+        """
+        Start, and block until stop() is called from another thread or the
+        process is interrupted; then drain.
+        """
+        self.start()
+        try:
+            while self._running:
+                self._wakeup.wait(1.0)
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+
+    def _receive(self):
+        wait = self.idle_wait
+        while self._running:
+            wanted = min(self.batch_size, self.prefetch - self._buffer.qsize())
+            if wanted < 1:
+                # the buffer is full; put() below would block a whole batch
+                self._wakeup.wait(0.01)
+                continue
+            try:
+                messages = self.queue.get_messages(wanted, self.visibility_timeout)
+            except Exception, e:
+                self.last_error = e
+                self._wakeup.wait(wait)
+                wait = min(wait * 2, MAX_IDLE_WAIT)
+                continue
+            if not messages:
+                self._count('empty_receives')
+                self._wakeup.wait(wait)
+                wait = min(wait * 2, MAX_IDLE_WAIT)
+                continue
+            wait = self.idle_wait
+            self._count('received', len(messages))
+            now = time.time()
+            for message in messages:
+                self._buffer.put((message, now))
+
+    def _work(self):
+        while True:
+            item = self._buffer.get()
+            if item is None:
+                return
+            if not self._running and not self._draining:
+                continue
+            message, received_at = item
+            lag = time.time() - received_at
+            if self.visibility_timeout is not None and lag > self.visibility_timeout:
+                self._count('expired')
+                continue
+            self._lock.acquire()
+            try:
+                self._lag += lag
+                self._in_flight += 1
+            finally:
+                self._lock.release()
+            try:
+                try:
+                    self.handler(message)
+                except Exception, e:
+                    self.last_error = e
+                    self._count('failed')
+                else:
+                    self._count('processed')
+                    self._acks.put(message)
+            finally:
+                self._count('_in_flight', -1)
+
+    def _pending_acks(self):
+        while True:
+            message = self._acks.get()
+            if message is None:
+                return
+            yield message
+
+    def _delete(self):
+        for message, result, error in imap_unordered(self.queue.delete, self._pending_acks(),
+                                                     self.delete_workers):
+            if error is None:
+                self._count('deleted')
+            else:
+                self.last_error = error
+                self._count('delete_errors')
+
+    def stats(self):
+        """
+        @return: The counters, plus buffered (received messages waiting for
+                 a worker), in_flight (being handled), pending_deletes,
+                 processed_per_sec since start and mean_lag (seconds between
+                 receive and handling)
+        @rtype:  dict
+        """
+        self._lock.acquire()
+        try:
+            elapsed = (self._stopped or time.time()) - (self._started or time.time())
+            handled = self.processed + self.failed
+            return {'received': self.received,
+                    'processed': self.processed,
+                    'failed': self.failed,
+                    'expired': self.expired,
+                    'deleted': self.deleted,
+                    'delete_errors': self.delete_errors,
+                    'empty_receives': self.empty_receives,
+                    'buffered': self._buffer.qsize(),
+                    'in_flight': self._in_flight,
+                    'pending_deletes': self._acks.qsize(),
+                    'processed_per_sec': elapsed and self.processed / elapsed or 0.0,
+                    'mean_lag': handled and self._lag / handled or 0.0}
+        finally:
+            self._lock.release()
@@ -1,11 +1,9 @@
 import sqs
-import re
-import sha
-import hmac
 import time
-import base64
 import urllib
 
+from s3.signer import Signer
+
 
 DEFAULT_CONTENT_TYPE = 'text/plain'
 PORTS_BY_SECURITY = { True: 443, False: 80 }
@@ -22,6 +20,7 @@ class SQSGenerator(object):
     def __init__(self, pub_key, priv_key, host=sqs.DEFAULT_HOST, port=None, secure=True):
         self._pub_key = pub_key
         self._priv_key = priv_key
+        self._signer = Signer(pub_key, priv_key)
         self._host = host
         if not port:
             self._port = PORTS_BY_SECURITY[secure]
@@ -60,10 +59,7 @@ class SQSGenerator(object):
 
 
     def _auth_header_value(self, action, timestamp):
-        auth_str = "%s%s" % (action, timestamp)
-        auth_str = base64.encodestring(
-            hmac.new(self._priv_key, auth_str, sha).digest()).strip()
-        return urllib.quote_plus(auth_str)
+        return urllib.quote_plus(self._signer.sign("%s%s" % (action, timestamp)))
         
 
 ##    def _headers(self, headers=None, length=None):
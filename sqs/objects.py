@@ -1,6 +1,8 @@
 import urlparse
+import threading
 from StringIO import StringIO
 from sqs.errors import SQSError
+from sqs.batch import unpack_messages
 from sqs.parsers import parseTimeout, parseMessageCreate, parseMessageRead, parseMessagesRead
 
 
@@ -30,11 +32,44 @@ class SQSMessage(object):
 
 
 class SQSQueue(object):
+    '''
+    With unpack set, read and get_messages return the messages packed into
+    envelopes by an SQSBatchWriter one by one. When read() unpacks an
+    envelope it returns the first message and keeps the rest for the next
+    read or get_messages call. An envelope is deleted once all its messages
+    have been.
+
+    With an S3Offload attached as offload, bodies above its threshold are
+    stored in S3 and only a pointer to them is queued.
+    '''
     def __init__(self, url, sqs_conn):
         self._sqs_conn = sqs_conn
         self.url = url
         self.id = urlparse.urlparse(self.url)[2] 
         self.name = self.id.split('/')[2]
+        self.unpack = False
+        self.offload = None
+        self._unpacked = []
+        self._unpacked_lock = threading.Lock()
+
+    def _buffered(self, number, messages=None):
+        # take up to number (None for all) buffered unpacked messages,
+        # after adding messages
+        self._unpacked_lock.acquire()
+        try:
+            if messages:
+                self._unpacked.extend(unpack_messages(messages, self))
+            if number is None:
+                number = len(self._unpacked)
+            taken, self._unpacked = self._unpacked[:number], self._unpacked[number:]
+            return taken
+        finally:
+            self._unpacked_lock.release()
+
+    def _received(self, messages):
+        if self.offload is not None:
+            messages = self.offload.wrap(messages, self)
+        return messages
 
     def __str__(self):
         return self.name
@@ -48,7 +83,7 @@ class SQSQueue(object):
 ##        @return: Visibility timeout
 ##        @rtype:  int
 ##        '''
-##        response = self._sqs_conn.clone().get()
+##        response = self._sqs_conn._connection().get()
 ##        print respo
 ##        return parseTimeout(response.read())
 
@@ -62,12 +97,24 @@ class SQSQueue(object):
         @return:        One SQSMessage from the front of the Queue
         @rtype:         SQSMessage
         '''
+        if self.unpack:
+            buffered = self._buffered(1)
+            if buffered:
+                return self._received(buffered)[0]
         params = {}
         if timeout != None:
             params = {'VisibilityTimeout' : timeout}
         queue = self.id + '/front'
-        response = self._sqs_conn.clone().get(queue=queue, params=params)
-        return parseMessageRead(response.read())
+        response = self._sqs_conn._connection().get(queue=queue, params=params)
+        message = parseMessageRead(response.read())
+        if message is None:
+            return None
+        if self.unpack:
+            buffered = self._buffered(1, [message])
+            if not buffered:
+                return None
+            message = buffered[0]
+        return self._received([message])[0]
 
 
     def write(self, message):
@@ -79,10 +126,16 @@ class SQSQueue(object):
         @return:        SQSMessage with assigned Queue
         @rtype:         SQSMessage
         '''
+        if self.offload is not None and len(message) > self.offload.threshold:
+            return self.offload.write(self, message)
+        return self._write(message)
+
+
+    def _write(self, message):
         message.queue = self
         headers = {'Content-Length':len(message)}
         queue = self.id + '/back'
-        response = self._sqs_conn.clone().put(queue=queue, send_io=StringIO(message.body), headers=headers)
+        response = self._sqs_conn._connection().put(queue=queue, send_io=StringIO(message.body), headers=headers)
         message.id = parseMessageCreate(response.read())
         return message
 
@@ -90,19 +143,27 @@ class SQSQueue(object):
     def get_messages(self, number, timeout=None):
         '''Get a variable number of messages
         
-        @param number:  Number of messages to get
+        @param number:  Number of messages to get; with unpack set, number of
+                        envelopes, each of which may hold many messages
         @type  number:  int
         @param timeout: Visibility timeout for the message
         @type  timeout: int
         @return:        List of messages
         @rtype:         list
         '''
+        if self.unpack:
+            buffered = self._buffered(None)
+            if buffered:
+                return self._received(buffered)
         queue = self.id + '/front'
         params = {'NumberOfMessages' : number}
         if timeout:
             params['VisibilityTimeout'] = timeout
-        response = self._sqs_conn.clone().get(queue=queue, params=params)
-        return parseMessagesRead(response.read())
+        response = self._sqs_conn._connection().get(queue=queue, params=params)
+        messages = parseMessagesRead(response.read())
+        if self.unpack:
+            messages = unpack_messages(messages, self)
+        return self._received(messages)
 
 
     def delete(self, message):
@@ -111,5 +172,12 @@ class SQSQueue(object):
         @param message: Message to delete
         @type  message: SQSMessage
         '''
+        envelope = getattr(message, 'envelope', None)
+        if envelope is not None:
+            if not envelope.ack(message.index):
+                return
+            message = envelope
         if hasattr(message, 'id'):
-            self._sqs_conn.clone().delete(queue=self.id, message=message.id)
+            self._sqs_conn._connection().delete(queue=self.id, message=message.id)
+            if getattr(message, 'pointer', None) is not None:
+                message.pointer.collect()
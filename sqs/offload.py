@@ -0,0 +1,220 @@
+import sys
+import time
+import uuid
+import threading
+
+from s3.errors import S3Error
+from s3.objects import S3Bucket, S3Object
+from s3.transfer import BackgroundCall
+from sqs.objects import SQSMessage
+from sqs.batch import MAX_BODY_SIZE
+
+# first line of a pointer body; the bucket, key and size follow, one a line
+POINTER_PREFIX = 'SQSS3\n'
+DEFAULT_KEY_PREFIX = 'sqs-payloads/'
+DEFAULT_FETCH_WAIT = 10.0
+
+
+class S3Pointer(object):
+    """
+    Location of a message body stored in S3.
+    """
+    def __init__(self, offload, bucket, key, size):
+        self._offload = offload
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+
+    def __repr__(self):
+        return '<S3Pointer %s/%s>' % (self.bucket.name, self.key)
+
+    def _get(self, stream):
+        # the pointer is queued while the body is still being uploaded, so
+        # the object may not be there yet
+        deadline = time.time() + self._offload.fetch_wait
+        wait = 0.05
+        while True:
+            try:
+                return self.bucket.get(self.key, stream=stream)
+            except S3Error, e:
+                if e.code != 'NoSuchKey' or time.time() + wait > deadline:
+                    raise
+            time.sleep(wait)
+            wait = min(wait * 2, 1.0)
+
+    def fetch(self):
+        """
+        @return: The message body
+        @rtype:  string
+        """
+        return self._get(False).data
+
+    def stream(self):
+        """
+        @return: The S3 object with a streamed body; close it when done
+        @rtype:  S3Object
+        """
+        return self._get(True)
+
+    def collect(self):
+        """
+        Delete the object in the background.
+        """
+        BackgroundCall(self._collect)
+
+    def _collect(self):
+        try:
+            self.bucket.delete(self.key)
+        except Exception, e:
+            self._offload._count('collect_errors')
+            self._offload.last_error = e
+        else:
+            self._offload._count('collected')
+
+
+class S3BackedMessage(SQSMessage):
+    """
+    Received message whose body is stored in S3. The body is fetched on
+    first use, or already being fetched if the S3Offload prefetches;
+    stream() reads it from S3 without keeping it in memory.
+    """
+    def __init__(self, pointer, id=None, queue=None):
+        SQSMessage.__init__(self, None, id, queue)
+        self.pointer = pointer
+        self._fetching = None
+
+    def __len__(self):
+        return self.pointer.size
+
+    def __str__(self):
+        return self.body
+
+    def __repr__(self):
+        return '<S3BackedMessage %s>' % self.pointer.key
+
+    def _getBody(self):
+        if self._body is None:
+            fetching, self._fetching = self._fetching, None
+            if fetching is not None:
+                self._body = fetching.result()
+            else:
+                self._body = self.pointer.fetch()
+        return self._body
+
+    body = property(_getBody, SQSMessage._setBody)
+
+    def stream(self):
+        """
+        @return: The S3 object with a streamed body; close it when done
+        @rtype:  S3Object
+        """
+        return self.pointer.stream()
+
+
+class S3Offload(object):
+    """
+    Stores message bodies above threshold bytes in an S3 bucket and queues
+    a small pointer to them instead.
+
+    Attach it as C{queue.offload}. The upload and the write of the pointer
+    run concurrently; a reader that gets the pointer before the upload has
+    finished waits up to fetch_wait seconds for the object. Received
+    pointers become S3BackedMessages, whose bodies are fetched in the
+    background as soon as they are received if prefetch is set, and on
+    first use otherwise. Deleting such a message from the queue deletes its
+    object in the background.
+
+    Counters offloaded, collected and collect_errors are public attributes.
+    """
+
+    def __init__(self, bucket, threshold=MAX_BODY_SIZE, key_prefix=DEFAULT_KEY_PREFIX,
+                 prefetch=True, fetch_wait=DEFAULT_FETCH_WAIT):
+        """
+        @param bucket:     Bucket to store the bodies in
+        @type  bucket:     S3Bucket
+        @param threshold:  Larger bodies are stored in S3
+        @type  threshold:  int
+        @param key_prefix: Prefix of the generated keys
+        @type  key_prefix: string
+        @param prefetch:   Fetch the bodies of received messages right away
+        @type  prefetch:   bool
+        @param fetch_wait: Seconds to wait for an object that is not there yet
+        @type  fetch_wait: float
+        """
+        self.bucket = bucket
+        self.threshold = threshold
+        self.key_prefix = key_prefix
+        self.prefetch = prefetch
+        self.fetch_wait = fetch_wait
+        self.offloaded = 0
+        self.collected = 0
+        self.collect_errors = 0
+        self.last_error = None
+        self._lock = threading.Lock()
+
+    def _count(self, counter):
+        self._lock.acquire()
+        try:
+            setattr(self, counter, getattr(self, counter) + 1)
+        finally:
+            self._lock.release()
+
+    def write(self, queue, message):
+        """
+        Store the message's body in S3 and queue a pointer to it.
+
+        @param queue:   Queue to write to
+        @type  queue:   SQSQueue
+        @param message: Message to write
+        @type  message: SQSMessage
+        @return:        The message, with the pointer's id
+        @rtype:         SQSMessage
+        """
+        key = self.key_prefix + uuid.uuid4().hex
+        body = message.body
+        upload = BackgroundCall(self.bucket.save, S3Object(key, body, {}))
+        pointer = SQSMessage('%s%s\n%s\n%d' % (POINTER_PREFIX, self.bucket.name, key, len(body)))
+        try:
+            queue._write(pointer)
+        except:
+            error = sys.exc_info()
+            try:
+                upload.result()
+                self.bucket.delete(key)
+            except Exception:
+                pass
+            raise error[0], error[1], error[2]
+        try:
+            upload.result()
+        except:
+            error = sys.exc_info()
+            try:
+                queue.delete(pointer)
+            except Exception:
+                pass
+            raise error[0], error[1], error[2]
+        self._count('offloaded')
+        message.id = pointer.id
+        message.queue = queue
+        return message
+
+    def wrap(self, messages, queue):
+        """
+        Replace received pointers with S3BackedMessages.
+        """
+        result = []
+        for message in messages:
+            body = message._body
+            if isinstance(message, S3BackedMessage) or not body or \
+                    not body.startswith(POINTER_PREFIX):
+                result.append(message)
+                continue
+            name, key, size = body[len(POINTER_PREFIX):].split('\n')
+            bucket = self.bucket
+            if name != bucket.name:
+                bucket = S3Bucket(name, bucket._s3_conn)
+            backed = S3BackedMessage(S3Pointer(self, bucket, key, int(size)), message.id, queue)
+            if self.prefetch:
+                backed._fetching = BackgroundCall(backed.pointer.fetch)
+            result.append(backed)
+        return result
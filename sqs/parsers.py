@@ -71,7 +71,7 @@ def parseTimeout(xml):
 
 def parseMessageCreate(xml):
     root = et.fromstring(xml)
-    return root.find('{%s}MessageId' % xmlns)
+    return root.find('{%s}MessageId' % xmlns).text
 
 
 def parseMessageRead(xml):
@@ -1,14 +1,105 @@
+import time
+import threading
+
 from sqs.objects import SQSQueue
 from sqs.connection import SQSConnection
+from s3.pool import DEFAULT_POOL_SIZE, DEFAULT_IDLE_TIMEOUT
 from sqs.parsers import parseQueueList, parseQueueCreation
 
+DEFAULT_QUEUE_CACHE_TTL = 0
+
 
 class SQSService(object):
     """
     SQS Service class
+
+    With queue_cache_ttl set, queues are cached by name for that many
+    seconds, so get() and delete() do not list the queues every time;
+    list() and create() fill the cache and delete() drops from it. After
+    warmup(), which lists every queue, a name that is not cached is known
+    not to exist, so get() does not touch the network at all until the
+    listing expires. The same SQSQueue object is returned for a name while
+    it is cached. A cached answer can be stale: a queue deleted or created
+    by another client shows up only once the entry expires.
     """
-    def __init__(self, pub_key, priv_key):
-        self._sqs_conn = SQSConnection(pub_key, priv_key)
+    def __init__(self, pub_key, priv_key, metrics=None, pool_size=DEFAULT_POOL_SIZE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, persistent=True,
+                 queue_cache_ttl=DEFAULT_QUEUE_CACHE_TTL):
+        """
+        @param pub_key:         AWS access key id
+        @type  pub_key:         string
+        @param priv_key:        AWS secret access key
+        @type  priv_key:        string
+        @param metrics:         Receives a report of every request
+        @type  metrics:         RequestMetrics
+        @param pool_size:       Maximum number of idle keep-alive connections
+        @type  pool_size:       int
+        @param idle_timeout:    Seconds an idle connection is kept before it
+                                is reopened
+        @type  idle_timeout:    int
+        @param persistent:      Keep connections alive; if false, every
+                                request opens a connection of its own
+        @type  persistent:      bool
+        @param queue_cache_ttl: Seconds a queue is cached by name, 0 to ask
+                                SQS every time, None to cache until deleted
+        @type  queue_cache_ttl: int
+        """
+        self._sqs_conn = SQSConnection(pub_key, priv_key, metrics=metrics, pool_size=pool_size,
+                                       idle_timeout=idle_timeout, persistent=persistent)
+        self.queue_cache_ttl = queue_cache_ttl
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._queues = {}
+        self._complete_time = None
+        self._cache_lock = threading.Lock()
+
+    def _fresh(self, cached_at):
+        # called with the cache lock held
+        if cached_at is None:
+            return False
+        if self.queue_cache_ttl is None:
+            return True
+        return time.time() - cached_at < self.queue_cache_ttl
+
+    def _cache(self, queues, complete=False):
+        now = time.time()
+        self._cache_lock.acquire()
+        try:
+            for queue in queues:
+                cached = self._queues.get(queue.name)
+                if cached is not None and cached[0].url == queue.url:
+                    # keep the object callers may have configured
+                    queue = cached[0]
+                self._queues[queue.name] = (queue, now)
+            if complete:
+                names = set([queue.name for queue in queues])
+                for name in self._queues.keys():
+                    if name not in names:
+                        del self._queues[name]
+                self._complete_time = now
+            return [self._queues[queue.name][0] for queue in queues]
+        finally:
+            self._cache_lock.release()
+
+    def clear_cache(self):
+        """
+        Forget the cached queues.
+        """
+        self._cache_lock.acquire()
+        try:
+            self._queues = {}
+            self._complete_time = None
+        finally:
+            self._cache_lock.release()
+
+    def warmup(self):
+        """
+        Cache every queue, so that get() answers from memory.
+
+        @return: Number of queues
+        @rtype:  int
+        """
+        return len(self.list())
 
     def get(self, name):
         """
@@ -19,6 +110,18 @@ class SQSService(object):
         @return:     Queue if exists, else None
         @rtype:      SQSQueue or None
         """
+        self._cache_lock.acquire()
+        try:
+            cached = self._queues.get(name)
+            if cached is not None and self._fresh(cached[1]):
+                self.cache_hits += 1
+                return cached[0]
+            if cached is None and self._fresh(self._complete_time):
+                self.cache_hits += 1
+                return None
+            self.cache_misses += 1
+        finally:
+            self._cache_lock.release()
         queues = self.list(name)
         for queue in queues:
             if queue.name == name:
@@ -39,8 +142,9 @@ class SQSService(object):
             params = {'QueueNamePrefix' : prefix }
         else:
             params = {}
-        response = self._sqs_conn.clone().get(params=params)
-        return parseQueueList(response.read(), self._sqs_conn)
+        response = self._sqs_conn._connection().get(params=params)
+        queues = parseQueueList(response.read(), self._sqs_conn)
+        return self._cache(queues, complete=not prefix)
 
 
     def create(self, name):
@@ -52,8 +156,8 @@ class SQSService(object):
         @return:     Returns the newly created queue
         @rtype:      SQSQueue
         """
-        response = self._sqs_conn.clone().post(params={'QueueName' : name})
-        return parseQueueCreation(response.read(), self._sqs_conn)
+        response = self._sqs_conn._connection().post(params={'QueueName' : name})
+        return self._cache([parseQueueCreation(response.read(), self._sqs_conn)])[0]
 
 
     def delete(self, name):
@@ -64,4 +168,9 @@ class SQSService(object):
         @type  name: string
         """
         q = self.get(name)
-        self._sqs_conn.clone().delete(queue=q.id)
+        self._sqs_conn._connection().delete(queue=q.id)
+        self._cache_lock.acquire()
+        try:
+            self._queues.pop(name, None)
+        finally:
+            self._cache_lock.release()